@@ -0,0 +1,58 @@
+import argparse
+import socket
+import statistics
+import threading
+import time
+
+from client import QueryThread
+from protocol import supported_compressions
+from server import Server
+
+
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def run_query(pattern, host, port, options):
+    """
+    Run a single query and drop the matched lines, so only the transport is measured.
+
+    :return: (number of matched lines, bytes received, secs)
+    """
+    worker = QueryThread(pattern, host, port, options, output=lambda logs: None)
+    worker.start()
+    worker.join()
+    return worker.cnt, worker.nbytes, worker.time_cost
+
+
+if __name__ == '__main__':
+    # benchmark: python3 bench_transport.py LOG_GLOB [PATTERN] [-r ROUNDS]
+    parser = argparse.ArgumentParser(description='Compare bytes on the wire and latency of result encodings.')
+    parser.add_argument('logs', help='path glob of the log files to query, e.g. machine.01.log')
+    parser.add_argument('pattern', nargs='?', default='frequent_pattern', help='raw string or regex to query')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='number of queries per encoding')
+    args = parser.parse_args()
+
+    host = '127.0.0.1'
+    port = free_port(host)
+    server = Server(host, port, log_glob=args.logs)
+    threading.Thread(target=server.run, daemon=True).start()
+    time.sleep(0.5)
+
+    encodings = [('json', {}), ('json+columnar', {'columnar': True})]
+    for compression in supported_compressions():
+        encodings.append((compression, {'compression': [compression]}))
+        encodings.append(('%s+columnar' % compression, {'compression': [compression], 'columnar': True}))
+
+    baseline = None
+    for name, options in encodings:
+        secs = []
+        for _ in range(args.rounds):
+            cnt, nbytes, cost = run_query(args.pattern, host, port, options)
+            secs.append(cost)
+        if baseline is None:
+            baseline = nbytes
+        print('%-16s %d lines, %d bytes on the wire (%.1f%%), median %.4f secs, min %.4f secs.'
+              % (name, cnt, nbytes, 100.0 * nbytes / max(baseline, 1), statistics.median(secs), min(secs)))
@@ -0,0 +1,265 @@
+import argparse
+import os
+import resource
+import re
+import socket
+import subprocess
+import sys
+import time
+
+from client import Client
+from genlog import gen_logs_fast
+from protocol import QueryMode, supported_compressions
+from scanner import scan_file
+
+
+# average length of a generated log line, e.g. 'frequent_pattern,' + 30 random chars + '\n'
+LINE_BYTES = 47
+
+# pattern -> how often it is found in the generated logs
+QUERIES = [
+    ('rare_pattern_on_7', 'rare'),
+    ('somewhat_freq', 'somewhat frequent'),
+    ('frequent_pattern', 'frequent'),
+]
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(size):
+    """
+    :param size: size string, e.g. '10M', '1G', '4096'
+    :return: number of bytes
+    """
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def log_path(log_dir, machine):
+    return os.path.join(log_dir, 'machine.%02d.log' % machine)
+
+
+def read_counts(count_path):
+    """
+    Parse the count.txt written by genlog.py.
+
+    :param count_path: path of count.txt
+    :return: {machine: {pattern: count}}
+    """
+    counts = {}
+    machine = None
+    with open(count_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            m = re.match(r'Count from machine \{(\d+)\}', line)
+            if m:
+                machine = int(m.group(1))
+                counts[machine] = {}
+            elif ':' in line and machine is not None:
+                key, value = line.split(':', 1)
+                counts[machine][key] = int(value)
+    return counts
+
+
+def generate_logs(log_dir, machines, size):
+    """
+    Generate a log of about size bytes for each machine with the fast generator of genlog.py,
+    unless logs of this size are already there with their counts.
+
+    :param log_dir: directory of the logs and count.txt
+    :param machines: number of machines
+    :param size: expected size of each log in bytes
+    :return: {machine: {pattern: count}}
+    """
+    count_path = os.path.join(log_dir, 'count.txt')
+    size_path = os.path.join(log_dir, 'size.txt')
+    if os.path.exists(count_path) and os.path.exists(size_path):
+        with open(size_path, 'r') as f:
+            generated = f.read().split()
+        counts = read_counts(count_path)
+        if generated == [str(size), str(machines)] and all(os.path.exists(log_path(log_dir, i)) for i in counts):
+            print('[INFO]: Reuse the logs in %s.' % log_dir)
+            return counts
+    os.makedirs(log_dir, exist_ok=True)
+    if os.path.exists(count_path):
+        os.remove(count_path)
+    lines = max(size // LINE_BYTES, 1)
+    t_start = time.time()
+    gen_logs_fast({i: log_path(log_dir, i) for i in range(1, machines + 1)}, lines, count_path=count_path)
+    print('[INFO]: Generated %d logs of %d lines, used %.4f secs.' % (machines, lines, time.time() - t_start))
+    with open(size_path, 'w') as f:
+        f.write('%d %d\n' % (size, machines))
+    return read_counts(count_path)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_servers(hosts, port, log_dir, server_args):
+    """
+    Start a server.py process for each machine on its own loopback address, serving its log.
+
+    :return: list of subprocess.Popen
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    servers = []
+    for i, host in enumerate(hosts, 1):
+        args = [sys.executable, os.path.join(here, 'server.py'), '--host', host, '--port', str(port),
+                '--logs', log_path(log_dir, i)] + server_args
+        servers.append(subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT))
+    # wait until every server accepts connections
+    deadline = time.time() + 30
+    for host in hosts:
+        while True:
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError('server on %s did not start' % host)
+                time.sleep(0.1)
+    return servers
+
+
+def peak_rss(pid):
+    """
+    :param pid: process id
+    :return: peak resident set size of the process in KB, -1 if unknown
+    """
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return -1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def compare_scanner(path, repeat=3):
+    """
+    Time the scanner of the servers against a plain line by line search on a log for each query,
+    both producing the (line number, line) pairs the servers send, so a pattern on which the scanner
+    is slower than the baseline (e.g. a frequent one) shows up.
+
+    :param path: log file path
+    :param repeat: number of runs of each, the fastest one is reported
+    :return: None
+    """
+    def baseline(regex):
+        with open(path, 'rb') as f:
+            return sum(1 for _ in ((n, line) for n, line in enumerate(f, 1) if regex.search(line)))
+
+    print('===== scanner vs line by line on %s =====' % os.path.basename(path))
+    for pattern, name in QUERIES:
+        regex = re.compile(pattern.encode('utf-8'))
+        times = {baseline: [], scan_file: []}
+        for _ in range(repeat):
+            t_start = time.time()
+            expected = baseline(regex)
+            times[baseline].append(time.time() - t_start)
+            t_start = time.time()
+            scanned = sum(1 for _ in scan_file(path, pattern))
+            times[scan_file].append(time.time() - t_start)
+        t_baseline, t_scanner = min(times[baseline]), min(times[scan_file])
+        print('%s (%s): line by line %.4f secs, scanner %.4f secs (%.2fx), %d lines matched.%s'
+              % (pattern, name, t_baseline, t_scanner, t_baseline / max(t_scanner, 1e-9), scanned,
+                 '' if scanned == expected else ' [ERROR]: %d expected.' % expected))
+
+
+def run_benchmark(client, hosts, counts, rounds, options):
+    """
+    Run every query for some rounds and print per-host and end-to-end statistics.
+    The scan time of the first (cold) round is reported apart from the median of the later (warm)
+    rounds, which a result cache of the servers may answer without scanning.
+
+    :return: True if every result matched count.txt
+    """
+    correct = True
+    for pattern, name in QUERIES:
+        latencies = []
+        scan_times = {host: [] for host in hosts}
+        nbytes = {host: 0 for host in hosts}
+        for _ in range(rounds):
+            t_start = time.time()
+            workers = client.query(pattern, output=os.devnull, verbose=False, **options)
+            latencies.append(time.time() - t_start)
+            for i, worker in enumerate(workers, 1):
+                scan_times[worker.host].append(worker.scan_time)
+                nbytes[worker.host] += worker.nbytes
+                found = sum(worker.counts.values()) if options.get('mode') == QueryMode.COUNT else worker.cnt
+                expected = counts.get(i, {}).get(pattern, 0)
+                if found != expected:
+                    print('[ERROR]: %s on %s: %d lines matched, %d expected.' % (pattern, worker.host, found, expected))
+                    correct = False
+        print('===== %s (%s) =====' % (pattern, name))
+        for i, host in enumerate(hosts, 1):
+            cold, warm = scan_times[host][0], scan_times[host][1:]
+            print('%s: %d lines, scan cold %.4f secs, warm median %s, %d bytes per query.'
+                  % (host, counts.get(i, {}).get(pattern, 0), cold,
+                     '%.4f secs' % percentile(warm, 50) if warm else '-', nbytes[host] // rounds))
+        print('latency p50 %.4f secs, p99 %.4f secs.' % (percentile(latencies, 50), percentile(latencies, 99)))
+    return correct
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark distributed grep on generated logs.')
+    parser.add_argument('-s', '--size', default='10M', help='size of each generated log, e.g. 10M, 1G, 10G')
+    parser.add_argument('-n', '--hosts', type=int, default=3, help='number of local servers, at most 10')
+    parser.add_argument('-r', '--rounds', type=int, default=10, help='number of runs of each query')
+    parser.add_argument('-d', '--dir', default='bench', help='directory of the generated logs')
+    parser.add_argument('-c', '--count', action='store_true', help='only count matched lines')
+    parser.add_argument('-p', '--parallel', action='store_true', help='scan the logs with all cores of each server')
+    parser.add_argument('-z', '--compress', action='store_true', help='compress the results')
+    parser.add_argument('--columnar', action='store_true', help='send results in columnar batches')
+    parser.add_argument('--session', action='store_true', help='run the queries on persistent connections')
+    parser.add_argument('--index', action='store_true', help='let the servers keep a sidecar trigram index')
+    parser.add_argument('--cache-bytes', default='0',
+                        help='memory limit of the result cache of the servers, default 0 measures full scans')
+    parser.add_argument('--no-scanner', action='store_true',
+                        help='skip timing the scanner against a line by line search on the first log')
+    args = parser.parse_args()
+
+    num_hosts = min(max(args.hosts, 1), 10)
+    log_dir = os.path.abspath(args.dir)
+    counts = generate_logs(log_dir, num_hosts, parse_size(args.size))
+    if not args.no_scanner:
+        compare_scanner(log_path(log_dir, 1))
+
+    hosts = ['127.0.0.%d' % i for i in range(1, num_hosts + 1)]
+    port = free_port()
+    server_args = []
+    if args.index:
+        server_args.append('--index')
+    server_args += ['--cache-bytes', str(parse_size(args.cache_bytes))]
+    servers = start_servers(hosts, port, log_dir, server_args)
+    options = {'mode': QueryMode.COUNT if args.count else QueryMode.LINES, 'parallel': args.parallel,
+               'columnar': args.columnar}
+    if args.compress:
+        options['compression'] = supported_compressions()
+    try:
+        c = Client(hosts=hosts, port=port)
+        if args.session:
+            c.connect()
+        correct = run_benchmark(c, hosts, counts, args.rounds, options)
+        c.close()
+        print('===== RSS =====')
+        for host, server in zip(hosts, servers):
+            print('%s: peak %d KB.' % (host, peak_rss(server.pid)))
+        print('client: peak %d KB.' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        print('Results match count.txt.' if correct else 'Results do NOT match count.txt.')
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    sys.exit(0 if correct else 1)
@@ -0,0 +1,193 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from scanner import Scanner, split_chunks, CHUNK_SIZE
+from index import required_trigrams
+
+
+# default memory limit of all cached results
+CACHE_BYTES = 64 * 1024 * 1024
+
+# rough memory cost of a cached match besides its content
+MATCH_OVERHEAD = 64
+
+# number of bytes before the scanned offset kept to check that a grown log still has the same prefix
+PREFIX_CHECK = 4096
+
+
+class CacheEntry:
+    def __init__(self, inode, size, mtime, scanned, prefix, next_line, matches, nbytes):
+        self.inode = inode
+        self.size = size  # file size when the entry is made
+        self.mtime = mtime
+        self.scanned = scanned  # offset after the last complete line covered by matches
+        self.prefix = prefix  # last PREFIX_CHECK bytes before scanned
+        self.next_line = next_line  # line number of the line starting at scanned
+        self.matches = matches  # [(line_number, line), ...] of complete lines before scanned
+        self.nbytes = nbytes
+
+
+class ResultCache:
+    def __init__(self, max_bytes=CACHE_BYTES):
+        """
+        An LRU cache of query results on a log file, bounded by the total size of cached lines.
+
+        An entry is keyed by the pattern and checked against the inode, size and mtime of the log.
+        If the log only grew since then (same inode, larger size and the bytes before the cached
+        offset unchanged), the cached matches are reused and only the appended bytes are scanned.
+        Any other change, e.g. a rewrite in place with a new mtime, is a miss.
+
+        :param max_bytes: memory limit of all cached results
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (path, pattern) -> CacheEntry
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0  # log unchanged, nothing scanned
+        self.partial_hits = 0  # log grown, only the new tail scanned
+        self.misses = 0
+        self.saved_bytes = 0  # bytes which did not need to be scanned thanks to the cache
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'partial_hits': self.partial_hits,
+                'misses': self.misses,
+                'saved_bytes': self.saved_bytes,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+            }
+
+    def get(self, key, f, st):
+        """
+        :param key: (path, pattern)
+        :param f: the log opened in binary mode
+        :param st: os.stat_result of the log now
+        :return: a usable CacheEntry or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                unchanged = entry.size == st.st_size and entry.mtime == st.st_mtime
+                grown = entry.size < st.st_size and os.pread(
+                    f.fileno(), len(entry.prefix), entry.scanned - len(entry.prefix)) == entry.prefix
+                if entry.inode != st.st_ino or not (unchanged or grown):
+                    self.remove(key)  # rotated, truncated or rewritten
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            if unchanged:
+                self.hits += 1
+            else:
+                self.partial_hits += 1
+            self.saved_bytes += entry.scanned
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if entry.nbytes > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        self.nbytes -= self.entries.pop(key).nbytes
+
+    def scan(self, path, pattern, cancelled=None, index=None):
+        """
+        Scan a log file through the cache.
+
+        :param path: log file path
+        :param pattern: query string or Scanner
+        :param cancelled: optional callable, the scan stops once it returns True
+        :param index: optional LogIndex of the log, to only scan its candidate blocks on a miss or a tail
+        :return: generator of (line_number, line) where line is bytes including its newline
+        """
+        scanner = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+        key = (path, scanner.pattern)
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            entry = self.get(key, f, st)
+            if entry is not None:
+                yield from entry.matches
+                scanned, next_line = entry.scanned, entry.next_line
+            else:
+                scanned, next_line = 0, 1
+            if st.st_size == scanned:
+                return
+            matches = list(entry.matches) if entry is not None else []
+            nbytes = entry.nbytes if entry is not None else 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                size = min(st.st_size, len(buf))
+                # only complete lines are cached, the line being written is scanned every time
+                last = max(buf.rfind(b'\n', scanned, size) + 1, scanned)
+                if index is not None:
+                    ranges, end_line = index_ranges(index, scanner, scanned, next_line, last)
+                else:
+                    ranges, end_line = [(scanned, last, next_line)], None
+                for range_start, range_end, first_line in ranges:
+                    line_number = first_line
+                    num_chunks = (range_end - range_start) // CHUNK_SIZE
+                    for start, end in split_chunks(buf, num_chunks, range_start, range_end):
+                        if cancelled is not None and cancelled():
+                            return
+                        lines = scanner.scan(buf, start, end, line_number)
+                        while True:
+                            try:
+                                line_number, line = next(lines)
+                            except StopIteration as stop:
+                                line_number = stop.value
+                                break
+                            if matches is not None:
+                                matches.append((line_number, line))
+                                nbytes += len(line) + MATCH_OVERHEAD
+                                if nbytes > self.max_bytes:
+                                    matches = None  # too large to be cached, stop collecting
+                            yield line_number, line
+                    next_line = line_number
+                if end_line is not None:
+                    next_line = end_line
+                if last > scanned and matches is not None:
+                    prefix = buf[max(last - PREFIX_CHECK, 0):last]
+                    self.put(key, CacheEntry(st.st_ino, size, st.st_mtime, last, prefix, next_line, matches, nbytes))
+                if last < size:
+                    yield from scanner.scan(buf, last, size, next_line)
+
+
+def index_ranges(index, scanner, scanned, next_line, last):
+    """
+    Byte ranges of the complete lines between scanned and last which may match, according to the index.
+
+    :param index: LogIndex of the log
+    :param scanner: Scanner of the query
+    :param scanned: offset of a line start
+    :param next_line: line number of the line starting at scanned
+    :param last: offset of a line end, after scanned
+    :return: ([(start, end, first line number), ...], line number of the line starting at last or None
+             if it is the end of the last range)
+    """
+    index.update()
+    candidates, indexed_size, indexed_lines = index.candidate_ranges(required_trigrams(scanner.pattern))
+    ranges = []
+    for start, end, first_line in candidates:
+        if end <= scanned or start >= last:
+            continue
+        if start < scanned:
+            start, first_line = scanned, next_line
+        ranges.append((start, min(end, last), first_line))
+    if indexed_size < last:
+        if indexed_size <= scanned:
+            ranges.append((scanned, last, next_line))
+        else:
+            ranges.append((indexed_size, last, indexed_lines + 1))
+        return ranges, None
+    return ranges, index.lines_before(last)[1] + 1
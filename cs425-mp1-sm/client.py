@@ -1,9 +1,10 @@
 import socket
-import json
+import argparse
 import sys
 import time
 import threading
-import os
+import queue
+from protocol import *
 
 # hard code hosts' (VMs') ip and port here
 # todo: use config file instead
@@ -22,134 +23,669 @@ HOSTS = [
 PORT = 55558
 
 
+class Connection(threading.Thread):
+    def __init__(self, host, port):
+        """
+        A persistent session connection to a single server. Several queries can be in flight
+        on it at the same time: each request is tagged with an id, and a reader thread routes
+        the reply frames to the queue of their request.
+
+        :param host: host of the server
+        :param port: port of the server
+        """
+        super(Connection, self).__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.socket = None
+        self.lock = threading.Lock()  # guards sending, the pending requests and reconnecting
+        self.pending = {}  # request id -> queue of (message, bytes received)
+        self.next_id = 0
+        self.closed = True
+
+    def connect(self):
+        """
+        Open the connection and start a session on it.
+
+        :return: None
+        """
+        s = socket.create_connection((self.host, self.port))
+        try:
+            send_msg(s, {'type': MessageType.SESSION})
+            msg = recv_msg(s)
+            if not msg or msg.get('type') != MessageType.SESSION:
+                raise OSError('server does not support sessions')
+        except (OSError, ValueError):
+            s.close()
+            raise
+        self.socket = s
+        self.closed = False
+        self.start()
+
+    def run(self):
+        """
+        Read reply frames until the connection is closed, and route them by request id.
+
+        :return: None
+        """
+        try:
+            while True:
+                msg, nbytes = recv_frame(self.socket)
+                if not msg:
+                    break
+                with self.lock:
+                    frames = self.pending.get(msg.get('id'))
+                if frames is not None:  # frames of cancelled requests are dropped
+                    frames.put((msg, nbytes))
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                for frames in self.pending.values():
+                    frames.put((None, 0))
+                self.pending.clear()
+
+    def request(self, msg):
+        """
+        Send a request on the session.
+
+        :param msg: request message
+        :return: (request id, queue of (message, bytes received) replies, (None, 0) once the connection is gone)
+        """
+        frames = queue.Queue()
+        with self.lock:
+            if self.closed:
+                raise OSError('connection to %s is closed' % self.host)
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = frames
+            msg = dict(msg, id=request_id)
+            send_msg(self.socket, msg)
+        return request_id, frames
+
+    def cancel(self, request_id):
+        """
+        Cancel a request in flight, its waiting thread gets (None, 0) at once.
+
+        :param request_id: id returned by request()
+        :return: None
+        """
+        with self.lock:
+            frames = self.pending.pop(request_id, None)
+            if frames is None:
+                return
+            frames.put((None, 0))
+            if not self.closed:
+                try:
+                    send_msg(self.socket, {'type': MessageType.CANCEL, 'id': request_id})
+                except OSError:
+                    pass
+
+    def finish(self, request_id):
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+
 class QueryThread(threading.Thread):
-    def __init__(self, pattern, host, port):
+    def __init__(self, pattern, host, port, options=None, output=None, connection=None, timeout=None, target=None):
         """
         Define thread for query.
 
         :param pattern: query string, e.g. 'a'(raw string), 'a[a-z]b'(regex)
         :param host: host of query target
         :param port: port of query target
+        :param options: extra query options sent to the server, e.g. {'parallel': True}
+        :param output: callable, called with the list of matched results of every received batch
+        :param connection: persistent Connection to the host, a new connection is opened if None
+        :param timeout: max secs to wait for connecting and for each reply frame, None to wait forever
+        :param target: host whose logs are queried, differs from host if host is one of its replicas
         """
         super(QueryThread, self).__init__()
         self.pattern = pattern
         self.host = host
         self.port = port
+        self.options = options or {}
+        self.output = output
+        self.connection = connection
+        self.timeout = timeout
+        self.target = target or host
+        self.request_id = None  # id of the query on the persistent connection
         self.time_cost = -1.0  # record time cost for single thread
+        self.cnt = 0  # number of received lines
+        self.nbytes = 0  # number of bytes received on the wire
+        self.counts = {}  # log path -> number of matched lines, reported by the server
+        self.groups = {}  # value of the capture group -> number of matched lines, in aggregate mode
+        self.scan_time = -1.0  # time cost of the query on the server
+        self.timings = {}  # phase timings and throughput of the query on the server
+        self.found = threading.Event()  # set once any line is received
+        self.completed = False  # set once the END frame is received
+        self.error = None  # why the query failed
+        self.socket = None
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the query from another thread. Closing the connection (or sending a CANCEL on
+        a persistent one) also stops the scan on the server.
+
+        :return: None
+        """
+        self.cancelled = True
+        if self.connection is not None:
+            if self.request_id is not None:
+                self.connection.cancel(self.request_id)
+        elif self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def receive(self, next_frame):
+        """
+        Receive returned batches and hand them out as soon as they arrive.
+
+        :param next_frame: callable returning the next (message, bytes received), (None, 0) on EOF
+        :return: None
+        """
+        while True:
+            msg, nbytes = next_frame()
+            if not msg:
+                if not self.cancelled:
+                    self.error = 'connection closed before the end of the query'
+                    print('[ERROR]: ', self.host, self.error)
+                break
+            self.nbytes += nbytes
+            if msg['type'] == MessageType.END:
+                self.counts = msg.get('counts', {})
+                self.scan_time = msg.get('secs', -1.0)
+                self.groups = msg.get('groups', {})
+                self.timings = msg.get('timings', {})
+                for log_path, error in msg.get('errors', {}).items():
+                    print('[ERROR]: ', self.host, log_path, error)
+                self.completed = True
+                break
+            if msg['type'] == MessageType.ERROR:
+                self.error = msg.get('info', '#')
+                print('[ERROR]: ', self.host, self.error)
+                break
+            if msg['type'] != MessageType.BATCH:
+                continue
+            matches = batch_matches(msg)
+            self.cnt += len(matches)
+            if self.output is not None:
+                self.output(matches)
+            self.found.set()
 
     def run(self):
         """
         Do the query as a single thread for a client.
         :return: None
         """
-        logs = []  # the result of query
         d = {
+            'type': MessageType.QUERY,
             'pattern': self.pattern,
         }  # pattern json format
+        d.update(self.options)
+
+        if self.connection is not None:
+            try:
+                t_start = time.time()
+                self.request_id, frames = self.connection.request(d)
+                if self.cancelled:
+                    self.connection.cancel(self.request_id)
+
+                def next_frame():
+                    try:
+                        return frames.get(timeout=self.timeout)
+                    except queue.Empty:
+                        raise socket.timeout('timed out')
+
+                self.receive(next_frame)
+                self.time_cost = time.time() - t_start
+            except OSError as e:
+                if not self.cancelled:
+                    self.error = e.__str__()
+                    print('[ERROR]: ', self.host, e.__class__().__str__(), e.__str__())
+                    self.connection.cancel(self.request_id)
+            finally:
+                if self.request_id is not None:
+                    self.connection.finish(self.request_id)
+            return
 
         # do the query for each host
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            self.socket = s
+            s.settimeout(self.timeout)
             try:
                 t_start = time.time()
                 s.connect((self.host, self.port))
 
-                # send query pattern as json format
-                data = json.dumps(d).encode('utf-8')
-                s.sendall(data)
-
-                # receive return results
-                while True:
-                    data = b''
-                    # declare the barrier here
-                    # only process after receiving all returned data
-                    while True:
-                        temp = s.recv(4096)
-                        if temp:
-                            data += temp
-                        else:
-                            break
-                    if data:
-                        res = json.loads(data.decode('utf-8'))
-                        logs += res
-                    else:
-                        break
-
-                if logs:
-                    with open('%s.temp' % self.host, 'w') as f:
-                        for log in logs:
-                            line = ' '.join([log.get('host', '#'),
-                                             log.get('port', '#'),
-                                             log.get('log_path', '#'),
-                                             str(log.get('line_number', -1)),
-                                             log.get('content', '#')])
-                            f.write(line)
+                # send query pattern as a json frame
+                send_msg(s, d)
+
+                self.receive(lambda: recv_frame(s))
                 t_end = time.time()
                 self.time_cost = t_end - t_start
 
             # handle the client exception
             except (OSError, socket.error) as e:
-                print('[ERROR]: ', self.host, e.__class__().__str__(), e.__str__())
+                if not self.cancelled:
+                    self.error = e.__str__()
+                    print('[ERROR]: ', self.host, e.__class__().__str__(), e.__str__())
+
+
+def print_stats(stats, indent=''):
+    """
+    Print nested statistics, one value per line.
+
+    :param stats: dict
+    :param indent: prefix of every line
+    :return: None
+    """
+    for k, v in stats.items():
+        if isinstance(v, dict) and v:
+            print('%s%s:' % (indent, k))
+            print_stats(v, indent + '  ')
+        elif isinstance(v, list) and v and isinstance(v[0], dict):
+            print('%s%s:' % (indent, k))
+            for i, item in enumerate(v):
+                print('%s  - #%d' % (indent, i))
+                print_stats(item, indent + '    ')
+        else:
+            print('%s%s: %s' % (indent, k, '%.4f' % v if isinstance(v, float) else v))
+
+
+def merge_groups(workers):
+    """
+    Merge the partial aggregates of an aggregate query from all hosts.
+
+    :param workers: list of finished QueryThread
+    :return: dict of value of the capture group -> number of matched lines on all hosts
+    """
+    groups = {}
+    for worker in workers:
+        for value, cnt in worker.groups.items():
+            groups[value] = groups.get(value, 0) + cnt
+    return groups
 
 
 class Client:
-    def __init__(self, hosts=HOSTS, port=PORT):
+    def __init__(self, hosts=HOSTS, port=PORT, replicas=None):
+        """
+        :param hosts: hosts of the servers
+        :param port: port of the servers
+        :param replicas: dict of host -> list of replica hosts serving the same logs, tried in order
+        """
         self.hosts = hosts
         self.port = port
+        self.replicas = replicas or {}
+        self.output_lock = threading.Lock()
+        self.connections = None  # host -> persistent Connection, only after connect()
+        self.connections_lock = threading.Lock()
 
-    def clean_temp_files(self):
-        for file in os.listdir(os.path.dirname(os.path.realpath(__file__))):
-            if file.endswith('.temp'):
-                print('[INFO] Old temp file %s is founded and cleaned.' % file)
-                os.remove(file)
+    def connect(self):
+        """
+        Keep a persistent session connection to every server, shared by the following queries
+        (also ones run from several threads at the same time) until close() is called.
 
-    def query(self, pattern):
+        :return: None
         """
-        Do the query as a client. Kill the client after finishing the query.
+        with self.connections_lock:
+            self.connections = {}
+        for host in self.hosts:
+            self.get_connection(host)
 
-        :param pattern: query string, e.g. 'a'(raw string), 'a[a-z]b'(regex)
+    def get_connection(self, host):
+        """
+        :param host: host of the server
+        :return: persistent Connection to the host, reopened if it was lost,
+                 None if not connected (then a query opens its own connection)
+        """
+        with self.connections_lock:
+            if self.connections is None:
+                return None
+            connection = self.connections.get(host)
+            if connection is None or connection.closed:
+                connection = Connection(host, self.port)
+                try:
+                    connection.connect()
+                except (OSError, ValueError) as e:
+                    print('[ERROR]: ', host, e.__class__().__str__(), e.__str__())
+                    return None
+                self.connections[host] = connection
+            return connection
+
+    def close(self):
+        """
+        Close the persistent connections.
+
+        :return: None
+        """
+        with self.connections_lock:
+            connections, self.connections = self.connections, None
+        for connection in (connections or {}).values():
+            connection.close()
+
+    def stats(self):
+        """
+        Print the statistics (e.g. result cache hits and misses) of every server.
+
+        :return: None
+        """
+        for host in self.hosts:
+            try:
+                with socket.create_connection((host, self.port)) as s:
+                    send_msg(s, {'type': MessageType.STATS})
+                    msg = recv_msg(s)
+                    print('===== %s =====' % host)
+                    print_stats((msg or {}).get('stats', {}))
+            except OSError as e:
+                print('[ERROR]: ', host, e.__class__().__str__(), e.__str__())
+
+    def write(self, out, logs):
+        """
+        Write matched results to the output, one line each.
+
+        :param out: text file object, e.g. sys.stdout
+        :param logs: list of matched results
         :return: None
         """
+        lines = []
+        for log in logs:
+            line = ' '.join([log.get('host', '#'),
+                             log.get('port', '#'),
+                             log.get('log_path', '#'),
+                             str(log.get('line_number', -1)),
+                             log.get('content', '#')])
+            lines.append(line if line.endswith('\n') else line + '\n')
+        with self.output_lock:
+            out.write(''.join(lines))
+            out.flush()
+
+    def start_attempt(self, pattern, host, target, options, output, timeout):
+        """
+        Start a query on a host, either the target itself or one of its replicas.
+
+        :return: started QueryThread
+        """
+        worker = QueryThread(pattern, host, self.port, options, output, self.get_connection(host), timeout, target)
+        worker.start_time = time.time()
+        worker.start()
+        return worker
+
+    def query(self, pattern, output=None, ordered=False, verbose=True, timeout=None, host_timeout=None, hedge=None,
+              **options):
+        """
+        Do the query as a client. Kill the client after finishing the query.
+        Matched lines are written out as soon as each host delivers them, and counted on the fly.
 
-        self.clean_temp_files()  # clean .temp files
+        A host which fails or takes longer than host_timeout is retried on its next replica, and a
+        host still running after hedge secs gets a second request to its next replica, whichever
+        finishes first wins. Results from a host with replicas are buffered until an attempt wins,
+        so no line is written twice. Hosts still running at the overall deadline are cancelled and
+        reported, the results received so far are kept.
 
+        :param pattern: query string, e.g. 'a'(raw string), 'a[a-z]b'(regex)
+        :param output: path of a file to write matched lines to, or a file opened by the caller
+                       (e.g. once for all queries of a session), default is stdout
+        :param ordered: write matched lines ordered by host, file and line number after all hosts are done,
+                        instead of in arrival order
+        :param verbose: print the statistics of the query
+        :param timeout: overall deadline of the query in secs, None to wait for every host
+        :param host_timeout: max secs for a single host to answer, None to wait forever
+        :param hedge: secs after which a still running host is hedged on its replica, None to never hedge
+        :param options: extra query options, e.g.
+                        - parallel=True: scan with all cores of each server
+                        - mode='count': only get the number of matched lines from each server
+                        - mode='exists': stop all servers once any of them finds a matched line
+                        - mode='aggregate': only get the number of matched lines per value of a capture group
+                          from each server, e.g. pattern='(?P<kind>^[a-z_]+),', merged on the client
+                        - group='kind': name or number of the capture group to aggregate by
+                        - limit=N: get at most N matched lines from each server
+                        - path='/var/log/app*.log*': path glob of the log files on each server
+                        - compression=['lz4', 'zlib']: compressions to offer, preferred first
+                        - columnar=True: send host, port and log paths once per batch
+                        - since='2018-09-10 12:00', until='2018-09-10 12:30': only lines with a timestamp
+                          in this range, both ends inclusive at the precision they are given with
+                        - follow=True: keep pushing the new matched lines appended to the logs, until
+                          the deadline or Ctrl-C
+        :return: list of QueryThread, one per host: the attempt which answered, or the last one tried
+        """
         time_start = time.time()  # record total parallel time
         d_time = {}  # record time cost for each thread
+        mode = options.get('mode', QueryMode.LINES)
+        follow = options.get('follow', False)
+        out = open(output, 'w') if isinstance(output, str) else output or sys.stdout
+        results = {host: [] for host in self.hosts}  # matched results per host in ordered mode
+        buffers = {}  # attempt -> its buffered results, for hosts with replicas
 
-        # assert worker for each query
-        workers = [QueryThread(pattern, host, PORT) for host in HOSTS]
-        for worker in workers:
-            worker.start()
+        def make_output(host):
+            if mode in (QueryMode.EXISTS, QueryMode.AGGREGATE):
+                return None
+            if self.replicas.get(host) and not follow:
+                buffer = []
+                return buffer, buffer.extend
+            if ordered and not follow:
+                return None, results[host].extend
+            return None, lambda logs: self.write(out, logs)
 
-        # end each worker, record time cost
-        for worker in workers:
-            worker.join()
-            d_time[worker.host] = worker.time_cost
+        def attempt(host, target):
+            buffer, write = make_output(target) or (None, None)
+            worker = self.start_attempt(pattern, host, target, options, write, host_timeout)
+            if buffer is not None:
+                buffers[worker] = buffer
+            return worker
+
+        attempts = {host: [attempt(host, host)] for host in self.hosts}  # host -> its started attempts
+        answered = {}  # host -> the attempt which finished the query for it
+        failed = []  # hosts which failed on every replica
+        missed = []  # hosts which missed the overall deadline
+        deadline = time_start + timeout if timeout is not None else None
+
+        try:
+            while True:
+                now = time.time()
+                for host in self.hosts:
+                    if host in answered or host in failed:
+                        continue
+                    tried = attempts[host]
+                    winner = next((w for w in tried if w.completed and not w.is_alive()), None)
+                    if winner is not None:
+                        answered[host] = winner
+                        for worker in tried:
+                            if worker is not winner:
+                                worker.cancel()
+                        if winner in buffers:
+                            if ordered:
+                                results[host].extend(buffers[winner])
+                            elif mode != QueryMode.EXISTS:
+                                self.write(out, buffers[winner])
+                        continue
+                    running = [w for w in tried if w.is_alive()]
+                    if host_timeout is not None:
+                        for worker in running:
+                            if now - worker.start_time > host_timeout:
+                                print('[ERROR]: ', worker.host, 'timed out after %.4f secs' % host_timeout)
+                                worker.cancel()
+                                worker.error = 'timed out'
+                        running = [w for w in running if not w.cancelled]
+                    replicas = self.replicas.get(host, [])
+                    more = len(tried) <= len(replicas)  # a replica is left to try
+                    if not running:
+                        if more:
+                            print('[INFO]: Retry %s on %s.' % (host, replicas[len(tried) - 1]))
+                            tried.append(attempt(replicas[len(tried) - 1], host))
+                        else:
+                            failed.append(host)
+                    elif hedge is not None and more and now - tried[-1].start_time > hedge:
+                        print('[INFO]: Hedge %s on %s.' % (host, replicas[len(tried) - 1]))
+                        tried.append(attempt(replicas[len(tried) - 1], host))
+
+                if mode == QueryMode.EXISTS and any(w.found.is_set() for tried in attempts.values() for w in tried):
+                    break  # one matched line is enough
+                if len(answered) + len(failed) == len(self.hosts):
+                    break
+                if deadline is not None and now >= deadline:
+                    if not follow:  # the deadline is the normal end of a follow query
+                        missed = [host for host in self.hosts if host not in answered and host not in failed]
+                    break
+                try:
+                    time.sleep(0.01)
+                except KeyboardInterrupt:
+                    if not follow:
+                        raise
+                    break  # a follow query runs until it is interrupted
+
+            # cancel the attempts which are still running, and end each worker
+            for tried in attempts.values():
+                for worker in tried:
+                    if worker.is_alive():
+                        worker.cancel()
+            for tried in attempts.values():
+                for worker in tried:
+                    worker.join()
+
+            workers = [answered.get(host, attempts[host][-1]) for host in self.hosts]
+            for worker in workers:
+                d_time[worker.target] = worker.time_cost
+
+            if ordered and not follow:
+                for host in self.hosts:
+                    logs = results[host]
+                    logs.sort(key=lambda log: (log.get('log_path', ''), log.get('line_number', -1)))
+                    self.write(out, logs)
+
+            if mode == QueryMode.AGGREGATE:
+                groups = merge_groups(workers)
+                lines = ['%s %d\n' % (value, cnt) for value, cnt in sorted(groups.items(), key=lambda g: (-g[1], g[0]))]
+                with self.output_lock:
+                    out.write(''.join(lines))
+        finally:
+            if isinstance(output, str):
+                out.close()
+            else:
+                out.flush()
 
         time_end = time.time()  # # record total parallel time
 
-        # get results from local-saved .temp files
-        d_cnt = {}
-        for file in os.listdir(os.path.dirname(os.path.realpath(__file__))):
-            cnt = 0
-            if file.endswith('.temp'):
-                with open(file, 'r') as f:
-                    for line in f:
-                        print(line, end='')
-                        cnt += 1
-                d_cnt[file.rstrip('.temp')] = cnt
+        if not verbose:
+            return workers
+
+        if mode == QueryMode.EXISTS:
+            found = [w.host for tried in attempts.values() for w in tried if w.found.is_set()]
+            if found:
+                print('Pattern found on %s.' % ', '.join(found))
+            else:
+                print('Pattern not found.')
+            print('Used %.4f secs.' % (time_end - time_start))
+            return workers
 
         print('===== STAT =====')
         total_lines = 0
-        for host, cnt in d_cnt.items():
-            print('From %s, %d lines matched, used %.4f secs.' % (host, cnt, d_time.get(host, -1.)))
+        for worker in workers:
+            cnt = sum(worker.counts.values()) if mode in (QueryMode.COUNT, QueryMode.AGGREGATE) else worker.cnt
+            if cnt:
+                via = ' (by %s)' % worker.host if worker.host != worker.target else ''
+                groups = ' in %d groups' % len(worker.groups) if mode == QueryMode.AGGREGATE else ''
+                print('From %s%s, %d lines matched%s, used %.4f secs.'
+                      % (worker.target, via, cnt, groups, d_time.get(worker.target, -1.)))
             total_lines += cnt
+        if missed:
+            print('Missed the deadline (partial results): %s' % ', '.join(missed))
+        if failed:
+            print('Failed: %s' % ', '.join(failed))
         print('Total %d line, used %.4f secs.' % (total_lines, time_end - time_start))
+        return workers
 
 
 if __name__ == '__main__':
-    c = Client()
-    if len(sys.argv) != 2:
-        print('[ERROR]: Input arg should be 1 for regex.')
+    parser = argparse.ArgumentParser(description='Distributed log querier.')
+    parser.add_argument('pattern', nargs='?', help='raw string or regex to query')
+    parser.add_argument('-p', '--parallel', action='store_true',
+                        help='scan the log with all cores of each server')
+    parser.add_argument('-c', '--count', action='store_true',
+                        help='only get the number of matched lines from each server')
+    parser.add_argument('-e', '--exists', action='store_true',
+                        help='stop all servers once any of them finds a matched line')
+    parser.add_argument('-a', '--aggregate', action='store_true',
+                        help='only get the number of matched lines per value of a capture group of the pattern')
+    parser.add_argument('-g', '--group', default=None,
+                        help='name or number of the capture group to aggregate by, default is the first named one')
+    parser.add_argument('-n', '--limit', type=int, default=0,
+                        help='get at most LIMIT matched lines from each server')
+    parser.add_argument('-f', '--files', default=None,
+                        help='path glob of the log files on each server, e.g. "/var/log/app*.log*"')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='compress the results sent back by the servers')
+    parser.add_argument('--columnar', action='store_true',
+                        help='send host, port and log paths once per batch instead of once per line')
+    parser.add_argument('--since', default=None,
+                        help='only lines with a timestamp from this one on, e.g. "2018-09-10 12:00"')
+    parser.add_argument('--until', default=None,
+                        help='only lines with a timestamp up to this one, e.g. "2018-09-10 12:30:00"')
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help='keep pushing the new matched lines appended to the logs, until the deadline or Ctrl-C')
+    parser.add_argument('-o', '--output', default=None, help='write matched lines to a file instead of stdout')
+    parser.add_argument('--ordered', action='store_true',
+                        help='write matched lines ordered by host, file and line number after all hosts are done')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='overall deadline in secs, hosts which miss it are reported with partial results')
+    parser.add_argument('--host-timeout', type=float, default=None,
+                        help='max secs for a single host to answer before it is retried on a replica')
+    parser.add_argument('--hedge', type=float, default=None,
+                        help='secs after which a still running host is also queried on its replica')
+    parser.add_argument('--replica', action='append', default=[], metavar='HOST=REPLICA[,REPLICA...]',
+                        help='replica hosts serving the same logs as HOST, can be given several times')
+    parser.add_argument('-i', '--interactive', action='store_true',
+                        help='read patterns from stdin, one query per line, on persistent connections')
+    parser.add_argument('--stats', action='store_true', help='print statistics of every server')
+    args = parser.parse_args()
+    replicas = {}
+    for replica in args.replica:
+        host, _, others = replica.partition('=')
+        replicas[host] = [h for h in others.split(',') if h]
+    c = Client(replicas=replicas)
+    query_mode = QueryMode.LINES
+    if args.count:
+        query_mode = QueryMode.COUNT
+    elif args.exists:
+        query_mode = QueryMode.EXISTS
+    elif args.aggregate:
+        query_mode = QueryMode.AGGREGATE
+    options = dict(output=args.output, ordered=args.ordered,
+                   timeout=args.timeout, host_timeout=args.host_timeout, hedge=args.hedge,
+                   parallel=args.parallel, mode=query_mode, limit=args.limit, path=args.files, group=args.group,
+                   since=args.since, until=args.until, follow=args.follow,
+                   compression=supported_compressions() if args.compress else None, columnar=args.columnar)
+    if args.stats:
+        c.stats()
+    elif args.interactive:
+        c.connect()
+        if args.output:
+            options['output'] = open(args.output, 'w')  # results of every query of the session
+        try:
+            while True:
+                try:
+                    line = input('grep> ')
+                except EOFError:
+                    break
+                if line:
+                    c.query(pattern=line, **options)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            c.close()
+            if args.output:
+                options['output'].close()
+    elif args.pattern is None:
+        parser.error('the pattern is required')
     else:
-        pattern = sys.argv[1]
-        c.query(pattern=pattern)
+        c.query(pattern=args.pattern, **options)
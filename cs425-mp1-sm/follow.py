@@ -0,0 +1,76 @@
+import mmap
+import os
+
+from scanner import Scanner
+from timerange import count_lines
+
+
+# how often a followed log is checked for appended bytes, in secs
+FOLLOW_INTERVAL = 0.5
+
+# an idle follow query sends a heartbeat every this many secs, a send to a dead client fails
+HEARTBEAT_INTERVAL = 5.0
+
+# max number of follow queries served at the same time
+MAX_FOLLOWS = 16
+
+
+class LogFollower:
+    def __init__(self, path, pattern, from_end=True, index=None):
+        """
+        Follow a growing log and scan only the complete lines appended since the last poll.
+        A rotated (new inode) or truncated log is followed again from its start.
+
+        :param path: log file path
+        :param pattern: query string or Scanner
+        :param from_end: skip the lines already in the log, otherwise start from its first line
+        :param index: optional LogIndex of the log, to find the line number of its end quickly
+        """
+        self.path = path
+        self.scanner = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+        self.inode = None
+        self.offset = 0  # offset after the last complete line scanned
+        self.line_number = 1  # line number of the line starting at offset
+        if from_end:
+            self.seek_end(index)
+
+    def seek_end(self, index=None):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # an empty file can not be mapped
+                return
+            with buf:
+                self.offset = buf.rfind(b'\n') + 1
+                counted, lines = index.lines_before(self.offset) if index is not None else (0, 0)
+                self.line_number = 1 + lines + count_lines(buf, counted, self.offset)
+
+    def poll(self):
+        """
+        Scan the complete lines appended since the last poll.
+
+        :return: generator of (line_number, line) where line is bytes including its newline
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:  # rotated away, wait for the new file
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if self.inode is not None and (st.st_ino != self.inode or st.st_size < self.offset):
+                print('[INFO]: Log %s is rotated or truncated, follow it from its start.' % self.path)
+                self.offset, self.line_number = 0, 1
+            self.inode = st.st_ino
+            if st.st_size <= self.offset:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                last = buf.rfind(b'\n', self.offset, st.st_size) + 1
+                if last <= self.offset:
+                    return  # the line being written is scanned once it is complete
+                self.line_number = yield from self.scanner.scan(buf, self.offset, last, self.line_number)
+                self.offset = last
@@ -1,5 +1,27 @@
+import argparse
 import random
 import string
+import time
+from array import array
+from multiprocessing import Pool
+
+
+# characters of the random part of a line
+ALPHABET = (string.ascii_letters + string.digits).encode('ascii')
+
+# random bytes below this are mapped to the alphabet without bias, the others are dropped
+ALPHABET_LIMIT = 256 // len(ALPHABET) * len(ALPHABET)
+ALPHABET_TABLE = bytes(ALPHABET[i % len(ALPHABET)] for i in range(256))
+REJECTED_BYTES = bytes(range(ALPHABET_LIMIT, 256))
+
+# a 16-bit random number per line picks its pattern, with the same thresholds as gen_log
+RARE_LIMIT = int(0.05 * 65536) + 1
+SOMEWHAT_LIMIT = int(0.25 * 65536) + 1
+
+# lines generated and written at once by the fast generator
+BLOCK_LINES = 64 * 1024
+
+SEED = 12450
 
 
 def gen_log(filename, lines, machine):
@@ -53,7 +75,19 @@ def gen_log(filename, lines, machine):
 				count['frequent_pattern'] += 1
 
 	# Save the counts of patterns on each log file for correctness check
-	with open('count.txt', 'a') as f:
+	write_count('count.txt', machine, count)
+
+
+def write_count(count_path, machine, count):
+	"""
+	Append the counts of patterns on a log file to count.txt
+
+	:param count_path: path of count.txt
+	:param machine: the number of machine this log file belongs to
+	:param count: dict of pattern -> number of lines
+	:return: NONE
+	"""
+	with open(count_path, 'a') as f:
 		f.write('Count from machine {%02d}\n' % machine)
 		for key, value in count.items():
 			f.write(key+':'+str(value)+'\n')
@@ -71,8 +105,107 @@ def gen_random(length):
 	return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
 
 
+def rare_pattern(machine):
+	"""
+	The rare pattern of a machine, same rules as gen_log
+
+	:param machine: the number of machine
+	:return: String
+	"""
+	if machine % 2 == 0:
+		return 'only_found_on_odd'
+	if machine % 3 == 0:
+		return 'third_and_ninth'
+	if machine % 7 == 0:
+		return 'rare_pattern_on_7'
+	return 'boring_message'
+
+
+def random_chars(rng, size):
+	"""
+	Generate random letters and digits in one go: random bytes are mapped to the alphabet
+	with a translate table, and the few bytes which would bias the mapping are dropped.
+
+	:param rng: random.Random
+	:param size: number of characters
+	:return: bytes
+	"""
+	chars = b''
+	while len(chars) < size:
+		need = size - len(chars)
+		chars += rng.randbytes(need + need // 16 + 16).translate(ALPHABET_TABLE, REJECTED_BYTES)
+	return chars[:size]
+
+
+def gen_log_fast(task):
+	"""
+	Generate a log file with the same pattern distribution as gen_log, block by block:
+	the pattern of every line and all the random characters of a block are drawn at once,
+	and the block is written with a single call. The random generator is seeded per machine,
+	so a log is the same whichever process generates it.
+
+	:param task: (filename, lines, machine, seed)
+	:return: (machine, dict of pattern -> number of lines)
+	"""
+	filename, lines, machine, seed = task
+	rng = random.Random('%d-%d' % (seed, machine))
+	prefixes = [(rare_pattern(machine) + ',').encode('ascii'), b'somewhat_freq,', b'frequent_pattern,']
+	kinds = [0, 0, 0]
+	with open(filename, 'wb') as f:
+		for start in range(0, lines, BLOCK_LINES):
+			n = min(BLOCK_LINES, lines - start)
+			draws = array('H')
+			draws.frombytes(rng.randbytes(2 * n))
+			chars = random_chars(rng, 30 * n)
+			picks = [0 if d < RARE_LIMIT else 1 if d < SOMEWHAT_LIMIT else 2 for d in draws]
+			for kind in range(3):
+				kinds[kind] += picks.count(kind)
+			f.write(b''.join(prefixes[k] + chars[30 * i:30 * i + 30] + b'\n' for i, k in enumerate(picks)))
+	count = {
+		'only_found_on_odd': 0,
+		'third_and_ninth': 0,
+		'boring_message': 0,
+		'rare_pattern_on_7': 0,
+		'somewhat_freq': kinds[1],
+		'frequent_pattern': kinds[2]
+	}
+	count[rare_pattern(machine)] = kinds[0]
+	return machine, count
+
+
+def gen_logs_fast(filenames, lines, seed=SEED, processes=None, count_path='count.txt'):
+	"""
+	Generate the log files of several machines in parallel with a process pool
+
+	:param filenames: dict of machine number -> log file name
+	:param lines: number of lines of each log file
+	:param seed: base seed, each machine derives its own from it
+	:param processes: number of processes, default is the number of cores
+	:param count_path: path of count.txt, the counts are written in machine order
+	:return: dict of machine number -> dict of pattern -> number of lines
+	"""
+	tasks = [(filename, lines, machine, seed) for machine, filename in sorted(filenames.items())]
+	with Pool(processes) as p:
+		counts = dict(p.imap_unordered(gen_log_fast, tasks))
+	for machine in sorted(counts):
+		write_count(count_path, machine, counts[machine])
+	return counts
+
+
 if __name__ == '__main__':
-	random.seed(12450)
-	for i in range(1, 11):
-		logfile = 'machine.' + str(i).zfill(2) + '.log'
-		gen_log(logfile, 10000, i)
+	parser = argparse.ArgumentParser(description='Generate logs with predefined patterns.')
+	parser.add_argument('-l', '--lines', type=int, default=10000, help='number of lines of each log file')
+	parser.add_argument('-m', '--machines', type=int, default=10, help='number of machines')
+	parser.add_argument('--fast', action='store_true', help='generate the logs block by block in parallel')
+	parser.add_argument('--processes', type=int, default=None, help='number of processes of the fast generator')
+	parser.add_argument('--seed', type=int, default=SEED, help='random seed')
+	args = parser.parse_args()
+	t_start = time.time()
+	logfiles = {i: 'machine.' + str(i).zfill(2) + '.log' for i in range(1, args.machines + 1)}
+	if args.fast:
+		gen_logs_fast(logfiles, args.lines, args.seed, args.processes)
+	else:
+		random.seed(args.seed)
+		for i, logfile in sorted(logfiles.items()):
+			gen_log(logfile, args.lines, i)
+	print('Generated %d logs of %d lines, used %.4f secs.' % (args.machines, args.lines, time.time() - t_start))
@@ -0,0 +1,383 @@
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from itertools import accumulate
+
+try:
+    from re import _parser as sre_parse
+    from re._constants import LITERAL, SUBPATTERN, MAX_REPEAT, MIN_REPEAT
+except ImportError:  # python < 3.11
+    import sre_parse
+    from sre_constants import LITERAL, SUBPATTERN, MAX_REPEAT, MIN_REPEAT
+
+from scanner import Scanner
+
+
+# the indexed part of a log is cut to blocks of about this size, aligned to line ends
+BLOCK_SIZE = 64 * 1024
+
+# a block with more distinct trigrams than this (one per byte of a block, only possible with long lines
+# of random content) is not worth indexing, it is recorded as dense and always scanned
+MAX_BLOCK_TRIGRAMS = BLOCK_SIZE
+
+# the trigrams of a block are kept as a bitmap of about this many bits per distinct trigram, one bit
+# per trigram, so a trigram absent from the block is reported present with a chance of about
+# 1 - exp(-1 / BITS_PER_TRIGRAM), and a query of k trigrams only scans a block without them by that chance ** k
+BITS_PER_TRIGRAM = 4
+
+# record of a block in the .trigrams file: start, end, first line number, number of bits of its
+# trigram bitmap (a prime), followed by the bitmap bytes
+BLOCK_HEADER = struct.Struct('!QQQI')
+DENSE = 0xFFFFFFFF
+
+# format of the sidecar files, older ones are rebuilt
+INDEX_VERSION = 2
+
+# suffixes of the sidecar files next to an indexed log
+SIDECAR_SUFFIXES = ('.idx', '.idx.tmp', '.lines', '.trigrams')
+
+
+def trigram_value(trigram):
+    """
+    :param trigram: 3-byte trigram
+    :return: the trigram as an integer, as collected by block_trigrams
+    """
+    return int.from_bytes(trigram, 'little')
+
+
+def block_trigrams(data):
+    """
+    Collect the distinct trigrams of a block as integers.
+
+    :param data: bytes of a block
+    :return: set of trigram values, or None if the block is dense
+    """
+    data += b'\0'  # so the last trigram is the low 3 bytes of a word
+    trigrams = set()
+    for i in range(4):
+        # the 4-byte words at i, i + 4, ... hold the trigrams at these offsets in their low 3 bytes
+        words = array('I')
+        words.frombytes(data[i:i + (len(data) - i) // 4 * 4])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        trigrams.update(map(0xFFFFFF.__and__, words))
+    return trigrams if len(trigrams) <= MAX_BLOCK_TRIGRAMS else None
+
+
+def next_prime(n):
+    """
+    :param n: positive integer
+    :return: the smallest prime >= n
+    """
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def trigram_bitmap(trigrams):
+    """
+    :param trigrams: set of trigram values of a block
+    :return: (number of bits, bitmap bytes) where bit v % number of bits is set for every trigram value v
+    """
+    num_bits = next_prime(len(trigrams) * BITS_PER_TRIGRAM)
+    bitmap = bytearray((num_bits + 7) // 8)
+    for bit in set(map(num_bits.__rmod__, trigrams)):
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+    return num_bits, bytes(bitmap)
+
+
+def literal_runs(parsed, runs):
+    """
+    Walk a parsed regex and collect the literal strings that every match must contain.
+    Only concatenations are followed, alternations and optional parts end a run.
+
+    :param parsed: sre_parse.SubPattern or list of (op, av)
+    :param runs: output list of bytes
+    :return: None
+    """
+    run = []
+    for op, av in parsed:
+        if op is LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            runs.append(''.join(run).encode('utf-8'))
+            run = []
+        if op is SUBPATTERN and not av[1] and not av[2]:  # group without inline flags
+            literal_runs(av[-1], runs)
+        elif op in (MAX_REPEAT, MIN_REPEAT) and av[0] >= 1:
+            literal_runs(av[-1], runs)
+    if run:
+        runs.append(''.join(run).encode('utf-8'))
+
+
+def required_trigrams(pattern):
+    """
+    Trigrams that every line matching the pattern must contain.
+
+    :param pattern: query string, e.g. 'a'(raw string), 'a[a-z]b'(regex)
+    :return: set of 3-byte trigrams, empty if nothing can be required
+    """
+    scanner = Scanner(pattern)
+    if scanner.is_literal():
+        runs = [scanner.literal]
+    else:
+        try:
+            parsed = sre_parse.parse(pattern)
+        except re.error:
+            return set()
+        if parsed.state.flags & re.IGNORECASE:
+            return set()
+        runs = []
+        literal_runs(parsed, runs)
+    return {run[i:i + 3] for run in runs for i in range(len(run) - 2) if b'\n' not in run[i:i + 3]}
+
+
+class LogIndex:
+    def __init__(self, log_path):
+        """
+        A sidecar index of a log file, kept next to it and updated incrementally as the log grows:
+        - <log>.lines: start offset of every line (uint64), so line number <-> offset is a lookup
+        - <log>.trigrams: per block trigram bitmaps, a block is only scanned if all trigrams of a query are set
+        - <log>.idx: json meta data (format version, inode, indexed size, number of lines, valid .trigrams length)
+
+        Both tables are memory-mapped instead of loaded, only the block headers are kept in memory.
+        Only complete lines are indexed, the tail after the last newline is always scanned.
+
+        :param log_path: path of the log file
+        """
+        self.log_path = log_path
+        self.meta_path = log_path + '.idx'
+        self.lines_path = log_path + '.lines'
+        self.trigrams_path = log_path + '.trigrams'
+        self.lock = threading.Lock()
+        self.lines_map = None
+        self.trigrams_map = None
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.unmap()
+        self.inode = None
+        self.size = 0  # number of indexed bytes
+        self.lines = array('Q')  # start offset of each line, line n starts at lines[n - 1]
+        self.blocks = []  # (start, end, first line number) of each block
+        self.bitmaps = []  # (offset in .trigrams, number of bits) of the bitmap of each block, None if dense
+        self.trigrams_bytes = 0  # valid length of the .trigrams file
+
+    def unmap(self):
+        if self.lines_map is not None:
+            self.lines.release()
+            self.lines = array('Q')
+            self.lines_map.close()
+            self.lines_map = None
+        if self.trigrams_map is not None:
+            self.trigrams_map.close()
+            self.trigrams_map = None
+
+    def map(self, num_lines, trigrams_bytes):
+        """
+        Memory-map the valid part of the sidecar tables.
+
+        :param num_lines: number of lines in the .lines file
+        :param trigrams_bytes: valid length of the .trigrams file
+        :return: None
+        """
+        self.unmap()
+        if num_lines:
+            with open(self.lines_path, 'rb') as f:
+                self.lines_map = mmap.mmap(f.fileno(), num_lines * self.lines.itemsize, access=mmap.ACCESS_READ)
+            self.lines = memoryview(self.lines_map).cast('Q')
+        if trigrams_bytes:
+            with open(self.trigrams_path, 'rb') as f:
+                self.trigrams_map = mmap.mmap(f.fileno(), trigrams_bytes, access=mmap.ACCESS_READ)
+        self.trigrams_bytes = trigrams_bytes
+
+    def remove_files(self):
+        for path in (self.meta_path, self.lines_path, self.trigrams_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load(self):
+        """
+        Map the sidecar files if they still describe the current log, otherwise start over.
+
+        :return: None
+        """
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get('version') != INDEX_VERSION:
+                raise ValueError('index format is outdated')
+            st = os.stat(self.log_path)
+            if st.st_ino != meta['inode'] or st.st_size < meta['size']:
+                raise ValueError('log file is rotated or truncated')
+            self.map(meta['lines'], meta['trigrams_bytes'])  # ValueError if a table is shorter
+            self.read_blocks(0)
+            self.inode = meta['inode']
+            self.size = meta['size']
+        except (OSError, ValueError, KeyError, struct.error):
+            self.reset()
+            self.remove_files()
+
+    def read_blocks(self, pos):
+        """
+        Read the block headers of the mapped .trigrams file from pos on.
+
+        :param pos: offset of the first record to read
+        :return: None
+        """
+        while pos < self.trigrams_bytes:
+            start, end, first_line, num_bits = BLOCK_HEADER.unpack_from(self.trigrams_map, pos)
+            pos += BLOCK_HEADER.size
+            self.blocks.append((start, end, first_line))
+            if num_bits == DENSE:
+                self.bitmaps.append(None)
+            else:
+                self.bitmaps.append((pos, num_bits))
+                pos += (num_bits + 7) // 8
+        if pos != self.trigrams_bytes:
+            raise ValueError('trigram table is incomplete')
+
+    def update(self):
+        """
+        Index the bytes appended to the log since the last update.
+
+        :return: None
+        """
+        with self.lock:
+            st = os.stat(self.log_path)
+            if self.inode is not None and (st.st_ino != self.inode or st.st_size < self.size):
+                print('[INFO]: Log %s is rotated or truncated, rebuild its index.' % self.log_path)
+                self.reset()
+                self.remove_files()
+            self.inode = st.st_ino
+            if st.st_size <= self.size:
+                return
+            with open(self.log_path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    last = buf.rfind(b'\n', self.size) + 1  # only index complete lines
+                    if last <= self.size:
+                        return
+                    num_lines = len(self.lines)
+                    lines = array('Q')
+                    records = []
+                    start = self.size
+                    while start < last:
+                        end = buf.find(b'\n', min(start + BLOCK_SIZE, last) - 1, last) + 1
+                        data = buf[start:end]
+                        first_line = num_lines + len(lines) + 1
+                        lengths = [len(line) + 1 for line in data.split(b'\n')[:-1]]
+                        lines.extend(accumulate([start] + lengths[:-1]))
+                        trigrams = block_trigrams(data)
+                        if trigrams is None:
+                            records.append(BLOCK_HEADER.pack(start, end, first_line, DENSE))
+                        else:
+                            num_bits, bitmap = trigram_bitmap(trigrams)
+                            records.append(BLOCK_HEADER.pack(start, end, first_line, num_bits))
+                            records.append(bitmap)
+                        start = end
+            with open(self.lines_path, 'ab') as f:
+                f.seek(num_lines * lines.itemsize)
+                f.truncate()
+                lines.tofile(f)
+            with open(self.trigrams_path, 'ab') as f:
+                f.seek(self.trigrams_bytes)
+                f.truncate()
+                for record in records:
+                    f.write(record)
+                trigrams_bytes = f.tell()
+            pos = self.trigrams_bytes
+            self.map(num_lines + len(lines), trigrams_bytes)
+            self.read_blocks(pos)
+            self.size = last
+            meta = {
+                'version': INDEX_VERSION,
+                'inode': self.inode,
+                'size': self.size,
+                'lines': len(self.lines),
+                'trigrams_bytes': self.trigrams_bytes,
+            }
+            with open(self.meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def line_offset(self, line_number):
+        """
+        :param line_number: 1-based line number of an indexed line
+        :return: byte offset where the line starts
+        """
+        with self.lock:
+            return self.lines[line_number - 1]
+
+    def line_number(self, offset):
+        """
+        :param offset: byte offset inside the indexed part of the log
+        :return: 1-based line number of the line containing offset
+        """
+        with self.lock:
+            return bisect.bisect_right(self.lines, offset)
+
+    def lines_before(self, offset):
+        """
+        :param offset: byte offset of a line start
+        :return: (o, n) where o is the offset up to which the index knows the lines, min(offset, indexed size),
+                 and n is the number of lines before o
+        """
+        with self.lock:
+            covered = min(offset, self.size)
+            return covered, bisect.bisect_left(self.lines, covered) if covered < self.size else len(self.lines)
+
+    def candidate_ranges(self, trigrams):
+        """
+        Byte ranges of the indexed blocks which may contain all the trigrams.
+        Adjacent candidate blocks are merged into one range.
+
+        :param trigrams: set of required trigrams
+        :return: ([(start, end, first line number), ...], indexed size, number of indexed lines)
+        """
+        values = [trigram_value(t) for t in trigrams]
+        with self.lock:
+            buf = self.trigrams_map
+            ranges = []
+            for (start, end, first_line), bitmap in zip(self.blocks, self.bitmaps):
+                if bitmap is not None:
+                    pos, num_bits = bitmap
+                    bits = [v % num_bits for v in values]
+                    if not all(buf[pos + (bit >> 3)] >> (bit & 7) & 1 for bit in bits):
+                        continue
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1][1] = end
+                else:
+                    ranges.append([start, end, first_line])
+            return [tuple(r) for r in ranges], self.size, len(self.lines)
+
+    def scan(self, pattern, cancelled=None):
+        """
+        Bring the index up to date, then scan only the candidate blocks and the unindexed tail.
+
+        :param pattern: query string or Scanner
+        :param cancelled: optional callable, the scan stops once it returns True
+        :return: generator of (line_number, line) where line is bytes including its newline
+        """
+        self.update()
+        scanner = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+        ranges, indexed_size, indexed_lines = self.candidate_ranges(required_trigrams(scanner.pattern))
+        with open(self.log_path, 'rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # an empty file can not be mapped
+                return
+            with buf:
+                ranges.append((indexed_size, len(buf), indexed_lines + 1))
+                for start, end, first_line in ranges:
+                    if cancelled is not None and cancelled():
+                        return
+                    yield from scanner.scan(buf, start, end, first_line)
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import deque
+
+
+# upper bounds of the histogram buckets in secs, each twice the one before, from 1 ms to about 65 secs
+BUCKETS = [0.001 * 2 ** i for i in range(17)]
+
+# the histogram only covers the last WINDOW_SLOTS slots of SLOT_SECS secs each
+SLOT_SECS = 60
+WINDOW_SLOTS = 10
+
+# number of recent queries kept with all their numbers
+RECENT_QUERIES = 20
+
+# phases of a query, timed separately
+PHASES = ('scan', 'serialize', 'send')
+
+
+class Histogram:
+    def __init__(self):
+        """
+        A rolling histogram of durations over the last WINDOW_SLOTS * SLOT_SECS secs.
+        Durations are counted in buckets with exponential bounds, per time slot, and the slots
+        which fall out of the window are dropped.
+        """
+        self.slots = deque()  # (slot number, [count per bucket]), oldest first
+
+    def add(self, secs, now=None):
+        slot = int((now or time.time()) // SLOT_SECS)
+        if not self.slots or self.slots[-1][0] != slot:
+            self.slots.append((slot, [0] * (len(BUCKETS) + 1)))
+        bucket = next((i for i, bound in enumerate(BUCKETS) if secs <= bound), len(BUCKETS))
+        self.slots[-1][1][bucket] += 1
+
+    def counts(self, now=None):
+        """
+        :return: count per bucket over the window, the last one counts durations above every bound
+        """
+        oldest = int((now or time.time()) // SLOT_SECS) - WINDOW_SLOTS + 1
+        while self.slots and self.slots[0][0] < oldest:
+            self.slots.popleft()
+        counts = [0] * (len(BUCKETS) + 1)
+        for _, slot_counts in self.slots:
+            for i, cnt in enumerate(slot_counts):
+                counts[i] += cnt
+        return counts
+
+    def percentile(self, counts, p):
+        """
+        :param counts: count per bucket
+        :param p: percentile, e.g. 99
+        :return: upper bound of the bucket of the percentile in secs, None if there is nothing to count
+        """
+        total = sum(counts)
+        if not total:
+            return None
+        rank = total * p / 100.0
+        seen = 0
+        for i, cnt in enumerate(counts):
+            seen += cnt
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+    def stats(self):
+        counts = self.counts()
+        return {
+            'count': sum(counts),
+            'p50': self.percentile(counts, 50),
+            'p90': self.percentile(counts, 90),
+            'p99': self.percentile(counts, 99),
+            'buckets': {'<=%gs' % bound: cnt for bound, cnt in zip(BUCKETS, counts) if cnt},
+        }
+
+
+class QueryTimer:
+    def __init__(self, pattern, mode):
+        """
+        Numbers of a single query: time spent in each phase (summed over the threads scanning
+        its files, so the phases may add up to more than the query took), and its throughput.
+
+        With memory-mapped logs, reading is page faults in the middle of matching,
+        so reading and matching are timed together as the scan phase.
+
+        :param pattern: query string
+        :param mode: query mode
+        """
+        self.pattern = pattern
+        self.mode = mode
+        self.start = time.time()
+        self.secs = 0.0
+        self.phases = {phase: 0.0 for phase in PHASES}
+        self.bytes_scanned = 0
+        self.lines_scanned = 0
+        self.matches = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()  # file workers add their numbers at the same time
+
+    def add(self, phase, secs):
+        with self.lock:
+            self.phases[phase] += secs
+
+    def add_scanned(self, nbytes, lines):
+        with self.lock:
+            self.bytes_scanned += nbytes
+            self.lines_scanned += lines
+
+    def finish(self):
+        self.secs = time.time() - self.start
+
+    def stats(self):
+        secs = max(self.secs, 1e-9)
+        d = {
+            'pattern': self.pattern,
+            'mode': self.mode,
+            'secs': self.secs,
+            'bytes_scanned': self.bytes_scanned,
+            'lines_scanned': self.lines_scanned,
+            'matches': self.matches,
+            'bytes_sent': self.bytes_sent,
+            'mb_per_sec': self.bytes_scanned / secs / 1024 / 1024,
+            'lines_per_sec': self.lines_scanned / secs,
+        }
+        d.update(self.phases)
+        return d
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Metrics of all the queries served: totals, rolling histograms of the query time and of
+        each phase, and the numbers of the most recent queries.
+        """
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.bytes_scanned = 0
+        self.lines_scanned = 0
+        self.matches = 0
+        self.bytes_sent = 0
+        self.histograms = {name: Histogram() for name in ('query',) + PHASES}
+        self.recent = deque(maxlen=RECENT_QUERIES)
+
+    def record(self, timer):
+        """
+        :param timer: QueryTimer of a finished query
+        :return: None
+        """
+        with self.lock:
+            self.queries += 1
+            self.bytes_scanned += timer.bytes_scanned
+            self.lines_scanned += timer.lines_scanned
+            self.matches += timer.matches
+            self.bytes_sent += timer.bytes_sent
+            self.histograms['query'].add(timer.secs)
+            for phase in PHASES:
+                self.histograms[phase].add(timer.phases[phase])
+            self.recent.append(timer.stats())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queries': self.queries,
+                'bytes_scanned': self.bytes_scanned,
+                'lines_scanned': self.lines_scanned,
+                'matches': self.matches,
+                'bytes_sent': self.bytes_sent,
+                'histograms': {name: h.stats() for name, h in self.histograms.items()},
+                'recent': list(self.recent),
+            }
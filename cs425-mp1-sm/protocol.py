@@ -0,0 +1,287 @@
+import json
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:  # lz4 compression is only offered with the lz4 package
+    lz4 = None
+
+
+# every frame on the wire is a 4-byte big-endian payload length followed by a utf-8 json payload
+HEADER = struct.Struct('!I')
+
+# a compressed frame has this bit set in its length, and its payload starts with a 1-byte codec id
+COMPRESSED_FLAG = 0x80000000
+
+# zlib level of compressed frames, low levels already shrink repetitive log lines a lot
+ZLIB_LEVEL = 1
+
+# the server flushes a batch of matched lines once either limit is reached
+BATCH_LINES = 1000
+BATCH_BYTES = 64 * 1024
+
+
+class MessageType:
+    QUERY = 'query'
+    BATCH = 'batch'
+    END = 'end'
+    ERROR = 'error'
+    STATS = 'stats'
+    SESSION = 'session'  # turn the connection into a persistent session
+    CANCEL = 'cancel'  # cancel a query in flight on a session
+    HEARTBEAT = 'heartbeat'  # sent by an idle follow query, so a dead client is noticed
+
+
+class QueryMode:
+    LINES = 'lines'  # return every matched line
+    COUNT = 'count'  # return only the number of matched lines per file
+    EXISTS = 'exists'  # stop at the first matched line
+    AGGREGATE = 'aggregate'  # return only the number of matched lines per value of a capture group
+
+
+class Compression:
+    NONE = 'none'
+    ZLIB = 'zlib'
+    LZ4 = 'lz4'
+
+    # codec id written in front of a compressed payload
+    IDS = {ZLIB: 1, LZ4: 2}
+    NAMES = {1: ZLIB, 2: LZ4}
+
+
+def supported_compressions():
+    """
+    :return: list of compression names this side can use, preferred first
+    """
+    if lz4 is not None:
+        return [Compression.LZ4, Compression.ZLIB]
+    return [Compression.ZLIB]
+
+
+def negotiate_compression(offered):
+    """
+    Pick the first compression offered by the client which is also supported here.
+
+    :param offered: list of compression names, preferred first
+    :return: compression name, Compression.NONE if nothing matches
+    """
+    supported = supported_compressions()
+    for name in offered or []:
+        if name in supported:
+            return name
+    return Compression.NONE
+
+
+def compress(payload, compression):
+    if compression == Compression.ZLIB:
+        return zlib.compress(payload, ZLIB_LEVEL)
+    return lz4.frame.compress(payload)
+
+
+def decompress(payload, codec_id):
+    compression = Compression.NAMES.get(codec_id)
+    if compression == Compression.ZLIB:
+        return zlib.decompress(payload)
+    if compression == Compression.LZ4 and lz4 is not None:
+        return lz4.frame.decompress(payload)
+    raise ValueError('unsupported compression id %d' % codec_id)
+
+
+def make_batch(host, port, matches, columnar=False):
+    """
+    Build a batch frame of matched lines.
+
+    In columnar form, host and port are sent once per batch, log paths once per distinct path,
+    and the line numbers and contents as parallel lists, instead of repeating every field per line.
+
+    :param host: server host
+    :param port: server port
+    :param matches: [(log_path, line_number, content), ...]
+    :param columnar: use the columnar form
+    :return: batch message
+    """
+    if not columnar:
+        return {
+            'type': MessageType.BATCH,
+            'matches': [{
+                'log_path': log_path,
+                'host': host,
+                'port': str(port),
+                'line_number': line_number,
+                'content': content,
+            } for log_path, line_number, content in matches],
+        }
+    paths = {}  # log path -> its id in the batch
+    for log_path, _, _ in matches:
+        paths.setdefault(log_path, len(paths))
+    return {
+        'type': MessageType.BATCH,
+        'host': host,
+        'port': str(port),
+        'paths': list(paths),
+        'path_ids': [paths[log_path] for log_path, _, _ in matches],
+        'line_numbers': [line_number for _, line_number, _ in matches],
+        'contents': [content for _, _, content in matches],
+    }
+
+
+def batch_matches(msg):
+    """
+    Expand a batch frame of either form to a list of matched results.
+
+    :param msg: batch message
+    :return: [{'log_path': ..., 'host': ..., 'port': ..., 'line_number': ..., 'content': ...}, ...]
+    """
+    if 'matches' in msg:
+        return msg['matches']
+    host, port, paths = msg['host'], msg['port'], msg['paths']
+    return [{
+        'log_path': paths[path_id],
+        'host': host,
+        'port': port,
+        'line_number': line_number,
+        'content': content,
+    } for path_id, line_number, content in zip(msg['path_ids'], msg['line_numbers'], msg['contents'])]
+
+
+def encode_frame(msg, compression=Compression.NONE):
+    """
+    Encode a message to a length-prefixed frame.
+
+    :param msg: json serializable dict
+    :param compression: compression negotiated for this connection
+    :return: bytes of the frame
+    """
+    payload = json.dumps(msg).encode('utf-8')
+    if compression != Compression.NONE:
+        payload = bytes([Compression.IDS[compression]]) + compress(payload, compression)
+        return HEADER.pack(len(payload) | COMPRESSED_FLAG) + payload
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_msg(conn, msg, compression=Compression.NONE):
+    """
+    Send a single length-prefixed frame.
+
+    :param conn: connected TCP socket
+    :param msg: json serializable dict
+    :param compression: compression negotiated for this connection
+    :return: number of bytes sent
+    """
+    frame = encode_frame(msg, compression)
+    conn.sendall(frame)
+    return len(frame)
+
+
+def recv_exactly(conn, size):
+    """
+    Receive exactly size bytes from the socket.
+
+    :param conn: connected TCP socket
+    :param size: number of bytes to receive
+    :return: bytes, or None if the peer closed the connection before sending all of them
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = conn.recv_into(view[received:], size - received)
+        if not n:
+            return None
+        received += n
+    return bytes(buf)
+
+
+def recv_frame(conn):
+    """
+    Receive a single length-prefixed frame, compressed or not.
+
+    :param conn: connected TCP socket
+    :return: (decoded dict, number of bytes received), or (None, 0) on EOF
+    """
+    header = recv_exactly(conn, HEADER.size)
+    if header is None:
+        return None, 0
+    length = HEADER.unpack(header)[0]
+    payload = recv_exactly(conn, length & ~COMPRESSED_FLAG)
+    if payload is None:
+        return None, 0
+    nbytes = len(header) + len(payload)
+    if length & COMPRESSED_FLAG:
+        payload = decompress(payload[1:], payload[0])
+    return json.loads(payload.decode('utf-8')), nbytes
+
+
+def recv_msg(conn):
+    """
+    Receive a single length-prefixed frame.
+
+    :param conn: connected TCP socket
+    :return: decoded dict, or None on EOF
+    """
+    return recv_frame(conn)[0]
+
+
+def peer_closed(conn):
+    """
+    Check without blocking whether the peer has closed (or reset) the connection.
+
+    :param conn: connected TCP socket
+    :return: True if the connection is gone
+    """
+    try:
+        readable, _, _ = select.select([conn], [], [], 0)
+        if not readable:
+            return False
+        return not conn.recv(1, socket.MSG_PEEK)
+    except (OSError, ValueError):
+        return True
+
+
+class Channel:
+    def __init__(self, conn, request_id=None, lock=None, cancelled=None, timer=None):
+        """
+        Where the replies of a single request go.
+
+        On a plain connection, there is one request and its replies are sent as they are.
+        On a session, several requests are in flight on the same connection, so every reply is
+        tagged with the request id, and frames of different requests are sent under a shared lock.
+
+        :param conn: connected TCP socket
+        :param request_id: id of the request on a session, None on a plain connection
+        :param lock: lock shared by the requests of a session
+        :param cancelled: optional callable, returns True once the request is cancelled or the session is gone
+        :param timer: optional QueryTimer (see metrics.py) which records the serialize and send time
+        """
+        self.conn = conn
+        self.request_id = request_id
+        self.lock = lock or threading.Lock()
+        self.cancelled = cancelled
+        self.timer = timer
+
+    def send(self, msg, compression=Compression.NONE):
+        if self.request_id is not None:
+            msg['id'] = self.request_id
+        t_start = time.perf_counter()
+        frame = encode_frame(msg, compression)
+        t_encoded = time.perf_counter()
+        with self.lock:
+            self.conn.sendall(frame)
+        if self.timer is not None:
+            self.timer.add('serialize', t_encoded - t_start)
+            self.timer.add('send', time.perf_counter() - t_encoded)
+            self.timer.bytes_sent += len(frame)
+        return len(frame)
+
+    def closed(self):
+        """
+        :return: True if nobody waits for the replies any more
+        """
+        if self.cancelled is not None:
+            return self.cancelled()
+        return peer_closed(self.conn)
@@ -0,0 +1,376 @@
+import gzip
+import io
+import mmap
+import os
+import re
+import sys
+import time
+from collections import deque
+from multiprocessing import Pool
+
+try:
+    import zstandard
+except ImportError:  # .zst logs are only supported with the zstandard package
+    zstandard = None
+
+
+# a file is split to chunks of about this size for parallel scanning
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# seconds between checks of the cancelled flag while waiting for a chunk of a parallel scan
+CANCEL_CHECK_INTERVAL = 0.1
+
+# a scan locates the matches of a pattern in windows of about this size, aligned to line ends
+SCAN_WINDOW = 1024 * 1024
+
+# a window is scanned line by line if at least this share of the lines of the previous window matched
+DENSE_MATCH_RATIO = 0.1
+
+# compressed logs are decompressed and scanned in blocks of about this size
+STREAM_BLOCK_SIZE = 4 * 1024 * 1024
+
+# any of these characters makes a pattern a regex, otherwise it is matched as a plain substring
+REGEX_META_CHARS = set('.^$*+?{}[]\\|()\n')
+
+
+class Scanner:
+    def __init__(self, pattern):
+        """
+        Compile a query pattern once for scanning large byte buffers.
+
+        :param pattern: query string, e.g. 'a'(raw string), 'a[a-z]b'(regex)
+        """
+        self.pattern = pattern
+        self.scanned_bytes = 0  # bytes of the finished scans
+        self.scanned_lines = 0  # lines of the finished scans
+        if any(ch in REGEX_META_CHARS for ch in pattern):
+            self.literal = None
+            # MULTILINE keeps '^' and '$' anchored to line boundaries inside a block
+            self.regex = re.compile(pattern.encode('utf-8'), re.MULTILINE)
+            # an empty match after the final newline of a line (e.g. of '^$') is not a match of the line,
+            # scan_lines can not tell it apart, so such a pattern is always scanned by scan_hits
+            self.line_by_line = self.regex.search(b'\n', 1) is None
+        else:
+            self.literal = pattern.encode('utf-8')
+            self.regex = None
+            self.line_by_line = True
+
+    def is_literal(self):
+        return self.literal is not None
+
+    def group_key(self, group=None):
+        """
+        Key function of an aggregate query, which groups the matched lines by a capture group.
+
+        :param group: name or number of a capture group, default is the first named group, or group 1
+        :return: callable mapping a matched line to the bytes of the group, None if the group does not take part
+        """
+        if self.regex is None or not self.regex.groups:
+            raise ValueError('an aggregate query needs a regex with a capture group, e.g. "(?P<key>^[a-z_]+),"')
+        groups = self.regex.groupindex
+        if group is None:
+            group = min(groups.values()) if groups else 1
+        elif isinstance(group, str) and group.isdigit():
+            group = int(group)
+        if group not in groups and not (isinstance(group, int) and 0 <= group <= self.regex.groups):
+            raise ValueError('no such capture group: %s' % group)
+        regex = self.regex
+
+        def key(line):
+            m = regex.search(line)
+            return m.group(group) if m is not None else None
+
+        return key
+
+    def scan(self, buf, start=0, end=None, first_line=1):
+        """
+        Scan a byte range window by window. A window is searched as a whole, see scan_hits, unless
+        at least DENSE_MATCH_RATIO of the lines of the previous window matched: then locating every
+        hit costs more than testing every line, and the window is scanned line by line, see scan_lines.
+        Windows grow from SCAN_WINDOW / 16 to SCAN_WINDOW, so a dense range soon switches.
+
+        :param buf: bytes-like object, e.g. bytes or mmap
+        :param start: offset of the first byte to scan, must be at a line start
+        :param end: offset after the last byte to scan, must be at a line end
+        :param first_line: line number of the line starting at start
+        :return: generator of (line_number, line) where line is bytes including its newline,
+                 its return value is the line number of the line starting at end
+        """
+        if end is None:
+            end = len(buf)
+        line_number = first_line
+        dense = False
+        window = SCAN_WINDOW // 16
+        pos = start
+        while pos < end:
+            window_end = buf.find(b'\n', min(pos + window, end) - 1, end) + 1 or end
+            if dense:
+                next_line, matches = self.scan_lines(buf, pos, window_end, line_number)
+                yield from matches
+                matched = len(matches)
+            else:
+                next_line, matched = yield from self.scan_hits(buf, pos, window_end, line_number)
+            dense = self.line_by_line and matched >= (next_line - line_number) * DENSE_MATCH_RATIO
+            line_number = next_line
+            window = min(window * 2, SCAN_WINDOW)
+            pos = window_end
+        self.scanned_bytes += end - start
+        self.scanned_lines += line_number - first_line
+        return line_number
+
+    def scan_hits(self, buf, start, end, line_number):
+        """
+        Search the whole window at once and only locate line boundaries around each match,
+        so that non-matching lines cost no python work at all.
+
+        A regex match may run across a newline (e.g. '\\s' or '[^a]'), so such a candidate
+        line is re-checked on its own to keep the same result as a line by line search.
+
+        :param buf: bytes-like object, e.g. bytes or mmap
+        :param start: offset of the first byte to scan, must be at a line start
+        :param end: offset after the last byte to scan
+        :param line_number: line number of the line starting at start
+        :return: generator of (line_number, line), its return value is
+                 (line number of the line starting at end, number of matched lines)
+        """
+        matched = 0
+        counted = start  # newlines before this offset are already counted in line_number
+        pos = start
+        while pos < end:
+            if self.literal is not None:
+                hit = buf.find(self.literal, pos, end)
+                if hit < 0:
+                    break
+                m = None
+            else:
+                m = self.regex.search(buf, pos, end)
+                if m is None:
+                    break
+                hit = m.start()
+                # an empty match after the final newline is not a line
+                if hit >= end and buf[end - 1:end] == b'\n':
+                    break
+            line_start = max(buf.rfind(b'\n', start, hit) + 1, start)
+            line_end = buf.find(b'\n', hit, end)
+            line_end = end if line_end < 0 else line_end + 1
+            if m is None or m.end() <= line_end or self.regex.search(buf, line_start, line_end):
+                line_number += buf[counted:line_start].count(b'\n')
+                yield line_number, buf[line_start:line_end]
+                matched += 1
+                line_number += 1
+                counted = line_end
+            pos = line_end
+        line_number += buf[counted:end].count(b'\n')
+        return line_number, matched
+
+    def scan_lines(self, buf, start, end, line_number):
+        """
+        Split the window to lines and test each of them, for windows where most lines match.
+
+        :param buf: bytes-like object, e.g. bytes or mmap
+        :param start: offset of the first byte to scan, must be at a line start
+        :param end: offset after the last byte to scan
+        :param line_number: line number of the line starting at start
+        :return: (line number of the line starting at end, [(line_number, line), ...])
+        """
+        data = buf[start:end]
+        # a compiled literal tests a short line faster than 'in'
+        search = (self.regex or re.compile(re.escape(self.literal))).search
+        # io.BytesIO splits at b'\n' only, keeping it
+        matches = [(n, line) for n, line in enumerate(io.BytesIO(data), line_number) if search(line)]
+        line_number += data.count(b'\n')
+        if matches and not matches[-1][1].endswith(b'\n'):
+            line_number += 1  # a last line without newline matched, as scan_hits counts it
+        return line_number, matches
+
+
+def scan_file(path, pattern, cancelled=None):
+    """
+    Memory-map a log file and scan it with a compiled pattern, block by block so that
+    a cancelled query stops within one block even if nothing matches.
+
+    :param path: log file path
+    :param pattern: query string or Scanner
+    :param cancelled: optional callable, the scan stops once it returns True
+    :return: generator of (line_number, line) where line is bytes including its newline
+    """
+    scanner = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file can not be mapped
+            return
+        with buf:
+            line_number = 1
+            for start, end in split_chunks(buf, len(buf) // CHUNK_SIZE):
+                if cancelled is not None and cancelled():
+                    return
+                line_number = yield from scanner.scan(buf, start, end, line_number)
+
+
+def is_compressed(path):
+    return path.endswith('.gz') or path.endswith('.zst')
+
+
+def open_compressed(path):
+    """
+    Open a compressed log as a stream of decompressed bytes.
+
+    :param path: path of a .gz or .zst file
+    :return: binary file object
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if zstandard is None:
+        raise RuntimeError('zstandard is not installed, can not read %s' % path)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+
+def scan_stream(f, pattern, cancelled=None):
+    """
+    Scan a stream (e.g. a decompressed log) block by block, carrying the incomplete last line
+    of a block over to the next one, so the whole file is never held in memory.
+
+    :param f: binary file object
+    :param pattern: query string or Scanner
+    :param cancelled: optional callable, the scan stops once it returns True
+    :return: generator of (line_number, line) where line is bytes including its newline
+    """
+    scanner = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+    line_number = 1
+    rest = b''  # incomplete last line of the previous block
+    while True:
+        if cancelled is not None and cancelled():
+            return
+        data = f.read(STREAM_BLOCK_SIZE)
+        if not data:
+            break
+        data = rest + data
+        last = data.rfind(b'\n') + 1
+        line_number = yield from scanner.scan(data, 0, last, line_number)
+        rest = data[last:]
+    if rest:
+        yield from scanner.scan(rest, 0, len(rest), line_number)
+
+
+def scan_path(path, pattern, cancelled=None):
+    """
+    Scan a plain or compressed log file.
+
+    :param path: log file path
+    :param pattern: query string or Scanner
+    :param cancelled: optional callable, the scan stops once it returns True
+    :return: generator of (line_number, line) where line is bytes including its newline
+    """
+    if not is_compressed(path):
+        yield from scan_file(path, pattern, cancelled)
+        return
+    with open_compressed(path) as f:
+        yield from scan_stream(f, pattern, cancelled)
+
+
+def split_chunks(buf, num_chunks, start=0, end=None):
+    """
+    Split a buffer (or a byte range of it) to byte ranges whose boundaries are aligned to line ends.
+
+    :param buf: bytes-like object, e.g. bytes or mmap
+    :param num_chunks: expected number of chunks
+    :param start: offset of the range to split, must be at a line start
+    :param end: offset after the range to split, default is the end of buf
+    :return: [(start, end), ...]
+    """
+    if end is None:
+        end = len(buf)
+    step = max((end - start) // max(num_chunks, 1), 1)
+    chunks = []
+    while start < end:
+        chunk_end = buf.find(b'\n', min(start + step, end) - 1, end)
+        chunk_end = end if chunk_end < 0 else chunk_end + 1
+        chunks.append((start, chunk_end))
+        start = chunk_end
+    return chunks
+
+
+def scan_chunk(task):
+    """
+    Worker of the process pool: scan a single chunk of a file.
+
+    :param task: (path, pattern, start, end)
+    :return: (number of newlines in the chunk, [(line_number relative to the chunk, line), ...])
+    """
+    path, pattern, start, end = task
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            matches = list(Scanner(pattern).scan(buf, start, end))
+            return buf[start:end].count(b'\n'), matches
+
+
+def scan_file_parallel(path, pattern, pool, num_workers, cancelled=None):
+    """
+    Scan a log file with a process pool. Chunk results come back in file order and
+    a prefix sum of the newline count of each chunk turns chunk-relative line numbers
+    into absolute ones.
+
+    At most num_workers chunks of a query are submitted to the pool at a time, and the next one
+    only after the first of them is done, so a cancelled query stops submitting right away and
+    leaves the pool to other queries once its running chunks finish.
+
+    :param path: log file path
+    :param pattern: query string or Scanner, a Scanner also counts the scanned bytes and lines
+    :param pool: multiprocessing.Pool
+    :param num_workers: number of processes in the pool
+    :param cancelled: optional callable, the scan stops once it returns True
+    :return: generator of (line_number, line) where line is bytes including its newline
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file can not be mapped
+            return
+        with buf:
+            num_chunks = max(num_workers, len(buf) // CHUNK_SIZE)
+            query = pattern.pattern if isinstance(pattern, Scanner) else pattern
+            tasks = deque((path, query, start, end) for start, end in split_chunks(buf, num_chunks))
+    running = deque()  # (task, AsyncResult) in file order
+    lines_before = 0  # prefix sum of newlines in previous chunks
+    while tasks or running:
+        while tasks and len(running) < num_workers:
+            task = tasks.popleft()
+            running.append((task, pool.apply_async(scan_chunk, (task,))))
+        task, result = running.popleft()
+        while not result.ready():
+            if cancelled is not None and cancelled():
+                return
+            result.wait(CANCEL_CHECK_INTERVAL)
+        if cancelled is not None and cancelled():
+            return
+        num_lines, matches = result.get()
+        for line_number, line in matches:
+            yield lines_before + line_number, line
+        lines_before += num_lines
+        if isinstance(pattern, Scanner):
+            pattern.scanned_bytes += task[3] - task[2]
+            pattern.scanned_lines += num_lines
+
+
+if __name__ == '__main__':
+    # benchmark: python3 scanner.py LOG_FILE PATTERN [NUM_WORKERS]
+    log_path, query = sys.argv[1], sys.argv[2]
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+
+    t_start = time.time()
+    cnt = 0
+    with open(log_path, 'r') as lf:
+        for l in lf:
+            if re.search(query, l):
+                cnt += 1
+    print('line by line: %d lines matched, used %.4f secs.' % (cnt, time.time() - t_start))
+
+    t_start = time.time()
+    cnt = sum(1 for _ in scan_file(log_path, query))
+    print('sequential: %d lines matched, used %.4f secs.' % (cnt, time.time() - t_start))
+
+    with Pool(workers) as p:
+        t_start = time.time()
+        cnt = sum(1 for _ in scan_file_parallel(log_path, query, p, workers))
+        print('parallel (%d workers): %d lines matched, used %.4f secs.' % (workers, cnt, time.time() - t_start))
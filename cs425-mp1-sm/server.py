@@ -1,78 +1,514 @@
 # Echo server program
 import socket
-import json
-import re
 import os
+import argparse
+import threading
+import glob
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from protocol import *
+from scanner import Scanner, scan_file, scan_file_parallel, scan_path, is_compressed
+from index import LogIndex, SIDECAR_SUFFIXES
+from cache import ResultCache, CACHE_BYTES
+from timerange import scan_file_range, filter_range
+from follow import LogFollower, FOLLOW_INTERVAL, HEARTBEAT_INTERVAL, MAX_FOLLOWS
+from metrics import Metrics, QueryTimer
 
 
 # hard code hosts' (VMs') ip and port here
 # todo: use config file instead
 HOST = socket.gethostname()
 PORT = 55558
+MAX_QUERIES = 8
+LOG_GLOB = '/home/wenhans2/*.log*'
+
+# number of log files scanned at the same time by a query
+FILE_WORKERS = 4
+
+# max number of matched lines buffered between the file workers and the sender
+RESULT_QUEUE_SIZE = 4 * BATCH_LINES
+
+
+def put_result(results, item, cancelled):
+    """
+    Put an item to the results queue, waiting for room only as long as cancelled() returns False.
+
+    :return: True if the item is put
+    """
+    while True:
+        try:
+            results.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            if cancelled():
+                return False
 
 
 class Server:
-    def __init__(self, host=HOST, port=PORT):
+    def __init__(self, host=HOST, port=PORT, workers=None, max_queries=MAX_QUERIES, log_glob=LOG_GLOB, index=False,
+                 cache_bytes=CACHE_BYTES, max_follows=MAX_FOLLOWS):
         """
         Server initialization.
-        Make sure the server has already known the .log file.
+        Make sure the server has already known the .log files.
 
         :param host: server host
         :param port: server post
+        :param workers: number of processes for parallel queries, default is the number of cores
+        :param max_queries: max number of queries served at the same time, others wait in the queue
+        :param log_glob: default path glob of the log files to query, rotated and compressed ones included
+        :param index: keep a sidecar trigram index of each log (see index.py) to skip blocks on queries
+        :param cache_bytes: memory limit of the query result cache (see cache.py), 0 to disable it
+        :param max_follows: max number of follow queries served at the same time, others are refused
         """
         self.host = host
         self.port = port
-        self.log_path = ''
-        root = '/home/wenhans2'
-        for file in os.listdir(root):
-            if file.endswith('.log'):
-                self.log_path = os.path.join(root, file)
+        self.workers = workers or os.cpu_count()
+        self.pool = None  # process pool for parallel queries, started by the first one
+        self.pool_lock = threading.Lock()
+        self.max_queries = max_queries
+        self.log_glob = log_glob
+        self.indexes = {} if index else None  # log path -> LogIndex
+        self.index_lock = threading.Lock()
+        self.cache = ResultCache(cache_bytes) if cache_bytes > 0 else None
+        self.executor = None  # pool of threads serving queries, started by run()
+        self.max_follows = max_follows
+        self.follows = 0  # number of follow queries being served, each in its own thread
+        self.follow_lock = threading.Lock()
+        self.metrics = Metrics()
+
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            return self.pool
+
+    def get_index(self, log_path):
+        with self.index_lock:
+            if log_path not in self.indexes:
+                self.indexes[log_path] = LogIndex(log_path)
+            return self.indexes[log_path]
+
+    def get_log_paths(self, log_glob=None):
+        """
+        :param log_glob: path glob from the query, default is the glob of the server
+        :return: sorted paths of the matched log files, sidecar index files excluded
+        """
+        paths = glob.glob(os.path.expanduser(log_glob or self.log_glob))
+        return sorted(p for p in paths if os.path.isfile(p) and not p.endswith(SIDECAR_SUFFIXES))
+
+    def scan(self, log_path, pattern, parallel=False, cancelled=None, since=None, until=None):
+        """
+        Scan a log file for every matched line together with its line number.
+        The pattern is compiled once and run over the memory-mapped file (see scanner.py).
+        Results of recent queries are cached, so a repeated query only scans what was appended.
+        An index limits the scan, or the scan of what was appended, to the blocks which may contain
+        the pattern.
+        Compressed logs are decompressed and scanned block by block.
+        With a time range, only the part of the log inside it is scanned (see timerange.py).
+
+        Only one of these applies, in this order: a time range (with the index for the line numbers),
+        decompression, a parallel scan, the cache (with the index), the index. So a parallel query
+        neither reads nor fills the cache and scans all blocks, and 'parallel' is ignored with a time range.
+
+        :param log_path: log file path
+        :param pattern: query string or Scanner, a Scanner also counts the scanned bytes and lines
+        :param parallel: split the file to chunks and scan them with a process pool, see above for what it skips
+        :param cancelled: optional callable, the scan stops once it returns True
+        :param since: only scan lines with a timestamp from this one on, e.g. '2018-09-10 12:00'
+        :param until: only scan lines with a timestamp up to this one
+        :return: generator of (line_number, line) where line is bytes including its newline
+        """
+        pattern = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+        if since or until:
+            if is_compressed(log_path):
+                return filter_range(scan_path(log_path, pattern, cancelled), since, until)
+            index = self.get_index(log_path) if self.indexes is not None else None
+            return scan_file_range(log_path, pattern, since, until, cancelled, index)
+        if is_compressed(log_path):
+            return scan_path(log_path, pattern, cancelled)
+        if parallel:
+            return scan_file_parallel(log_path, pattern, self.get_pool(), self.workers, cancelled)
+        index = self.get_index(log_path) if self.indexes is not None else None
+        if self.cache is not None:
+            return self.cache.scan(log_path, pattern, cancelled, index)
+        if index is not None:
+            return index.scan(pattern, cancelled)
+        return scan_file(log_path, pattern, cancelled)
+
+    def produce(self, results, log_path, pattern, parallel, cancelled, since=None, until=None, timer=None,
+                abandoned=None):
+        """
+        Scan a log file in a worker thread and put (log_path, line_number, line) of every matched line
+        to the results queue, followed by (log_path, None, error or None) once the file is done.
+        The time spent scanning and the scanned bytes and lines are added to the timer.
+        A cancelled query stops putting matched lines, and once the results are abandoned (nobody
+        takes them any more, e.g. the reply failed) the worker does not wait to put anything.
+
+        :return: None
+        """
+        error = None
+        scanner = None
+        scan_secs = 0.0
+        try:
+            scanner = Scanner(pattern)
+            matches = self.scan(log_path, scanner, parallel=parallel, cancelled=cancelled, since=since, until=until)
+            try:
+                while True:
+                    t_start = time.perf_counter()
+                    try:
+                        line_number, line = next(matches)
+                    except StopIteration:
+                        break
+                    finally:
+                        scan_secs += time.perf_counter() - t_start
+                    if not put_result(results, (log_path, line_number, line), cancelled):
+                        return
+            finally:
+                matches.close()
+        except Exception as e:
+            error = e.__str__()
+        finally:
+            if timer is not None and scanner is not None:
+                timer.add('scan', scan_secs)
+                timer.add_scanned(scanner.scanned_bytes, scanner.scanned_lines)
+            put_result(results, (log_path, None, error), abandoned or (lambda: False))
+
+    def handle(self, channel, msg):
+        """
+        Serve a single request, either a query or a stats request.
+
+        :param channel: Channel to reply to
+        :param msg: request message
+        :return: None
+        """
+        if msg.get('type') == MessageType.STATS:
+            channel.send({'type': MessageType.STATS, 'host': self.host, 'stats': self.stats()})
+        else:
+            self.query(channel, msg)
+
+    def handle_safely(self, channel, msg):
+        """
+        Serve a single request and report its failure to the client instead of raising.
+
+        :param channel: Channel to reply to
+        :param msg: request message
+        :return: None
+        """
+        try:
+            self.handle(channel, msg)
+        except Exception as e:
+            print('[ERROR]:', e.__str__())
+            try:
+                channel.send({'type': MessageType.ERROR, 'info': e.__str__()})
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        :return: dict of server statistics
+        """
+        return {
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'follows': self.follows,
+            'queries': self.metrics.stats(),
+        }
+
+    def query(self, channel, msg):
+        """
+        Serve a single query. The log files matched by the path glob are scanned concurrently,
+        and matched lines, tagged with their file, are streamed back in length-prefixed batches
+        as soon as a batch is full, followed by an END frame with the number of matched lines per file.
+        The query is cancelled once the client disconnects.
+
+        Query modes:
+        - lines: return every matched line, or only the first 'limit' ones if limit is given
+        - count: return only the number of matched lines
+        - exists: stop at the first matched line
+        - aggregate: return only the number of matched lines per value of the capture group 'group'
+          of the pattern (see Scanner.group_key), so the reply grows with the distinct values, not the lines
+
+        With 'since' and/or 'until', only lines whose timestamp is inside the time range are returned.
+        With 'follow', see follow().
+
+        If the client offers compressions, every reply frame is compressed with the first one
+        supported here, and 'columnar' batches send host, port and log paths once per batch.
+
+        :param channel: Channel to reply to
+        :param msg: query message
+        :return: None
+        """
+        if msg.get('follow'):
+            self.follow(channel, msg)
+            return
+        t_start = time.time()
+        pattern = msg['pattern']
+        parallel = msg.get('parallel', False)
+        mode = msg.get('mode', QueryMode.LINES)
+        timer = QueryTimer(pattern, mode)
+        channel.timer = timer
+        limit = 1 if mode == QueryMode.EXISTS else msg.get('limit') or 0
+        log_paths = self.get_log_paths(msg.get('path'))
+        since, until = msg.get('since'), msg.get('until')
+        key = Scanner(pattern).group_key(msg.get('group')) if mode == QueryMode.AGGREGATE else None
+        groups = {}  # value of the capture group -> number of matched lines
+        stopped = threading.Event()  # set once the query has enough results
+        abandoned = threading.Event()  # set once the results queue is not read any more
+        cancelled = lambda: stopped.is_set() or channel.closed()
+        results = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+        compression = negotiate_compression(msg.get('compression'))
+        columnar = msg.get('columnar', False)
+        counts = {log_path: 0 for log_path in log_paths}  # number of matched lines per file
+        errors = {}
+        cnt = 0  # total number of matched lines
+        batch = []  # matched results not sent yet
+        size = 0  # payload size of current batch
+        with ThreadPoolExecutor(max_workers=FILE_WORKERS) as executor:
+            for log_path in log_paths:
+                executor.submit(self.produce, results, log_path, pattern, parallel, cancelled, since, until, timer,
+                                abandoned.is_set)
+            done = 0
+            try:
+                while done < len(log_paths):
+                    log_path, line_number, line = results.get()
+                    if line_number is None:
+                        done += 1
+                        if line is not None:
+                            errors[log_path] = line
+                        continue
+                    if stopped.is_set():
+                        continue  # drain the queue until every worker is done
+                    cnt += 1
+                    counts[log_path] += 1
+                    if key is not None:
+                        value = key(line)
+                        if value is not None:
+                            value = value.decode('utf-8', 'replace')
+                            groups[value] = groups.get(value, 0) + 1
+                    elif mode != QueryMode.COUNT:
+                        content = line.decode('utf-8', 'replace')
+                        batch.append((log_path, line_number, content))
+                        size += len(content)
+                        if len(batch) >= BATCH_LINES or size >= BATCH_BYTES:
+                            channel.send(make_batch(self.host, self.port, batch, columnar), compression)
+                            batch = []
+                            size = 0
+                    if limit and cnt >= limit:
+                        stopped.set()
+            except BaseException:
+                # e.g. the client is gone: let the workers give up instead of waiting for room in the queue
+                stopped.set()
+                abandoned.set()
+                while not results.empty():
+                    results.get_nowait()
+                raise
+        if channel.closed():
+            print('[INFO]: Query %s is cancelled by the client.' % pattern)
+            timer.matches = cnt
+            timer.finish()
+            self.metrics.record(timer)
+            return
+        if batch:
+            channel.send(make_batch(self.host, self.port, batch, columnar), compression)
+        timer.matches = cnt
+        timer.finish()
+        self.metrics.record(timer)
+        end = {'type': MessageType.END, 'counts': counts, 'errors': errors, 'secs': time.time() - t_start,
+               'timings': timer.stats()}
+        if key is not None:
+            end['groups'] = groups
+        channel.send(end, compression)
+
+    def follow(self, channel, msg):
+        """
+        Serve a follow query: keep watching the log files matched by the path glob, and push the
+        lines appended to them which match the pattern, as batches every FOLLOW_INTERVAL secs,
+        until the client disconnects or cancels. Lines already in the logs are not returned,
+        log files created later (e.g. after a rotation) are followed from their first line.
+        A heartbeat is sent after HEARTBEAT_INTERVAL secs without any batch, so a client which is
+        gone without closing the connection is noticed.
+
+        :param channel: Channel to reply to
+        :param msg: query message
+        :return: None
+        """
+        pattern = msg['pattern']
+        scanner = Scanner(pattern)
+        compression = negotiate_compression(msg.get('compression'))
+        columnar = msg.get('columnar', False)
+        followers = {}  # log path -> LogFollower
+        first = True
+        last_sent = time.monotonic()
+        while not channel.closed():
+            for log_path in self.get_log_paths(msg.get('path')):
+                if log_path not in followers and not is_compressed(log_path):
+                    index = self.get_index(log_path) if self.indexes is not None else None
+                    followers[log_path] = LogFollower(log_path, scanner, from_end=first, index=index)
+            first = False
+            batch = []
+            size = 0
+            for log_path, follower in followers.items():
+                for line_number, line in follower.poll():
+                    content = line.decode('utf-8', 'replace')
+                    batch.append((log_path, line_number, content))
+                    size += len(content)
+                    if len(batch) >= BATCH_LINES or size >= BATCH_BYTES:
+                        channel.send(make_batch(self.host, self.port, batch, columnar), compression)
+                        batch = []
+                        size = 0
+            if batch:
+                channel.send(make_batch(self.host, self.port, batch, columnar), compression)
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                channel.send({'type': MessageType.HEARTBEAT})  # raises once the client is gone
+                last_sent = time.monotonic()
+            time.sleep(FOLLOW_INTERVAL)
+        print('[INFO]: Follow of %s is stopped by the client.' % pattern)
+
+    def spawn_follow(self, channel, msg, done):
+        """
+        Serve a follow query in its own thread: it lasts as long as the client, so it must not hold
+        a worker of the query pool. At most max_follows of them run at the same time, more are
+        refused with an error.
+
+        :param channel: Channel to reply to
+        :param msg: follow query message
+        :param done: callable run once the follow query is over, e.g. to close its connection
+        :return: None
+        """
+        with self.follow_lock:
+            refused = self.follows >= self.max_follows
+            if not refused:
+                self.follows += 1
+        if refused:
+            print('[ERROR]: Too many follow queries, refuse %s.' % msg['pattern'])
+            try:
+                info = 'too many follow queries (max %d)' % self.max_follows
+                channel.send({'type': MessageType.ERROR, 'info': info})
+            except OSError:
+                pass
+            done()
+            return
+
+        def run():
+            try:
+                self.handle_safely(channel, msg)
+            finally:
+                with self.follow_lock:
+                    self.follows -= 1
+                done()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def serve(self, conn, addr):
+        """
+        Serve a connection in a worker thread and close it afterwards.
+        A session connection, or a follow query, is handed over to its own thread instead,
+        see session() and spawn_follow().
+
+        :param conn: connected TCP socket
+        :param addr: client address
+        :return: None
+        """
+        print('[INFO]: Connected by', addr)
+        try:
+            msg = recv_msg(conn)
+        except (OSError, ValueError) as e:
+            print('[ERROR]:', e.__str__())
+            conn.close()
+            return
+        if msg and msg.get('type') == MessageType.SESSION:
+            # a session lives as long as the client, keep it out of the query pool
+            threading.Thread(target=self.session, args=(conn, addr), daemon=True).start()
+            return
+        if msg and msg.get('follow'):
+            self.spawn_follow(Channel(conn), msg, conn.close)
+            return
+        with conn:
+            if msg:
+                self.handle_safely(Channel(conn), msg)
+
+    def session(self, conn, addr):
+        """
+        Serve a persistent session: read requests tagged with ids until the client disconnects,
+        and run each of them in the query pool (a follow query in its own thread), so several
+        queries can be in flight on the same connection. A CANCEL request stops the query with the same id.
+
+        :param conn: connected TCP socket
+        :param addr: client address
+        :return: None
+        """
+        lock = threading.Lock()  # one frame at a time on the connection
+        closed = threading.Event()  # set once the client is gone
+        in_flight = {}  # request id -> stopped event of the query
+        with conn:
+            try:
+                send_msg(conn, {'type': MessageType.SESSION})
+                while True:
+                    msg = recv_msg(conn)
+                    if not msg:
+                        break
+                    request_id = msg.get('id')
+                    if msg.get('type') == MessageType.CANCEL:
+                        if request_id in in_flight:
+                            in_flight[request_id].set()
+                        continue
+                    stopped = threading.Event()
+                    in_flight[request_id] = stopped
+                    cancelled = lambda stopped=stopped: closed.is_set() or stopped.is_set()
+                    channel = Channel(conn, request_id, lock, cancelled)
+                    done = lambda request_id=request_id: in_flight.pop(request_id, None)
+                    if msg.get('follow'):
+                        self.spawn_follow(channel, msg, done)
+                        continue
+                    future = self.executor.submit(self.handle_safely, channel, msg)
+                    future.add_done_callback(lambda _, done=done: done())
+            except (OSError, ValueError) as e:
+                print('[ERROR]:', e.__str__())
+            finally:
+                closed.set()
+                print('[INFO]: Session of', addr, 'is closed.')
 
     def run(self):
         """
         Run a server, to receive the query pattern from clients and return log data.
+        Each connection is served by a thread pool, so a slow query does not block the others.
 
         :return: None
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, \
+                ThreadPoolExecutor(max_workers=self.max_queries) as executor:
+            self.executor = executor
             s.bind((self.host, self.port))
-            s.listen(1)
+            s.listen(socket.SOMAXCONN)
+            if self.indexes is not None:
+                for log_path in self.get_log_paths():
+                    if not is_compressed(log_path):
+                        print('[INFO]: Updating index of %s ...' % log_path)
+                        self.get_index(log_path).update()
+            print('[INFO]: Waiting for connection ...')
             while True:
-                print('[INFO]: Waiting for connection ...')
                 conn, addr = s.accept()
-                with conn:
-                    print('[INFO]: Connected by', addr)
-
-                    # receive the pattern and process data
-                    try:
-                        data = conn.recv(1024)
-                        if data:
-                            pattern = json.loads(data.decode('utf-8'))['pattern']
-                            cnt = 0  # line number counter
-                            buffer = []  # store all the matched results
-                            with open(self.log_path, 'r') as f:
-                                for line in f:
-                                    cnt += 1
-                                    if re.search(pattern, line):
-                                        buffer.append({
-                                            'log_path': self.log_path,
-                                            'host': self.host,
-                                            'port': str(self.port),
-                                            'line_number': cnt,
-                                            'content': line,
-                                        })  # json format for returning the matched log results
-                            # return the results to the client
-                            if buffer:
-                                data = json.dumps(buffer).encode('utf-8')
-                                conn.sendall(data)
-
-                    except Exception as e:
-                        print('[ERROR]:', e.__str__())
+                executor.submit(self.serve, conn, addr)
 
 
 if __name__ == '__main__':
-    s = Server()
+    parser = argparse.ArgumentParser(description='Distributed log querier server.')
+    parser.add_argument('--host', default=HOST, help='host to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--max-queries', type=int, default=MAX_QUERIES,
+                        help='max number of queries served at the same time')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes for parallel queries')
+    parser.add_argument('--logs', default=LOG_GLOB, help='default path glob of the log files to query')
+    parser.add_argument('--index', action='store_true',
+                        help='keep a sidecar trigram index of each log to skip blocks on queries')
+    parser.add_argument('--cache-bytes', type=int, default=CACHE_BYTES,
+                        help='memory limit of the query result cache, 0 to disable it')
+    parser.add_argument('--max-follows', type=int, default=MAX_FOLLOWS,
+                        help='max number of follow queries served at the same time')
+    args = parser.parse_args()
+    s = Server(host=args.host, port=args.port, workers=args.workers, max_queries=args.max_queries, log_glob=args.logs, index=args.index,
+               cache_bytes=args.cache_bytes, max_follows=args.max_follows)
     s.run()
-
-
-
@@ -0,0 +1,63 @@
+import os
+import random
+import string
+import tempfile
+import unittest
+
+from index import BLOCK_SIZE, LogIndex, required_trigrams
+
+
+def random_lines(rng, n, prefix):
+    # like genlog.py: a pattern word and 30 random alphanumerics per line
+    chars = string.ascii_letters + string.digits
+    return b''.join(b'%s,%s\n' % (prefix, ''.join(rng.choices(chars, k=30)).encode()) for _ in range(n))
+
+
+class LogIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'vm.log')
+        self.rng = random.Random(425)
+        with open(self.path, 'wb') as f:
+            f.write(random_lines(self.rng, 20000, b'frequent_pattern'))
+            f.write(b'rare_pattern_on_7,here\n')
+            f.write(random_lines(self.rng, 20000, b'frequent_pattern'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def scan(self, index, pattern):
+        ranges, indexed_size, _ = index.candidate_ranges(required_trigrams(pattern))
+        return list(index.scan(pattern)), sum(end - start for start, end, _ in ranges), indexed_size
+
+    def test_selective_query_skips_blocks(self):
+        index = LogIndex(self.path)
+        index.update()
+        self.assertGreater(len(index.blocks), 10)
+        self.assertNotIn(None, index.bitmaps)  # random alphanumerics are not dense
+
+        matches, candidate_bytes, indexed_size = self.scan(index, 'rare_pattern_on_7')
+        self.assertEqual(matches, [(20001, b'rare_pattern_on_7,here\n')])
+        self.assertLessEqual(candidate_bytes, 2 * BLOCK_SIZE)
+        self.assertEqual(indexed_size, os.path.getsize(self.path))
+
+        matches, candidate_bytes, _ = self.scan(index, 'frequent_pattern')
+        self.assertEqual(len(matches), 40000)
+        self.assertEqual(candidate_bytes, indexed_size)
+
+    def test_reload_and_append(self):
+        LogIndex(self.path).update()
+        with open(self.path, 'ab') as f:
+            f.write(random_lines(self.rng, 100, b'boring_message'))
+            f.write(b'rare_pattern_on_7,appended\n')
+
+        index = LogIndex(self.path)  # maps the sidecar files written above
+        self.assertEqual(len(index.lines), 40001)
+        self.assertEqual([n for n, _ in index.scan('rare_pattern_on_7')], [20001, 40102])
+        self.assertEqual(len(index.lines), 40102)
+        self.assertEqual(index.line_number(index.line_offset(40102)), 40102)
+        self.assertEqual(index.lines_before(os.path.getsize(self.path)), (os.path.getsize(self.path), 40102))
+
+
+if __name__ == '__main__':
+    unittest.main()
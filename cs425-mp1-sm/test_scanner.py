@@ -0,0 +1,53 @@
+import io
+import re
+import unittest
+
+import scanner
+from scanner import Scanner
+
+
+def line_by_line(pattern, data):
+    regex = re.compile(pattern.encode('utf-8'), re.MULTILINE)
+    matches = []
+    for n, line in enumerate(io.BytesIO(data), 1):
+        m = regex.search(line)
+        # an empty match after the final newline is not a match of the line
+        if m is not None and (m.start() < len(line) or not line.endswith(b'\n')):
+            matches.append((n, line))
+    return matches
+
+
+class ScannerTest(unittest.TestCase):
+    def setUp(self):
+        # sparse matches first, then a dense part where almost every line matches, then sparse again
+        self.data = b''.join([
+            b''.join(b'%d INFO ok\n' % n for n in range(2000)),
+            b''.join(b'%d ERROR disk\n' % n if n % 7 else b'\n' for n in range(5000)),
+            b''.join(b'%d INFO ok\n' % n for n in range(2000)),
+            b'last ERROR line',
+        ])
+        self.window = scanner.SCAN_WINDOW
+        scanner.SCAN_WINDOW = 16 * 1024  # several windows in each part
+
+    def tearDown(self):
+        scanner.SCAN_WINDOW = self.window
+
+    def scan(self, pattern):
+        gen = Scanner(pattern).scan(self.data)
+        matches = []
+        while True:
+            try:
+                matches.append(next(gen))
+            except StopIteration as e:
+                return matches, e.value
+
+    def test_dense_windows_match_line_by_line(self):
+        for pattern in ['ERROR', 'ERROR disk$', '^[0-9]+ ERROR', 'ERROR\\s', 'INFO', '^$']:
+            matches, _ = self.scan(pattern)
+            self.assertEqual(matches, line_by_line(pattern, self.data), pattern)
+            self.assertGreater(len(matches), 0, pattern)
+        self.assertEqual(self.scan('INFO')[1], 9001)  # the line after the 9000 complete lines
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from protocol import MessageType, send_msg, recv_msg
+from server import Server
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        for i in range(3):
+            with open(os.path.join(self.dir.name, 'vm%d.log' % i), 'wb') as f:
+                f.write(b''.join(b'%d GET /index.html 200 match\n' % n for n in range(100000)))
+        self.port = free_port()
+        self.server = Server(host='127.0.0.1', port=self.port, max_queries=1,
+                             log_glob=os.path.join(self.dir.name, '*.log'), cache_bytes=0, max_follows=2)
+        threading.Thread(target=self.server.run, daemon=True).start()
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def query(self, pattern):
+        s = socket.create_connection(('127.0.0.1', self.port))
+        send_msg(s, {'type': MessageType.QUERY, 'pattern': pattern})
+        return s
+
+    def test_disconnect_mid_stream_frees_the_query_slot(self):
+        # read the first batch only, then reset the connection while the server is still streaming
+        s = self.query('match')
+        self.assertEqual(recv_msg(s)['type'], MessageType.BATCH)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        s.close()
+
+        # with a single query slot, the next query is only served if the cancelled one has finished
+        with self.query('index.html 200 match$') as s:
+            s.settimeout(10)
+            while True:
+                msg = recv_msg(s)
+                if msg['type'] != MessageType.BATCH:
+                    break
+        self.assertEqual(msg['type'], MessageType.END)
+        self.assertEqual(sum(msg['counts'].values()), 300000)
+
+    def test_follow_queries_do_not_hold_query_slots(self):
+        follows = [self.follow('match') for _ in range(2)]
+        for s in follows:
+            s.settimeout(10)
+
+        # the single query slot is still free for a normal query
+        with self.query('^7 GET') as s:
+            s.settimeout(10)
+            msg = recv_msg(s)
+            while msg['type'] == MessageType.BATCH:
+                msg = recv_msg(s)
+        self.assertEqual(msg['type'], MessageType.END)
+
+        # more than max_follows follow queries are refused
+        with self.follow('match') as s:
+            s.settimeout(10)
+            self.assertEqual(recv_msg(s)['type'], MessageType.ERROR)
+        for s in follows:
+            s.close()
+
+    def follow(self, pattern):
+        s = socket.create_connection(('127.0.0.1', self.port))
+        send_msg(s, {'type': MessageType.QUERY, 'pattern': pattern, 'follow': True})
+        return s
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import mmap
+import re
+
+from scanner import Scanner, split_chunks, CHUNK_SIZE
+
+
+# leading timestamp of a log line, e.g. '2018-09-10 12:00:01', '2018-09-10T12:00:01.123'
+TIMESTAMP_RE = re.compile(rb'(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?)')
+
+# at most this many bytes of a line are looked at for its timestamp
+TIMESTAMP_BYTES = 64
+
+
+def normalize(timestamp):
+    """
+    Normalize a timestamp, so that timestamps compare in time order as plain bytes.
+
+    :param timestamp: str or bytes, e.g. '2018-09-10T12:00:01,5'
+    :return: bytes, e.g. b'2018-09-10 12:00:01.5'
+    """
+    if isinstance(timestamp, str):
+        timestamp = timestamp.encode('utf-8')
+    return timestamp.strip().replace(b'T', b' ').replace(b',', b'.')
+
+
+def line_timestamp(line):
+    """
+    :param line: bytes of a line, or its beginning
+    :return: normalized leading timestamp of the line, None if it has none (e.g. a stack trace line)
+    """
+    m = TIMESTAMP_RE.match(line)
+    if m is None:
+        return None
+    return m.group(1) + b' ' + m.group(2).replace(b',', b'.')
+
+
+def in_range(timestamp, since=None, until=None):
+    """
+    Check a timestamp against a time range. Both ends are inclusive at the precision they are
+    given with, e.g. until '2018-09-10 12:00' takes every second of that minute.
+
+    :param timestamp: normalized timestamp
+    :param since: normalized start of the range, None for no start
+    :param until: normalized end of the range, None for no end
+    :return: True if the timestamp is in the range
+    """
+    if since is not None and timestamp[:len(since)] < since:
+        return False
+    if until is not None and timestamp[:len(until)] > until:
+        return False
+    return True
+
+
+def next_timestamp(buf, pos, end):
+    """
+    Find the first line with a timestamp starting at or after pos.
+
+    :param buf: bytes-like object, e.g. bytes or mmap
+    :param pos: any offset
+    :param end: offset after the last byte to look at
+    :return: (line start, timestamp), or (end, None) if there is no such line
+    """
+    if pos > 0 and buf[pos - 1:pos] != b'\n':
+        pos = buf.find(b'\n', pos, end) + 1 or end
+    while pos < end:
+        timestamp = line_timestamp(buf[pos:min(pos + TIMESTAMP_BYTES, end)])
+        if timestamp is not None:
+            return pos, timestamp
+        pos = buf.find(b'\n', pos, end) + 1 or end
+    return end, None
+
+
+def seek(buf, start, end, reached):
+    """
+    Binary search the byte offsets of a log whose timestamps never decrease.
+    Lines without a timestamp belong to the timestamped line before them.
+
+    :param buf: bytes-like object, e.g. bytes or mmap
+    :param start: offset of the first byte to search, must be at a line start
+    :param end: offset after the last byte to search
+    :param reached: monotone predicate on a timestamp
+    :return: start of the first timestamped line whose timestamp is reached, or end
+    """
+    lo, hi = start, end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        _, timestamp = next_timestamp(buf, mid, end)
+        if timestamp is None or reached(timestamp):
+            hi = mid
+        else:
+            lo = mid + 1
+    return next_timestamp(buf, lo, end)[0]
+
+
+def time_range(buf, since=None, until=None, start=0, end=None):
+    """
+    Byte range of the lines of a log inside a time range, found with two binary searches.
+
+    :param buf: bytes-like object, e.g. bytes or mmap
+    :param since: normalized start of the range, None for no start
+    :param until: normalized end of the range, None for no end
+    :param start: offset of the first byte to search, must be at a line start
+    :param end: offset after the last byte to search
+    :return: (start, end) aligned to line starts
+    """
+    if end is None:
+        end = len(buf)
+    if since is not None:
+        start = seek(buf, start, end, lambda timestamp: timestamp[:len(since)] >= since)
+    if until is not None:
+        end = seek(buf, start, end, lambda timestamp: timestamp[:len(until)] > until)
+    return start, end
+
+
+def count_lines(buf, start, end):
+    """
+    Count the newlines of a byte range in chunks, without copying the whole range at once.
+
+    :return: number of newlines
+    """
+    return sum(buf[a:b].count(b'\n') for a, b in split_chunks(buf, (end - start) // CHUNK_SIZE, start, end))
+
+
+def scan_file_range(path, pattern, since=None, until=None, cancelled=None, index=None):
+    """
+    Scan only the part of a timestamped log inside a time range.
+
+    The line number of the first line in the range comes from the line table of the index if there
+    is one, otherwise the newlines before it are counted, which is still much cheaper than matching.
+
+    :param path: log file path
+    :param pattern: query string or Scanner
+    :param since: start of the range, None for no start
+    :param until: end of the range, None for no end
+    :param cancelled: optional callable, the scan stops once it returns True
+    :param index: optional LogIndex of the log
+    :return: generator of (line_number, line) where line is bytes including its newline
+    """
+    scanner = pattern if isinstance(pattern, Scanner) else Scanner(pattern)
+    since = normalize(since) if since else None
+    until = normalize(until) if until else None
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file can not be mapped
+            return
+        with buf:
+            start, end = time_range(buf, since, until)
+            if start >= end:
+                return
+            counted, line_number = 0, 1
+            if index is not None:
+                counted, lines = index.lines_before(start)
+                line_number += lines
+            line_number += count_lines(buf, counted, start)
+            for chunk_start, chunk_end in split_chunks(buf, (end - start) // CHUNK_SIZE, start, end):
+                if cancelled is not None and cancelled():
+                    return
+                line_number = yield from scanner.scan(buf, chunk_start, chunk_end, line_number)
+
+
+def filter_range(matches, since=None, until=None):
+    """
+    Keep only the matched lines whose own timestamp is inside a time range, for logs which can not
+    be searched (e.g. compressed ones). Matched lines without a timestamp are dropped.
+
+    :param matches: iterable of (line_number, line)
+    :param since: start of the range, None for no start
+    :param until: end of the range, None for no end
+    :return: generator of (line_number, line)
+    """
+    since = normalize(since) if since else None
+    until = normalize(until) if until else None
+    for line_number, line in matches:
+        timestamp = line_timestamp(line[:TIMESTAMP_BYTES])
+        if timestamp is not None and in_range(timestamp, since, until):
+            yield line_number, line
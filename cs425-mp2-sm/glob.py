@@ -1,7 +1,3 @@
-
-# time stamp format in this program
-TIME_FORMAT_STRING = '%H:%M:%S'
-
 # static introducer addr
 INTRODUCER_HOST = 'fa18-cs425-g33-01.cs.illinois.edu'
 
@@ -22,67 +18,15 @@ ALL_HOSTS = [
 # default socket port
 DEFAULT_PORT = 55343
 
-# topology of 10 VMs
-# {source: [dest_1, dest_2, ...]}
-CONNECTIONS = {
-    'fa18-cs425-g33-01.cs.illinois.edu': [
-        'fa18-cs425-g33-09.cs.illinois.edu',
-        'fa18-cs425-g33-10.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-        'fa18-cs425-g33-03.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-02.cs.illinois.edu': [
-        'fa18-cs425-g33-03.cs.illinois.edu',
-        'fa18-cs425-g33-04.cs.illinois.edu',
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-10.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-03.cs.illinois.edu': [
-        'fa18-cs425-g33-04.cs.illinois.edu',
-        'fa18-cs425-g33-05.cs.illinois.edu',
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-04.cs.illinois.edu': [
-        'fa18-cs425-g33-05.cs.illinois.edu',
-        'fa18-cs425-g33-06.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-        'fa18-cs425-g33-03.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-05.cs.illinois.edu': [
-        'fa18-cs425-g33-06.cs.illinois.edu',
-        'fa18-cs425-g33-07.cs.illinois.edu',
-        'fa18-cs425-g33-03.cs.illinois.edu',
-        'fa18-cs425-g33-04.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-06.cs.illinois.edu': [
-        'fa18-cs425-g33-07.cs.illinois.edu',
-        'fa18-cs425-g33-08.cs.illinois.edu',
-        'fa18-cs425-g33-04.cs.illinois.edu',
-        'fa18-cs425-g33-05.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-07.cs.illinois.edu': [
-        'fa18-cs425-g33-08.cs.illinois.edu',
-        'fa18-cs425-g33-09.cs.illinois.edu',
-        'fa18-cs425-g33-05.cs.illinois.edu',
-        'fa18-cs425-g33-06.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-08.cs.illinois.edu': [
-        'fa18-cs425-g33-09.cs.illinois.edu',
-        'fa18-cs425-g33-10.cs.illinois.edu',
-        'fa18-cs425-g33-06.cs.illinois.edu',
-        'fa18-cs425-g33-07.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-09.cs.illinois.edu': [
-        'fa18-cs425-g33-10.cs.illinois.edu',
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-07.cs.illinois.edu',
-        'fa18-cs425-g33-08.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-10.cs.illinois.edu': [
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-        'fa18-cs425-g33-08.cs.illinois.edu',
-        'fa18-cs425-g33-09.cs.illinois.edu',
-    ]
-}
+# number of successors and predecessors of a node in the sorted ring of live hosts which it pings
+NUM_SUCCESSORS = 2
+NUM_PREDECESSORS = 2
+
+# every this many rounds a node sends its full membership list instead of the changes only
+FULL_SYNC_ROUNDS = 10
+
+# max size of a received UDP message, the full membership list of a large group exceeds 4096 bytes
+MAX_DATAGRAM = 65507
+
+# a neighbour is failed if it does not acknowledge a PING within this many secs
+PING_TIMEOUT = 2.
@@ -0,0 +1,73 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler:
+    def __init__(self):
+        """
+        A single thread running callbacks at their deadlines, which are kept in a heap. The thread
+        sleeps until the earliest deadline, or until an earlier one is added, so nothing is polled.
+        Cancelled deadlines are left in the heap and skipped once they are reached.
+        """
+        self.heap = []  # (deadline, seq, key)
+        self.pending = {}  # {key: (seq, callback, args)}
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, key, delay, callback, *args):
+        """
+        Run callback(*args) on the scheduler thread after delay secs, unless the key is cancelled first.
+        A key which is already pending keeps its earlier deadline.
+
+        :param key: any hashable, e.g. a host name
+        :param delay: secs from now
+        :param callback: function to run, it should return quickly
+        :return: True if added, False if the key is already pending
+        """
+        with self.cond:
+            if key in self.pending:
+                return False
+            entry = (time.monotonic() + delay, next(self.seq), key)
+            self.pending[key] = (entry[1], callback, args)
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.cond.notify()  # the thread sleeps until a later deadline
+            return True
+
+    def cancel(self, key):
+        """
+        :param key: key of a pending callback
+        :return: True if it was pending
+        """
+        with self.cond:
+            return self.pending.pop(key, None) is not None
+
+    def next_due(self):
+        """
+        Pop the earliest pending callback once its deadline is reached, skipping cancelled ones.
+        Must be called with self.cond held.
+
+        :return: (callback, args)
+        """
+        while True:
+            while self.heap and self.pending.get(self.heap[0][2], (None,))[0] != self.heap[0][1]:
+                heapq.heappop(self.heap)  # cancelled, or replaced by a later add of the same key
+            now = time.monotonic()
+            if self.heap and self.heap[0][0] <= now:
+                _, _, key = heapq.heappop(self.heap)
+                _, callback, args = self.pending.pop(key)
+                return callback, args
+            self.cond.wait(self.heap[0][0] - now if self.heap else None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                callback, args = self.next_due()
+            try:
+                callback(*args)
+            except Exception as e:
+                print(e)
@@ -2,9 +2,10 @@ import socket
 import threading
 import json
 import random
-import datetime
+import bisect
 import time
 from glob import *
+from scheduler import Scheduler
 
 
 class MessageField:
@@ -13,6 +14,8 @@ class MessageField:
     PORT = 'port'
     INFO = 'info'
     ID = 'id'
+    VERSION = 'version'
+    UPDATES = 'updates'
 
 
 class Status:
@@ -29,38 +32,176 @@ class MessageType:
     LEAVE = 'LEAVE'
 
 
+# statuses of the nodes in the ring, which are monitored by their neighbours
+LIVE = {Status.JOINING, Status.RUNNING}
+
+# order of the statuses within one incarnation of a node, a later status overrides an earlier one
+STATUS_ORDER = {
+    Status.JOINING: 0,
+    Status.RUNNING: 1,
+    Status.FAILED: 2,
+    Status.LEAVED: 3,
+}
+
+
+class Member:
+    __slots__ = ('id', 'inc', 'status', 'ver', 'changed')
+
+    def __init__(self, member_id=0, inc=0, status=Status.JOINING):
+        """
+        An item of the membership list. Items are ordered by their incarnation, a counter which only
+        the node itself increases, so no clock is compared between nodes.
+
+        :param member_id: rand inited by each join operation
+        :param inc: incarnation, e.g. increased to refute a failure of the node
+        :param status: status of the node
+        """
+        self.id = member_id
+        self.inc = inc
+        self.status = status
+        self.ver = 0  # local version of the last change, never sent
+        self.changed = time.monotonic()  # local time of the last change, never sent
+
+    def key(self):
+        return self.inc, STATUS_ORDER[self.status]
+
+    def to_list(self):
+        """
+        :return: [id, incarnation, status] to send
+        """
+        return [self.id, self.inc, self.status]
+
+
 class MembershipList:
     def __init__(self, host_name, init_id):
+        self.host = host_name
+        self.clock = 0  # local version, increased by every change of the list
+        self.ring = [host_name]  # sorted live hosts, the node itself is always in
+        self.nbs = []  # neighbours of the node in the ring
         self.d = {
-            host_name: {
-                'id': init_id,  # rand inited by each join operation
-                'status': Status.LEAVED,  # init status, LEAVED is default
-                'ts': datetime.datetime.now().strftime(TIME_FORMAT_STRING)  # init time stamp
-            }
+            host_name: Member(init_id, 0, Status.LEAVED)  # init status, LEAVED is default
         }
 
+    def set(self, host, **fields):
+        """
+        Change the item of a host and stamp it with a new local version, so that it is gossiped again.
 
-def get_nbs(host_name):
+        :param host: host name
+        :param fields: fields to change, e.g. status=Status.FAILED
+        :return: None
+        """
+        member = self.d.get(host)
+        if member is None:
+            member = self.d[host] = Member()
+        for field, value in fields.items():
+            setattr(member, field, value)
+        self.update_ring(host)
+        self.clock += 1
+        member.ver = self.clock
+        member.changed = time.monotonic()
+
+    def update_ring(self, host):
+        """
+        Add a host which became live to the ring, or remove a host which is not live any more, and
+        recompute the neighbours if the ring changed.
+
+        :param host: host name
+        :return: None
+        """
+        live = host == self.host or self.d[host].status in LIVE
+        i = bisect.bisect_left(self.ring, host)
+        in_ring = i < len(self.ring) and self.ring[i] == host
+        if live == in_ring:
+            return
+        if live:
+            self.ring.insert(i, host)
+        else:
+            del self.ring[i]
+        self.nbs = get_nbs(self.ring, self.host)
+
+    def merge(self, host, info):
+        """
+        Merge a gossiped item. The higher incarnation wins, and within the same incarnation the
+        later status in STATUS_ORDER wins. If the node itself is said to be failed or leaved while it
+        is running, it refutes that with a higher incarnation.
+
+        :param host: host name
+        :param info: gossiped [id, incarnation, status] of the host
+        :return: True if the item changed
+        """
+        member_id, inc, status = info
+        member = self.d.get(host)
+        if member is not None and (inc, STATUS_ORDER[status]) <= member.key():
+            return False
+        if host == self.host:
+            if member.status != Status.RUNNING:
+                return False
+            self.set(host, inc=inc + 1)
+            return True
+        self.set(host, id=member_id, inc=inc, status=status)
+        return True
+
+    def join(self, host, member_id, inc):
+        """
+        Record a JOIN. A JOIN with another id than the stored one comes from a restarted node, whose
+        incarnation starts over, so it replaces the old item with an incarnation above the old one,
+        which also wins against the items of the old node still gossiped. Any other JOIN is merged.
+
+        :param host: host name of the joining node
+        :param member_id: id of the joining node
+        :param inc: incarnation of the joining node
+        :return: True if the item changed
+        """
+        member = self.d.get(host)
+        if member is not None and member.id != member_id and host != self.host:
+            self.set(host, id=member_id, inc=max(inc, member.inc + 1), status=Status.JOINING)
+            return True
+        return self.merge(host, [member_id, inc, Status.JOINING])
+
+    def item(self, host):
+        """
+        :return: item of a host to send
+        """
+        return self.d[host].to_list()
+
+    def delta(self, since=None):
+        """
+        :param since: local version the peer has acknowledged, None for the full list
+        :return: {host: item} changed after that version
+        """
+        return {host: member.to_list() for host, member in self.d.items() if since is None or member.ver > since}
+
+
+def get_nbs(ring, host_name):
     """
-    Given host_name, return [host_name1, host_name2, ...]
+    Given the sorted ring of live hosts, return the NUM_SUCCESSORS hosts after host_name and the
+    NUM_PREDECESSORS hosts before it, wrapping around, e.g. [host_3, host_4, host_1, host_10] for host_2
+    in a ring of 10 hosts, or fewer hosts in a smaller ring.
 
+    :param ring: sorted live host names, including host_name
     :param host_name:
-    :return: static neightbours
+    :return: neighbours of host_name
     """
-    return CONNECTIONS[host_name]
+    i = bisect.bisect_left(ring, host_name)
+    nbs = []
+    for d in list(range(1, NUM_SUCCESSORS + 1)) + list(range(-1, -NUM_PREDECESSORS - 1, -1)):
+        host = ring[(i + d) % len(ring)]
+        if host != host_name and host not in nbs:
+            nbs.append(host)
+    return nbs
 
 
 class Server:
     def __init__(self, host_name, port):
         self.id = random.randint(0, 65535)
         self.ml = MembershipList(host_name=host_name, init_id=self.id)
-        self.nbs = get_nbs(host_name)
         self.host = host_name
         self.port = port
         self.addr = (self.host, self.port)
-        self.timer = {}
+        self.scheduler = Scheduler()  # deadlines of the PINGs not acknowledged yet
+        self.joined = threading.Event()  # set while the node is in the group
+        self.acked = {}  # {host: local version of the list acknowledged by the host}
         self.ml_lock = threading.Lock()
-        self.checker_lock = threading.Lock()
         self.print_ml()
 
     def print_ml(self):
@@ -72,7 +213,7 @@ class Server:
         mld = self.ml.d
         print('=== MembershipList on %s ===' % self.host)
         for k, v in mld.items():
-            print('%s: %d [%s] [%s]' % (k, v['id'], v['status'], v['ts']))
+            print('%s: %d [%s] [%d] [%ds]' % (k, v.id, v.status, v.inc, time.monotonic() - v.changed))
         print('============================')
 
     def is_introducer(self):
@@ -95,12 +236,13 @@ class Server:
             while True:
                 try:
 
-                    # if current node is leaved, it does not receive any message
-                    if mld[self.host]['status'] == Status.LEAVED:
+                    # if current node is leaved, it does not receive any message until it joins again
+                    if mld[self.host].status == Status.LEAVED:
+                        self.joined.wait()
                         continue
 
                     # UDP receiver
-                    data, server = s.recvfrom(4096)
+                    data, server = s.recvfrom(MAX_DATAGRAM)
                     if data:
                         msg = json.loads(data.decode('utf-8'))
                         msg_type = msg.get(MessageField.TYPE, '#')
@@ -111,62 +253,62 @@ class Server:
                                                                      msg[MessageField.HOST],
                                                                      msg[MessageField.PORT]))
                         from_host = msg[MessageField.HOST]
-                        now = datetime.datetime.now().strftime(TIME_FORMAT_STRING)
-
-                        self.ml_lock.acquire()
-
-                        # process PING message
-                        if msg_type == MessageType.PING:
-                            info = msg[MessageField.INFO]
-                            for host in info:
-                                if host not in mld:
-                                    mld[host] = info[host]  # update new item in ml
-                                    continue
-                                old_time = datetime.datetime.strptime(mld[host]['ts'], TIME_FORMAT_STRING)
-                                new_time = datetime.datetime.strptime(info[host]['ts'], TIME_FORMAT_STRING)
-                                if new_time > old_time:
-                                    mld[host] = info[host]  # update older item in ml
-                            ack_msg = {
-                                MessageField.TYPE: MessageType.ACK,
-                                MessageField.HOST: self.host,
-                                MessageField.PORT: DEFAULT_PORT,
-                                MessageField.INFO: mld[self.host]
-                            }  # return ACK message
-                            s.sendto(json.dumps(ack_msg).encode('utf-8'), (from_host, DEFAULT_PORT))
-
-                        # process ACK message
-                        elif msg_type == MessageType.ACK:
-                            mld[from_host] = msg[MessageField.INFO]
-                            if from_host in self.timer:
-                                self.checker_lock.acquire()
-                                del self.timer[from_host]  # clean time table
-                                self.checker_lock.release()
-
-                        # process JOIN message
-                        elif msg_type == MessageType.JOIN:
-                            mld[from_host] = msg[MessageField.INFO]
-                            mld[from_host]['status'] = Status.JOINING
-                            mld[from_host]['ts'] = now
-                            if self.is_introducer():  # multicast the join message to all nodes as introducer
-                                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                                    join_msg = {
-                                        MessageField.TYPE: MessageType.JOIN,
-                                        MessageField.HOST: from_host,
-                                        MessageField.PORT: DEFAULT_PORT,
-                                        MessageField.INFO: mld[from_host]
-                                    }
-                                    for host in ALL_HOSTS:
-                                        if host != from_host and host != self.host:  # except for source node and itself
+
+                        with self.ml_lock:
+                            # process PING message
+                            if msg_type == MessageType.PING:
+                                info = msg[MessageField.INFO]  # items changed since the last PING acknowledged
+                                for host in info:
+                                    self.ml.merge(host, info[host])
+                                ack_msg = {
+                                    MessageField.TYPE: MessageType.ACK,
+                                    MessageField.HOST: self.host,
+                                    MessageField.PORT: DEFAULT_PORT,
+                                    MessageField.INFO: self.ml.item(self.host),
+                                    MessageField.VERSION: msg.get(MessageField.VERSION)
+                                }  # return ACK message
+                                if from_host in mld and mld[from_host].status == Status.FAILED:
+                                    # it is not pinged by its neighbours any more, let it refute its failure
+                                    ack_msg[MessageField.UPDATES] = {from_host: self.ml.item(from_host)}
+                                s.sendto(json.dumps(ack_msg).encode('utf-8'), (from_host, DEFAULT_PORT))
+
+                            # process ACK message
+                            elif msg_type == MessageType.ACK:
+                                self.ml.merge(from_host, msg[MessageField.INFO])
+                                updates = msg.get(MessageField.UPDATES, {})
+                                for host in updates:
+                                    self.ml.merge(host, updates[host])
+                                version = msg.get(MessageField.VERSION)
+                                if version is not None and version > self.acked.get(from_host, -1):
+                                    self.acked[from_host] = version  # the next PING only carries later changes
+                                self.scheduler.cancel(from_host)  # clean time table
+
+                            # process JOIN message
+                            elif msg_type == MessageType.JOIN:
+                                member_id, inc, _ = msg[MessageField.INFO]
+                                # a stale JOIN does not override a newer incarnation or status
+                                joined = self.ml.join(from_host, member_id, inc)
+                                if joined:
+                                    self.acked.pop(from_host, None)  # a (re)joined node gets the full list first
+                                if joined and self.is_introducer():  # multicast the join message to all nodes as introducer
+                                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
+                                        join_msg = {
+                                            MessageField.TYPE: MessageType.JOIN,
+                                            MessageField.HOST: from_host,
+                                            MessageField.PORT: DEFAULT_PORT,
+                                            MessageField.INFO: self.ml.item(from_host)
+                                        }
+                                        for host in list(self.ml.ring):
+                                            if host == from_host or host == self.host:
+                                                continue  # except for source node and itself
                                             ss.sendto(json.dumps(join_msg).encode('utf-8'), (host, DEFAULT_PORT))
 
-                        # process LEAVE message
-                        elif msg_type == MessageType.LEAVE:
-                            mld[from_host]['status'] = Status.LEAVED
-                            mld[from_host]['ts'] = now
+                            # process LEAVE message
+                            elif msg_type == MessageType.LEAVE:
+                                self.ml.set(from_host, status=Status.LEAVED)
 
-                        else:
-                            print('[ERROR] Unknown message type in info at receiver.')
-                        self.ml_lock.release()
+                            else:
+                                print('[ERROR] Unknown message type in info at receiver.')
 
                 except Exception as e:
                     print(e)
@@ -176,9 +318,14 @@ class Server:
         A UDP sender for a node. It sends PING message to its neighbours and maintain time table for
         handling timeout issue.
 
+        A PING only carries the items of the membership list changed since the last PING acknowledged
+        by the neighbour, the full list is sent to a neighbour which has not acknowledged any PING yet
+        and to every neighbour every FULL_SYNC_ROUNDS rounds, to repair anything lost.
+
         :return: None
         """
         mld = self.ml.d
+        rounds = 0
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             while True:
                 try:
@@ -186,75 +333,55 @@ class Server:
                     time.sleep(1)
 
                     # if current node is leaved, it does not send any message
-                    if mld[self.host]['status'] == Status.LEAVED:
+                    if mld[self.host].status == Status.LEAVED:
                         continue
 
-                    now = datetime.datetime.now()
-                    self.ml_lock.acquire()
-                    mld[self.host]['ts'] = now.strftime(TIME_FORMAT_STRING)
-                    mld[self.host]['status'] = Status.RUNNING
-
-                    # send PING message to all its neighbours
-                    for host in self.nbs:
-                        if (host not in mld) or (host in mld) and (mld[host]['status'] == Status.LEAVED):
-                            continue  # ignore non-discovered nodes and leaved nodes
-                        ping_msg = {
-                            MessageField.TYPE: MessageType.PING,
-                            MessageField.HOST: self.host,
-                            MessageField.PORT: self.port,
-                            MessageField.INFO: mld
-                        }
-                        s.sendto(json.dumps(ping_msg).encode('utf-8'), (host, self.port))
-
-                        # update the timer for checker thread
-                        if host in mld and host not in self.timer:
-                            self.checker_lock.acquire()
-                            self.timer[host] = datetime.datetime.now()
-                            self.checker_lock.release()
-                    self.ml_lock.release()
+                    with self.ml_lock:
+                        if mld[self.host].status != Status.RUNNING:
+                            self.ml.set(self.host, status=Status.RUNNING)
+                        full_sync = rounds % FULL_SYNC_ROUNDS == 0
+                        rounds += 1
+
+                        # send PING message to all its neighbours
+                        for host in self.ml.nbs:
+                            if (host not in mld) or (host in mld) and (mld[host].status == Status.LEAVED):
+                                continue  # ignore non-discovered nodes and leaved nodes
+                            acked = None if full_sync else self.acked.get(host)
+                            ping_msg = {
+                                MessageField.TYPE: MessageType.PING,
+                                MessageField.HOST: self.host,
+                                MessageField.PORT: self.port,
+                                MessageField.INFO: self.ml.delta(acked),
+                                MessageField.VERSION: self.ml.clock
+                            }
+                            s.sendto(json.dumps(ping_msg).encode('utf-8'), (host, self.port))
+
+                            # start the timer of the checker, unless the last PING is still not acknowledged
+                            self.scheduler.add(host, PING_TIMEOUT, self.checker, host)
                 except Exception as e:
                     print(e)
 
-    def checker(self):
+    def checker(self, host):
         """
-        A checker process for a node to check timeout (failure) of its neighbours.
-
-        The algorithm based on time table
-
-        The sender sends PING to foo at 24 logic time stamp.
+        A checker for a node to check timeout (failure) of its neighbours, run by the scheduler once
+        a PING to the neighbour has not been acknowledged for PING_TIMEOUT secs.
 
-        host | ts
-        =========
-        foo  | 24
-
-        If receiver gets the ACK from foo, delete the foo item in time table.
-        If checker checks that t_now - ts[foo] > LIMIT_TIME, it throws failed status to its own ml.
+        The sender sends PING to foo and adds a deadline for foo to the scheduler, unless foo already
+        has one: the deadline of the oldest PING not acknowledged is needed to check timeout.
+        If receiver gets the ACK from foo, the deadline of foo is cancelled.
+        Otherwise the scheduler calls the checker at the deadline, which throws failed status to its own ml.
         If the node is LEAVED or FAILED, the checker ignores the timeout.
 
-        Note: the new PING will not update time table if foo has been existed, e.g. the node send
-              PING to foo at 25 but the time table has 24, we do not update 24 to 25 because the oldest time
-              is needed to check timeout.
+        The scheduler sleeps until the next deadline, so an idle node does not burn any CPU.
 
+        :param host: neighbour which did not acknowledge in time
         :return: None
         """
         mld = self.ml.d
-        timer = self.timer
-        while True:
-            try:
-                self.checker_lock.acquire()
-                for host in list(timer.keys()):
-                    now = datetime.datetime.now()
-                    time_delta = now - timer[host]
-                    if time_delta.seconds > 2.:  # timeout, update timetable
-                        if (host in mld) and (mld[host]['status'] not in {Status.FAILED, Status.LEAVED}):
-                            print('[INFO] Timeout for host %s from checker.' % host, time_delta)
-                            mld[host]['status'] = Status.FAILED
-                            mld[host]['ts'] = now.strftime(TIME_FORMAT_STRING)
-                        del timer[host]
-                self.checker_lock.release()
-
-            except Exception as e:
-                print(e)
+        with self.ml_lock:
+            if (host in mld) and (mld[host].status not in {Status.FAILED, Status.LEAVED}):
+                print('[INFO] Timeout for host %s from checker.' % host)
+                self.ml.set(host, status=Status.FAILED)
 
     def join(self):
         """
@@ -268,9 +395,10 @@ class Server:
         if self.is_introducer():
             print('[INFO] I\'m introducer!')
 
-        mld[self.host]['status'] = Status.RUNNING
-        mld[self.host]['ts'] = datetime.datetime.now().strftime(TIME_FORMAT_STRING)
-        mld[self.host]['id'] = random.randint(0, 65535)
+        with self.ml_lock:
+            self.ml.set(self.host, status=Status.RUNNING, id=random.randint(0, 65535), inc=mld[self.host].inc + 1)
+            self.acked.clear()  # send the full list to every neighbour first
+        self.joined.set()
         if not self.is_introducer():
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
                 print('[INFO] Send join msg to introducer.')
@@ -278,7 +406,7 @@ class Server:
                     MessageField.TYPE: MessageType.JOIN,
                     MessageField.HOST: self.host,
                     MessageField.PORT: self.port,
-                    MessageField.INFO: mld[self.host],
+                    MessageField.INFO: self.ml.item(self.host),
                 }
                 s.sendto(json.dumps(join_msg).encode('utf-8'), (INTRODUCER_HOST, DEFAULT_PORT))
 
@@ -289,8 +417,8 @@ class Server:
         :return:
         """
         mld = self.ml.d
-        if mld[self.host]['status'] != Status.RUNNING:
-            print('[INFO] Cant leave under the status %s.' % mld[self.host]['status'])
+        if mld[self.host].status != Status.RUNNING:
+            print('[INFO] Cant leave under the status %s.' % mld[self.host].status)
             return
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             print('[INFO] Send leave msg to neighbours.')
@@ -299,9 +427,11 @@ class Server:
                 MessageField.HOST: self.host,
                 MessageField.PORT: self.port,
             }
-            for host in self.nbs:
+            for host in self.ml.nbs:
                 s.sendto(json.dumps(leave_msg).encode('utf-8'), (host, DEFAULT_PORT))
-            mld[self.host]['status'] = Status.LEAVED
+            with self.ml_lock:
+                self.ml.set(self.host, status=Status.LEAVED)
+            self.joined.clear()
         print('[INFO] %s safely LEAVES the group.' % self.host)
 
     def monitor(self):
@@ -342,21 +472,18 @@ class Server:
         - receiver: receive all UDP message
         - sender: send PING message
         - monitor: monitor the actions including join, leave, id and ml
-        - checker: check the failed events
+        - scheduler: check the failed events at the deadlines of the PINGs (started with the server)
 
         :return: None
         """
         t_receiver = threading.Thread(target=self.receiver)
         t_sender = threading.Thread(target=self.sender)
-        t_checker = threading.Thread(target=self.checker)
         t_monitor = threading.Thread(target=self.monitor)
         t_receiver.start()
         t_sender.start()
-        t_checker.start()
         t_monitor.start()
         t_receiver.join()
         t_sender.join()
-        t_checker.join()
         t_monitor.join()
 
 
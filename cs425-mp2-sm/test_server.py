@@ -0,0 +1,34 @@
+import unittest
+
+from server import MembershipList, Status
+
+
+class RejoinTest(unittest.TestCase):
+    def setUp(self):
+        self.ml = MembershipList('A', 1)
+        self.ml.set('A', status=Status.RUNNING, inc=1)
+
+    def test_failed_node_rejoins_after_restart(self):
+        self.assertTrue(self.ml.join('B', 111, 1))
+        self.ml.set('B', status=Status.FAILED)
+        self.assertEqual(self.ml.ring, ['A'])
+
+        # the restarted process has a new id and starts again at incarnation 1
+        self.assertTrue(self.ml.join('B', 222, 1))
+        member_id, inc, status = self.ml.item('B')
+        self.assertEqual((member_id, status), (222, Status.JOINING))
+        self.assertEqual(self.ml.ring, ['A', 'B'])
+
+        # a FAILED item of the old process still gossiped does not override the new one
+        self.assertFalse(self.ml.merge('B', [111, 1, Status.FAILED]))
+        self.assertEqual(self.ml.item('B')[2], Status.JOINING)
+
+    def test_stale_join_is_ignored(self):
+        self.ml.join('B', 111, 1)
+        self.ml.merge('B', [111, 2, Status.RUNNING])
+        self.assertFalse(self.ml.join('B', 111, 1))
+        self.assertEqual(self.ml.item('B'), [111, 2, Status.RUNNING])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import argparse
+import json
+import timeit
+
+import codec
+
+
+def sample_messages():
+    """
+    :return: [(name, message)] of the control messages on the hot paths, with the hosts of ALL_HOSTS
+    """
+    hosts = codec.ALL_HOSTS
+    items = {host: [1000 + i, 3, 'RUNNING'] for i, host in enumerate(hosts)}
+    return [
+        ('PING full list', {'message_type': 'PING', 'host': hosts[0], 'port': 52333, 'info': items, 'version': 42}),
+        ('PING delta', {'message_type': 'PING', 'host': hosts[0], 'port': 52333,
+                        'info': {hosts[1]: [1001, 4, 'FAILED']}, 'version': 43}),
+        ('ACK', {'message_type': 'ACK', 'host': hosts[1], 'port': 52333, 'info': [1001, 3, 'RUNNING'],
+                 'version': 42}),
+        ('PING_REQ', {'message_type': 'PING_REQ', 'host': hosts[0], 'port': 52333, 'target': hosts[2],
+                      'updates': dict(list(items.items())[:3])}),
+        ('SDFS update', {'type': 'update', 'file_name': 'foo.txt', 'replicas': [3, 4, 5, 6], 'version': 2}),
+        ('SDFS failed_relay', {'type': 'failed_relay', 'host': hosts[3]}),
+        ('Nimbus ping', {'type': 'ping', 'host': hosts[0]}),
+        ('stream tuple', {'pid': 123456, 'jid': 4242, 'data': '1537900000,GET /index.html,200'}),
+    ]
+
+
+def per_call(stmt, number):
+    """
+    :return: best secs per call over 3 repeats
+    """
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number
+
+
+if __name__ == '__main__':
+    # benchmark: python3 bench_codec.py [-n NUMBER]
+    parser = argparse.ArgumentParser(description='Compare datagram size and encode/decode cost of json and binary.')
+    parser.add_argument('-n', '--number', type=int, default=20000, help='number of calls per measurement')
+    args = parser.parse_args()
+
+    print('%-18s %10s %10s %12s %12s %12s %12s'
+          % ('message', 'json B', 'binary B', 'json enc us', 'bin enc us', 'json dec us', 'bin dec us'))
+    for name, msg in sample_messages():
+        json_data = json.dumps(msg).encode('utf-8')
+        binary_data = codec.encode_binary(msg)
+        assert binary_data is not None and codec.decode(binary_data) == json.loads(json_data), name
+        print('%-18s %10d %10d %12.2f %12.2f %12.2f %12.2f' % (
+            name, len(json_data), len(binary_data),
+            per_call(lambda: json.dumps(msg).encode('utf-8'), args.number) * 1e6,
+            per_call(lambda: codec.encode_binary(msg), args.number) * 1e6,
+            per_call(lambda: json.loads(json_data.decode('utf-8')), args.number) * 1e6,
+            per_call(lambda: codec.decode(binary_data), args.number) * 1e6))
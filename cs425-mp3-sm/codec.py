@@ -0,0 +1,238 @@
+import json
+import struct
+from glob import *
+
+
+# first byte of a binary message, it never starts a utf-8 json message, so both formats can be received
+MAGIC = 0xFF
+
+# version of the binary format, a receiver drops the binary messages of other versions
+WIRE_VERSION = 1
+
+# magic, version, type id and a bitmask of the fields present
+HEADER = struct.Struct('!BBBB')
+
+# node ids replace host names on the wire, a host out of ALL_HOSTS is sent in json
+HOST_IDS = {host: i + 1 for i, host in enumerate(ALL_HOSTS)}
+HOSTS_BY_ID = {i: host for host, i in HOST_IDS.items()}
+
+# statuses of the membership items
+STATUSES = ('JOINING', 'RUNNING', 'SUSPECT', 'FAILED', 'LEAVED')
+STATUS_IDS = {status: i for i, status in enumerate(STATUSES)}
+
+U16 = struct.Struct('!H')
+U32 = struct.Struct('!I')
+ITEM = struct.Struct('!HIB')  # id, incarnation, status of a membership item
+HOST_ITEM = struct.Struct('!HHIB')  # node id followed by its item
+
+
+class Kind:
+    HOST = 'host'  # host name, as its node id
+    HOSTS = 'hosts'  # list of host names
+    U16 = 'u16'
+    U32 = 'u32'
+    STR = 'str'  # utf-8 string of up to 65535 bytes
+    INTS = 'ints'  # list of u32
+    ITEM = 'item'  # membership item [id, incarnation, status]
+    ITEMS = 'items'  # {host: item}
+    JSON = 'json'  # anything else, as json
+
+
+class Schema:
+    def __init__(self, type_id, type_key, type_value, fields):
+        """
+        Binary layout of a kind of message: the type field is the type id of the header, and the other
+        fields follow in order, each one only if its bit is set in the header.
+
+        :param type_id: id in the header
+        :param type_key: name of the type field, e.g. 'message_type', None for messages without one
+        :param type_value: value of the type field, e.g. 'PING'
+        :param fields: [(name, Kind)], at most 8
+        """
+        self.type_id = type_id
+        self.type_key = type_key
+        self.type_value = type_value
+        self.fields = fields
+        self.keys = {name for name, _ in fields} | {type_key}  # keys a message of the schema may have
+
+
+SCHEMAS = [
+    # failure detector
+    Schema(1, 'message_type', 'PING', [('host', Kind.HOST), ('port', Kind.U16), ('info', Kind.ITEMS),
+                                       ('version', Kind.U32)]),
+    Schema(2, 'message_type', 'ACK', [('host', Kind.HOST), ('port', Kind.U16), ('info', Kind.ITEM),
+                                      ('version', Kind.U32), ('updates', Kind.ITEMS)]),
+    Schema(3, 'message_type', 'JOIN', [('host', Kind.HOST), ('port', Kind.U16), ('info', Kind.ITEM)]),
+    Schema(4, 'message_type', 'LEAVE', [('host', Kind.HOST), ('port', Kind.U16)]),
+    Schema(5, 'message_type', 'PING_REQ', [('host', Kind.HOST), ('port', Kind.U16), ('target', Kind.HOST),
+                                           ('updates', Kind.ITEMS)]),
+    # SDFS
+    Schema(16, 'type', 'update', [('file_name', Kind.STR), ('replicas', Kind.INTS), ('version', Kind.U32)]),
+    Schema(17, 'type', 'delete', [('file_name', Kind.STR)]),
+    Schema(18, 'type', 'failed_relay', [('host', Kind.HOST)]),
+    Schema(19, 'type', 'failed', [('host', Kind.HOST)]),
+    Schema(20, 'type', 'join', [('host', Kind.HOSTS)]),
+    Schema(21, 'type', 'join', [('lives', Kind.INTS)]),
+    # Nimbus and Supervisor
+    Schema(32, 'type', 'join', [('host', Kind.HOST), ('mode', Kind.STR)]),
+    Schema(33, 'type', 'ping', [('host', Kind.HOST)]),
+    Schema(34, 'type', 'ack', [('host', Kind.HOST)]),
+    Schema(35, 'type', 'leave', [('host', Kind.HOST)]),
+    Schema(36, 'type', 'node', [('nid', Kind.U32), ('jid', Kind.U32), ('info', Kind.JSON),
+                                ('master_host', Kind.HOST)]),
+    Schema(37, 'type', 'node_map', [('info', Kind.JSON)]),
+    Schema(48, None, None, [('pid', Kind.U32), ('jid', Kind.U32), ('data', Kind.STR)]),  # tuple of a stream
+]
+
+SCHEMAS_BY_ID = {schema.type_id: schema for schema in SCHEMAS}
+SCHEMAS_BY_TYPE = {}
+for schema in SCHEMAS:
+    SCHEMAS_BY_TYPE.setdefault((schema.type_key, schema.type_value), []).append(schema)
+
+
+def pack_str(buf, s):
+    b = s.encode('utf-8')
+    buf += U16.pack(len(b))
+    buf += b
+
+
+def pack_field(buf, kind, value):
+    """
+    Append a field to buf.
+
+    :raise KeyError, TypeError, struct.error: if the value does not fit the kind, e.g. an unknown host
+    """
+    if kind == Kind.HOST:
+        buf += U16.pack(HOST_IDS[value])
+    elif kind == Kind.HOSTS:
+        buf += U16.pack(len(value))
+        for host in value:
+            buf += U16.pack(HOST_IDS[host])
+    elif kind == Kind.U16:
+        buf += U16.pack(value)
+    elif kind == Kind.U32:
+        buf += U32.pack(value)
+    elif kind == Kind.STR:
+        pack_str(buf, value)
+    elif kind == Kind.INTS:
+        buf += U16.pack(len(value))
+        buf += struct.pack('!%dI' % len(value), *value)
+    elif kind == Kind.ITEM:
+        member_id, inc, status = value
+        buf += ITEM.pack(member_id, inc, STATUS_IDS[status])
+    elif kind == Kind.ITEMS:
+        buf += U16.pack(len(value))
+        for host, (member_id, inc, status) in value.items():
+            buf += HOST_ITEM.pack(HOST_IDS[host], member_id, inc, STATUS_IDS[status])
+    else:
+        b = json.dumps(value).encode('utf-8')
+        buf += U32.pack(len(b))
+        buf += b
+
+
+def unpack_field(data, offset, kind):
+    """
+    :return: (value, offset after the field)
+    """
+    if kind == Kind.HOST:
+        return HOSTS_BY_ID[U16.unpack_from(data, offset)[0]], offset + 2
+    if kind == Kind.HOSTS:
+        n = U16.unpack_from(data, offset)[0]
+        ids = struct.unpack_from('!%dH' % n, data, offset + 2)
+        return [HOSTS_BY_ID[i] for i in ids], offset + 2 + 2 * n
+    if kind == Kind.U16:
+        return U16.unpack_from(data, offset)[0], offset + 2
+    if kind == Kind.U32:
+        return U32.unpack_from(data, offset)[0], offset + 4
+    if kind == Kind.STR:
+        n = U16.unpack_from(data, offset)[0]
+        if offset + 2 + n > len(data):
+            raise struct.error('truncated string')
+        return bytes(data[offset + 2:offset + 2 + n]).decode('utf-8'), offset + 2 + n
+    if kind == Kind.INTS:
+        n = U16.unpack_from(data, offset)[0]
+        return list(struct.unpack_from('!%dI' % n, data, offset + 2)), offset + 2 + 4 * n
+    if kind == Kind.ITEM:
+        member_id, inc, status = ITEM.unpack_from(data, offset)
+        return [member_id, inc, STATUSES[status]], offset + ITEM.size
+    if kind == Kind.ITEMS:
+        n = U16.unpack_from(data, offset)[0]
+        offset += 2
+        end = offset + HOST_ITEM.size * n
+        if end > len(data):
+            raise struct.error('truncated items')
+        items = {HOSTS_BY_ID[host_id]: [member_id, inc, STATUSES[status]]
+                 for host_id, member_id, inc, status in HOST_ITEM.iter_unpack(data[offset:end])}
+        return items, end
+    n = U32.unpack_from(data, offset)[0]
+    if offset + 4 + n > len(data):
+        raise struct.error('truncated json')
+    return json.loads(bytes(data[offset + 4:offset + 4 + n]).decode('utf-8')), offset + 4 + n
+
+
+def encode_binary(msg):
+    """
+    :param msg: message dict
+    :return: binary message, None if no schema fits it
+    """
+    if 'message_type' in msg:
+        type_key = 'message_type'
+    elif 'type' in msg:
+        type_key = 'type'
+    else:
+        type_key = None
+    type_value = msg[type_key] if type_key else None
+    for schema in SCHEMAS_BY_TYPE.get((type_key, type_value), ()):
+        if not msg.keys() <= schema.keys:
+            continue
+        buf = bytearray()
+        flags = 0
+        try:
+            for i, (name, kind) in enumerate(schema.fields):
+                value = msg.get(name)
+                if value is not None:  # None is the same as absent
+                    flags |= 1 << i
+                    pack_field(buf, kind, value)
+        except (KeyError, TypeError, ValueError, struct.error):
+            continue  # e.g. a host out of ALL_HOSTS or a negative number
+        return HEADER.pack(MAGIC, WIRE_VERSION, schema.type_id, flags) + buf
+    return None
+
+
+def encode(msg):
+    """
+    Encode a message in WIRE_FORMAT. A message which does not fit any binary schema is sent in json.
+
+    :param msg: message dict
+    :return: bytes to send
+    """
+    if WIRE_FORMAT == 'binary':
+        data = encode_binary(msg)
+        if data is not None:
+            return data
+    return json.dumps(msg).encode('utf-8')
+
+
+def decode(data):
+    """
+    Decode a binary or a json message.
+
+    :param data: received bytes
+    :return: message dict, the same as json would give
+    :raise ValueError: if the message is invalid, or binary of another WIRE_VERSION
+    """
+    if not data or data[0] != MAGIC:
+        return json.loads(data.decode('utf-8'))
+    try:
+        _, version, type_id, flags = HEADER.unpack_from(data)
+        if version != WIRE_VERSION:
+            raise ValueError('Unsupported wire version %d.' % version)
+        schema = SCHEMAS_BY_ID[type_id]
+        msg = {schema.type_key: schema.type_value} if schema.type_key else {}
+        offset = HEADER.size
+        for i, (name, kind) in enumerate(schema.fields):
+            if flags & (1 << i):
+                msg[name], offset = unpack_field(data, offset, kind)
+    except (KeyError, IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError('Invalid binary message: %s' % e)
+    return msg
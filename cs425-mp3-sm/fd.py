@@ -1,10 +1,10 @@
 import socket
-import threading
-import json
 import random
-import datetime
+import bisect
 import time
+import math
 from glob import *
+from runtime import Runtime
 from collections import defaultdict
 
 
@@ -14,11 +14,15 @@ class MessageField:
     PORT = 'port'
     INFO = 'info'
     ID = 'id'
+    VERSION = 'version'
+    TARGET = 'target'
+    UPDATES = 'updates'
 
 
 class Status:
     JOINING = 'JOINING'
     RUNNING = 'RUNNING'
+    SUSPECT = 'SUSPECT'
     FAILED = 'FAILED'
     LEAVED = 'LEAVED'
 
@@ -28,40 +32,211 @@ class MessageType:
     ACK = 'ACK'
     JOIN = 'JOIN'
     LEAVE = 'LEAVE'
+    PING_REQ = 'PING_REQ'
+
+
+class Mode:
+    RING = 'ring'  # PING the static neighbours, a time out means FAILED
+    SWIM = 'swim'  # PING one random member per period, with indirect PINGs and suspicion
+
+
+# statuses of the nodes in the ring, which are monitored by their neighbours (or probed in SWIM mode)
+LIVE = {Status.JOINING, Status.RUNNING, Status.SUSPECT}
+
+# order of the statuses within one incarnation of a node, a later status overrides an earlier one
+STATUS_ORDER = {
+    Status.JOINING: 0,
+    Status.RUNNING: 1,
+    Status.SUSPECT: 2,
+    Status.FAILED: 3,
+    Status.LEAVED: 4,
+}
+
+
+class Member:
+    __slots__ = ('id', 'inc', 'status', 'ver', 'changed')
+
+    def __init__(self, member_id=0, inc=0, status=Status.JOINING):
+        """
+        An item of the membership list. Items are ordered by their incarnation, a counter which only
+        the node itself increases, so no clock is compared between nodes.
+
+        :param member_id: rand inited by each join operation
+        :param inc: incarnation, e.g. increased to refute a failure of the node
+        :param status: status of the node
+        """
+        self.id = member_id
+        self.inc = inc
+        self.status = status
+        self.ver = 0  # local version of the last change, never sent
+        self.changed = time.monotonic()  # local time of the last change, never sent
+
+    def key(self):
+        return self.inc, STATUS_ORDER[self.status]
+
+    def to_list(self):
+        """
+        :return: [id, incarnation, status] to send
+        """
+        return [self.id, self.inc, self.status]
 
 
 class MembershipList:
     def __init__(self, host_name, init_id):
+        self.host = host_name
+        self.clock = 0  # local version, increased by every change of the list
+        self.ring = [host_name]  # sorted live hosts, the node itself is always in
+        self.nbs = []  # neighbours of the node in the ring
+        self.gossip = {}  # {host: times the last change of its item has been piggybacked}
         self.d = {
-            host_name: {
-                'id': init_id,  # rand inited by each join operation
-                'status': Status.LEAVED,  # init status, LEAVED is default
-                'ts': datetime.datetime.now().strftime(TIME_FORMAT_STRING)  # init time stamp
-            }
+            host_name: Member(init_id, 0, Status.LEAVED)  # init status, LEAVED is default
         }
 
+    def set(self, host, **fields):
+        """
+        Change the item of a host and stamp it with a new local version, so that it is gossiped again.
+
+        :param host: host name
+        :param fields: fields to change, e.g. status=Status.FAILED
+        :return: None
+        """
+        member = self.d.get(host)
+        if member is None:
+            member = self.d[host] = Member()
+        for field, value in fields.items():
+            setattr(member, field, value)
+        self.update_ring(host)
+        self.clock += 1
+        member.ver = self.clock
+        member.changed = time.monotonic()
+        self.gossip[host] = 0
+
+    def update_ring(self, host):
+        """
+        Add a host which became live to the ring, or remove a host which is not live any more, and
+        recompute the neighbours if the ring changed.
+
+        :param host: host name
+        :return: None
+        """
+        live = host == self.host or self.d[host].status in LIVE
+        i = bisect.bisect_left(self.ring, host)
+        in_ring = i < len(self.ring) and self.ring[i] == host
+        if live == in_ring:
+            return
+        if live:
+            self.ring.insert(i, host)
+        else:
+            del self.ring[i]
+        self.nbs = get_nbs(self.ring, self.host)
 
-def get_nbs(host_name):
+    def merge(self, host, info):
+        """
+        Merge a gossiped item. The higher incarnation wins, and within the same incarnation the
+        later status in STATUS_ORDER wins. If the node itself is said to be failed or leaved while it
+        is running, it refutes that with a higher incarnation.
+
+        :param host: host name
+        :param info: gossiped [id, incarnation, status] of the host
+        :return: True if the item changed
+        """
+        member_id, inc, status = info
+        member = self.d.get(host)
+        if member is not None and (inc, STATUS_ORDER[status]) <= member.key():
+            return False
+        if host == self.host:
+            if member.status != Status.RUNNING:
+                return False
+            self.set(host, inc=inc + 1)
+            return True
+        self.set(host, id=member_id, inc=inc, status=status)
+        return True
+
+    def join(self, host, member_id, inc):
+        """
+        Record a JOIN. A JOIN with another id than the stored one comes from a restarted node, whose
+        incarnation starts over, so it replaces the old item with an incarnation above the old one,
+        which also wins against the items of the old node still gossiped. Any other JOIN is merged.
+
+        :param host: host name of the joining node
+        :param member_id: id of the joining node
+        :param inc: incarnation of the joining node
+        :return: True if the item changed
+        """
+        member = self.d.get(host)
+        if member is not None and member.id != member_id and host != self.host:
+            self.set(host, id=member_id, inc=max(inc, member.inc + 1), status=Status.JOINING)
+            return True
+        return self.merge(host, [member_id, inc, Status.JOINING])
+
+    def item(self, host):
+        """
+        :return: item of a host to send
+        """
+        return self.d[host].to_list()
+
+    def delta(self, since=None):
+        """
+        :param since: local version the peer has acknowledged, None for the full list
+        :return: {host: item} changed after that version
+        """
+        return {host: member.to_list() for host, member in self.d.items() if since is None or member.ver > since}
+
+    def piggyback(self, limit, times):
+        """
+        Pick the items to piggyback on a message in SWIM mode: the recent changes sent the fewest
+        times so far. Each change is sent a number of times, then dropped from the gossip buffer.
+
+        :param limit: max number of items
+        :param times: number of times each change is sent
+        :return: {host: item}
+        """
+        hosts = sorted(self.gossip, key=self.gossip.get)[:limit]
+        for host in hosts:
+            self.gossip[host] += 1
+            if self.gossip[host] >= times:
+                del self.gossip[host]
+        return {host: self.d[host].to_list() for host in hosts}
+
+    def members(self):
+        """
+        :return: other hosts which are probed in SWIM mode
+        """
+        return [host for host, member in self.d.items() if host != self.host and member.status in LIVE]
+
+
+def get_nbs(ring, host_name):
     """
-    Given host_name, return [host_name1, host_name2, ...]
+    Given the sorted ring of live hosts, return the NUM_SUCCESSORS hosts after host_name and the
+    NUM_PREDECESSORS hosts before it, wrapping around, e.g. [host_3, host_4, host_1, host_10] for host_2
+    in a ring of 10 hosts, or fewer hosts in a smaller ring.
 
+    :param ring: sorted live host names, including host_name
     :param host_name:
-    :return: static neightbours
+    :return: neighbours of host_name
     """
-    return CONNECTIONS[host_name]
+    i = bisect.bisect_left(ring, host_name)
+    nbs = []
+    for d in list(range(1, NUM_SUCCESSORS + 1)) + list(range(-1, -NUM_PREDECESSORS - 1, -1)):
+        host = ring[(i + d) % len(ring)]
+        if host != host_name and host not in nbs:
+            nbs.append(host)
+    return nbs
 
 
 class FailureDetector:
-    def __init__(self, host_name, port):
+    def __init__(self, host_name, port, mode=FD_MODE, runtime=None):
         self.id = random.randint(0, 65535)
         self.ml = MembershipList(host_name=host_name, init_id=self.id)
-        self.nbs = get_nbs(host_name)
         self.host = host_name
         self.port = port
         self.addr = (self.host, self.port)
-        self.timer = {}
-        self.ml_lock = threading.Lock()
-        self.checker_lock = threading.Lock()
+        self.runtime = runtime or Runtime()  # event loop of the handlers, the PING rounds and the time outs
+        self.rounds = 0
+        self.acked = {}  # {host: local version of the list acknowledged by the host}
+        self.mode = mode
+        self.probe_order = []  # SWIM mode: members left to probe in this round
+        self.ping_reqs = {}  # SWIM mode: {target: hosts waiting for its ACK through this node}
         self.cd = defaultdict(int)
         self.sent = set()
         # self.print_ml()
@@ -72,16 +247,18 @@ class FailureDetector:
 
         :return: None
         """
+        if not self.runtime.in_loop():
+            return self.runtime.call(self.print_ml)
         mld = self.ml.d
         print('=== MembershipList on %s ===' % self.host)
         for k, v in mld.items():
-            print('%s: %d [%s] [%s]' % (k, v['id'], v['status'], v['ts']))
+            print('%s: %d [%s] [%d] [%ds]' % (k, v.id, v.status, v.inc, time.monotonic() - v.changed))
         print('============================')
 
     def is_introducer(self):
         return self.host == INTRODUCER_HOST
 
-    def receiver(self):
+    def receiver(self, msg, addr):
         """
         A server's receiver is respnsible to receive all UDP message including four types:
 
@@ -89,237 +266,373 @@ class FailureDetector:
         - ACK: udpate the membership list only for source host
         - JOIN (only from introducer): acknowledge that some server has been introduced to the group by introducer
         - LEAVE: acknowledge that a node is gonna be leaved
+        - PING_REQ (SWIM mode): PING a target on behalf of the source host and relay the ACK of the target
 
+        In SWIM mode, PING, ACK and PING_REQ also piggyback recent changes of the membership list.
+        It runs on the event loop for every message, like all the other handlers, so the membership
+        list needs no lock.
+
+        :param msg: decoded message
+        :param addr: source address
         :return: None
         """
         mld = self.ml.d
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind(self.addr)
-            while True:
-                # if current node is leaved, it does not receive any message
-                if mld[self.host]['status'] == Status.LEAVED:
-                    continue
-
-                # UDP receiver
-                data, server = s.recvfrom(4096)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    msg_type = msg.get(MessageField.TYPE, '#')
-                    if msg_type == '#':
-                        # print('[ERROR] No message type field in info at receiver.')
-                        continue
-                    # print('[INFO] Receive %s msg from %s:%s.' % (msg[MessageField.TYPE],
-                    #                                              msg[MessageField.HOST],
-                    #                                              msg[MessageField.PORT]))
-                    from_host = msg[MessageField.HOST]
-                    now = datetime.datetime.now().strftime(TIME_FORMAT_STRING)
-
-                    self.ml_lock.acquire()
-
-                    # process PING message
-                    if msg_type == MessageType.PING:
-                        info = msg[MessageField.INFO]
-                        for host in info:
-                            if host not in mld:
-                                mld[host] = info[host]  # update new item in ml
-                                continue
-                            old_time = datetime.datetime.strptime(mld[host]['ts'], TIME_FORMAT_STRING)
-                            new_time = datetime.datetime.strptime(info[host]['ts'], TIME_FORMAT_STRING)
-                            if new_time > old_time:
-                                mld[host] = info[host]  # update older item in ml
-                        ack_msg = {
-                            MessageField.TYPE: MessageType.ACK,
-                            MessageField.HOST: self.host,
-                            MessageField.PORT: DEFAULT_PORT_FD,
-                            MessageField.INFO: mld[self.host]
-                        }  # return ACK message
-                        s.sendto(json.dumps(ack_msg).encode('utf-8'), (from_host, DEFAULT_PORT_FD))
-
-                    # process ACK message
-                    elif msg_type == MessageType.ACK:
-                        mld[from_host] = msg[MessageField.INFO]
-                        if from_host in self.timer:
-                            self.checker_lock.acquire()
-                            if from_host in self.timer:
-                                del self.timer[from_host]  # clean time table
-                            self.checker_lock.release()
-
-                    # process JOIN message
-                    elif msg_type == MessageType.JOIN:
-                        mld[from_host] = msg[MessageField.INFO]
-                        mld[from_host]['status'] = Status.JOINING
-                        mld[from_host]['ts'] = now
-                        self.sent.discard(from_host)
-                        if self.is_introducer():  # multicast the join message to all nodes as introducer
-                            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s1:
-                                join_msg = {
-                                    MessageField.TYPE: MessageType.JOIN,
-                                    MessageField.HOST: from_host,
-                                    MessageField.PORT: DEFAULT_PORT_FD,
-                                    MessageField.INFO: mld[from_host]
-                                }
-                                for host in ALL_HOSTS:
-                                    if host != from_host and host != self.host:  # except for source node and itself
-                                        s1.sendto(json.dumps(join_msg).encode('utf-8'), (host, DEFAULT_PORT_FD))
-                            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s2:
-                                join_msg = {
-                                    'type': 'join',
-                                    'host': [from_host],
-                                }
-                                s2.sendto(json.dumps(join_msg).encode('utf-8'), (self.host, DEFAULT_PORT_SDFS))
-
-                    # process LEAVE message
-                    elif msg_type == MessageType.LEAVE:
-                        mld[from_host]['status'] = Status.LEAVED
-                        mld[from_host]['ts'] = now
-
-                    else:
-                        # print('[ERROR] Unknown message type in info at receiver.')
-                        pass
-                    self.ml_lock.release()
+        # if current node is leaved, it ignores every message until it joins again
+        if mld[self.host].status == Status.LEAVED:
+            return
+
+        msg_type = msg.get(MessageField.TYPE, '#')
+        if msg_type == '#':
+            # print('[ERROR] No message type field in info at receiver.')
+            return
+        # print('[INFO] Receive %s msg from %s:%s.' % (msg[MessageField.TYPE],
+        #                                              msg[MessageField.HOST],
+        #                                              msg[MessageField.PORT]))
+        from_host = msg[MessageField.HOST]
+
+        # process PING message
+        if msg_type == MessageType.PING:
+            self.merge_info(msg[MessageField.INFO])  # items changed since the last PING acknowledged
+            ack_msg = {
+                MessageField.TYPE: MessageType.ACK,
+                MessageField.HOST: self.host,
+                MessageField.PORT: DEFAULT_PORT_FD,
+                MessageField.INFO: self.ml.item(self.host),
+                MessageField.VERSION: msg.get(MessageField.VERSION)
+            }  # return ACK message
+            if self.mode == Mode.SWIM:
+                ack_msg[MessageField.UPDATES] = self.piggyback()
+            if from_host in mld and mld[from_host].status in {Status.SUSPECT, Status.FAILED}:
+                # it is not pinged by its neighbours any more, let it refute its failure
+                ack_msg.setdefault(MessageField.UPDATES, {})[from_host] = self.ml.item(from_host)
+            self.runtime.send(ack_msg, (from_host, DEFAULT_PORT_FD))
+
+        # process ACK message
+        elif msg_type == MessageType.ACK:
+            self.ml.merge(from_host, msg[MessageField.INFO])
+            self.merge_info(msg.get(MessageField.UPDATES, {}))
+            version = msg.get(MessageField.VERSION)
+            if version is not None and version > self.acked.get(from_host, -1):
+                self.acked[from_host] = version  # the next PING only carries later changes
+            self.runtime.cancel(from_host)  # clean time table
+            self.runtime.cancel(('probe', from_host))
+            for host in self.ping_reqs.pop(from_host, ()):
+                self.runtime.send(msg, (host, DEFAULT_PORT_FD))  # relay the ACK of an indirect PING
+
+        # process PING_REQ message
+        elif msg_type == MessageType.PING_REQ:
+            self.merge_info(msg.get(MessageField.UPDATES, {}))
+            target = msg[MessageField.TARGET]
+            self.ping_reqs.setdefault(target, set()).add(from_host)
+            self.runtime.add(('ping_req', target), PING_REQ_TIMEOUT, self.ping_reqs.pop, target, None)
+            ping_msg = {
+                MessageField.TYPE: MessageType.PING,
+                MessageField.HOST: self.host,
+                MessageField.PORT: DEFAULT_PORT_FD,
+                MessageField.INFO: self.piggyback()
+            }
+            self.runtime.send(ping_msg, (target, DEFAULT_PORT_FD))
+
+        # process JOIN message
+        elif msg_type == MessageType.JOIN:
+            member_id, inc, _ = msg[MessageField.INFO]
+            if not self.ml.join(from_host, member_id, inc):
+                return  # a stale JOIN, the list already has a newer incarnation or status
+            self.acked.pop(from_host, None)  # a (re)joined node gets the full list first
+            self.sent.discard(from_host)
+            if self.is_introducer():  # multicast the join message to all nodes as introducer
+                join_msg = {
+                    MessageField.TYPE: MessageType.JOIN,
+                    MessageField.HOST: from_host,
+                    MessageField.PORT: DEFAULT_PORT_FD,
+                    MessageField.INFO: self.ml.item(from_host)
+                }
+                for host in self.ml.ring:
+                    if host != from_host and host != self.host:  # except for source node and itself
+                        self.runtime.send(join_msg, (host, DEFAULT_PORT_FD))
+                sdfs_join_msg = {
+                    'type': 'join',
+                    'host': [from_host],
+                }
+                self.runtime.send(sdfs_join_msg, (self.host, DEFAULT_PORT_SDFS))
+                if self.mode == Mode.SWIM:  # nobody else sends the full list to a new member
+                    ping_msg = {
+                        MessageField.TYPE: MessageType.PING,
+                        MessageField.HOST: self.host,
+                        MessageField.PORT: DEFAULT_PORT_FD,
+                        MessageField.INFO: self.ml.delta()
+                    }
+                    self.runtime.send(ping_msg, (from_host, DEFAULT_PORT_FD))
+
+        # process LEAVE message
+        elif msg_type == MessageType.LEAVE:
+            self.ml.set(from_host, status=Status.LEAVED)
+
+        else:
+            # print('[ERROR] Unknown message type in info at receiver.')
+            pass
 
     def sender(self):
         """
-        A UDP sender for a node. It sends PING message to its neighbours and maintain time table for
-        handling timeout issue.
+        A UDP sender for a node, run on the event loop once per period. It sends PING message to its
+        neighbours and maintain time table for handling timeout issue.
+
+        A PING only carries the items of the membership list changed since the last PING acknowledged
+        by the neighbour, the full list is sent to a neighbour which has not acknowledged any PING yet
+        and to every neighbour every FULL_SYNC_ROUNDS rounds, to repair anything lost.
+
+        In SWIM mode, it probes a single member per period instead, see probe().
 
         :return: None
         """
         mld = self.ml.d
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            while True:
-                try:
-                    # self.print_ml()
-                    time.sleep(0.5)
-
-                    # if current node is leaved, it does not send any message
-                    if mld[self.host]['status'] == Status.LEAVED:
-                        continue
-
-                    now = datetime.datetime.now()
-                    self.ml_lock.acquire()
-                    mld[self.host]['ts'] = now.strftime(TIME_FORMAT_STRING)
-                    mld[self.host]['status'] = Status.RUNNING
-
-                    # send PING message to all its neighbours
-                    for host in self.nbs:
-                        if (host not in mld) or (host in mld) and (mld[host]['status'] == Status.LEAVED):
-                            continue  # ignore non-discovered nodes and leaved nodes
-                        ping_msg = {
-                            MessageField.TYPE: MessageType.PING,
-                            MessageField.HOST: self.host,
-                            MessageField.PORT: self.port,
-                            MessageField.INFO: mld
-                        }
-                        s.sendto(json.dumps(ping_msg).encode('utf-8'), (host, self.port))
-
-                        # update the timer for checker thread
-                        self.checker_lock.acquire()
-                        if host in mld and host not in self.timer:
-                            self.timer[host] = datetime.datetime.now()
-                        self.checker_lock.release()
-                    self.ml_lock.release()
-                except Exception as e:
-                    print(e)
-
-    def checker(self):
-        """
-        A checker process for a node to check timeout (failure) of its neighbours.
-
-        The algorithm based on time table
-
-        The sender sends PING to foo at 24 logic time stamp.
-
-        host | ts
-        =========
-        foo  | 24
-
-        If receiver gets the ACK from foo, delete the foo item in time table.
-        If checker checks that t_now - ts[foo] > LIMIT_TIME, it throws failed status to its own ml.
+        # self.print_ml()
+
+        # if current node is leaved, it does not send any message
+        if mld[self.host].status == Status.LEAVED:
+            return
+
+        if mld[self.host].status != Status.RUNNING:
+            self.ml.set(self.host, status=Status.RUNNING)
+        full_sync = self.rounds % FULL_SYNC_ROUNDS == 0
+        self.rounds += 1
+        if self.mode == Mode.SWIM:
+            self.probe(full_sync)
+            return
+
+        # send PING message to all its neighbours
+        for host in self.ml.nbs:
+            if (host not in mld) or (host in mld) and (mld[host].status == Status.LEAVED):
+                continue  # ignore non-discovered nodes and leaved nodes
+            acked = None if full_sync else self.acked.get(host)
+            ping_msg = {
+                MessageField.TYPE: MessageType.PING,
+                MessageField.HOST: self.host,
+                MessageField.PORT: self.port,
+                MessageField.INFO: self.ml.delta(acked),
+                MessageField.VERSION: self.ml.clock
+            }
+            self.runtime.send(ping_msg, (host, self.port))
+
+            # start the timer of the checker, unless the last PING is still not acknowledged
+            self.runtime.add(host, PING_TIMEOUT, self.checker, host)
+
+    def checker(self, host):
+        """
+        A checker for a node to check timeout (failure) of its neighbours, run on the event loop once
+        a PING to the neighbour has not been acknowledged for PING_TIMEOUT secs.
+
+        The sender sends PING to foo and adds a time out for foo to the runtime, unless foo already
+        has one: the deadline of the oldest PING not acknowledged is needed to check timeout.
+        If receiver gets the ACK from foo, the time out of foo is cancelled.
+        Otherwise the runtime calls the checker at the deadline, which throws failed status to its own ml.
         If the node is LEAVED or FAILED, the checker ignores the timeout.
 
-        Note: the new PING will not update time table if foo has been existed, e.g. the node send
-              PING to foo at 25 but the time table has 24, we do not update 24 to 25 because the oldest time
-              is needed to check timeout.
+        :param host: neighbour which did not acknowledge in time
+        :return: None
+        """
+        mld = self.ml.d
+        if (host in mld) and (mld[host].status not in {Status.FAILED, Status.LEAVED}):
+            # print('[INFO] Timeout for host %s from checker.' % host)
+            self.ml.set(host, status=Status.FAILED)
+            self.relay_later(host)
 
+    def piggyback(self):
+        """
+        :return: recent changes to piggyback on a message in SWIM mode
+        """
+        times = RETRANSMIT_MULT * max(1, math.ceil(math.log2(len(self.ml.d) + 1)))
+        return self.ml.piggyback(MAX_PIGGYBACK, times)
+
+    def merge_info(self, info):
+        """
+        Merge gossiped items, and start the time outs of the nodes which became SUSPECT or FAILED.
+
+        :param info: {host: item}
         :return: None
         """
         mld = self.ml.d
-        timer = self.timer
+        for host in info:
+            if not self.ml.merge(host, info[host]):
+                continue
+            if mld[host].status == Status.SUSPECT:
+                self.suspect_later(host)
+            elif mld[host].status == Status.FAILED:
+                self.relay_later(host)
+
+    def next_target(self):
+        """
+        SWIM mode: members are probed in a random order, and every member once per round, so that a
+        failed member is probed within two rounds.
+
+        :return: host to probe, None if there is no other member
+        """
+        mld = self.ml.d
         while True:
-            for host in list(timer.keys()):
-                now = datetime.datetime.now()
-                time_delta = now - timer.get(host, datetime.datetime.now())
-                if time_delta.days >= 0 and time_delta.seconds > 2.:  # timeout, update timetable
-                    if (host in mld) and (mld[host]['status'] not in {Status.FAILED, Status.LEAVED}):
-                        # print('[INFO] Timeout for host %s from checker.' % host, time_delta)
-                        mld[host]['status'] = Status.FAILED
-                        mld[host]['ts'] = now.strftime(TIME_FORMAT_STRING)
-                    try:
-                        del timer[host]
-                    except Exception as e:
-                        pass
-            for host in list(mld.keys()):
-                if host in mld:
-                    ts = datetime.datetime.strptime(mld[host]['ts'], TIME_FORMAT_STRING)
-                    now = datetime.datetime.now()
-                    delta = now - ts
-                    if mld[host]['status'] == Status.FAILED and delta.days >= 0 \
-                            and delta.seconds > 3. and (host not in self.sent):
-                        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                            failed_msg = {
-                                'type': 'failed_relay',
-                                'host': host,
-                            }
-                            s.sendto(json.dumps(failed_msg).encode('utf-8'), (self.host, DEFAULT_PORT_SDFS))
-                        self.sent.add(host)
+            if not self.probe_order:
+                self.probe_order = self.ml.members()
+                random.shuffle(self.probe_order)
+                if not self.probe_order:
+                    return None
+            host = self.probe_order.pop()
+            if host in mld and mld[host].status in LIVE:
+                return host
+
+    def probe(self, full_sync):
+        """
+        SWIM mode: PING a single member, which the ACK cancels the time out of. Otherwise the time out
+        asks PING_REQ_COUNT other members to PING it, and if none of them relays its ACK either, the
+        member becomes SUSPECT.
+
+        :param full_sync: piggyback the full membership list instead of the recent changes
+        :return: None
+        """
+        target = self.next_target()
+        if target is None:
+            return
+        info = self.ml.delta() if full_sync else self.piggyback()
+        if self.ml.d[target].status == Status.SUSPECT:
+            info[target] = self.ml.item(target)  # let it refute the suspicion right away
+        ping_msg = {
+            MessageField.TYPE: MessageType.PING,
+            MessageField.HOST: self.host,
+            MessageField.PORT: self.port,
+            MessageField.INFO: info
+        }
+        self.runtime.send(ping_msg, (target, self.port))
+        self.runtime.add(('probe', target), PROBE_TIMEOUT, self.ping_req, target)
+
+    def ping_req(self, target):
+        """
+        SWIM mode: the target did not acknowledge the PING in time, ask other members to PING it.
+
+        :param target: probed host
+        :return: None
+        """
+        helpers = [host for host in self.ml.members() if host != target]
+        req_msg = {
+            MessageField.TYPE: MessageType.PING_REQ,
+            MessageField.HOST: self.host,
+            MessageField.PORT: self.port,
+            MessageField.TARGET: target,
+            MessageField.UPDATES: self.piggyback()
+        }
+        for host in random.sample(helpers, min(PING_REQ_COUNT, len(helpers))):
+            self.runtime.send(req_msg, (host, DEFAULT_PORT_FD))
+        self.runtime.add(('probe', target), PING_REQ_TIMEOUT, self.suspect, target)
+
+    def suspect(self, target):
+        """
+        SWIM mode: neither the target nor the members asked to PING it acknowledged in time.
+
+        :param target: probed host
+        :return: None
+        """
+        mld = self.ml.d
+        if target in mld and mld[target].status in {Status.JOINING, Status.RUNNING}:
+            self.ml.set(target, status=Status.SUSPECT)
+            self.suspect_later(target)
+
+    def suspect_later(self, host):
+        """
+        A SUSPECT node becomes FAILED unless it refutes the suspicion within SUSPECT_TIMEOUT secs.
+
+        :param host: host which just became SUSPECT
+        :return: None
+        """
+        self.runtime.cancel(('suspect', host))
+        self.runtime.add(('suspect', host), SUSPECT_TIMEOUT, self.confirm, host, self.ml.d[host].inc)
+
+    def confirm(self, host, inc):
+        """
+        :param host: SUSPECT host
+        :param inc: incarnation the host was suspected at
+        :return: None
+        """
+        mld = self.ml.d
+        if host in mld and mld[host].status == Status.SUSPECT and mld[host].inc == inc:
+            self.ml.set(host, status=Status.FAILED)
+            self.relay_later(host)
+
+    def relay_later(self, host):
+        """
+        Tell SDFS about a failed node once it has stayed FAILED for FAILED_RELAY_DELAY secs.
+
+        :param host: host which just became FAILED
+        :return: None
+        """
+        self.runtime.cancel(('relay', host))
+        self.runtime.add(('relay', host), FAILED_RELAY_DELAY, self.failed_relay, host)
+
+    def failed_relay(self, host):
+        """
+        Relay a failure to the local SDFS server, at most once until the node joins again.
+
+        :param host: failed host
+        :return: None
+        """
+        member = self.ml.d.get(host)
+        if member is None or member.status != Status.FAILED or host in self.sent:
+            return
+        failed_msg = {
+            'type': 'failed_relay',
+            'host': host,
+        }
+        self.runtime.send(failed_msg, (self.host, DEFAULT_PORT_SDFS))
+        self.sent.add(host)
 
     def join(self):
         """
         Action join, it tells the introducer the node will be joined to the group.
         Also, it updates self's status to RUNNING.
-        A node can join after its leave.
+        A node can join after its leave. It can be called from any thread, it runs on the event loop.
 
         :return: None
         """
+        if not self.runtime.in_loop():
+            return self.runtime.call(self.join)
         mld = self.ml.d
         if self.is_introducer():
             print('[INFO] I\'m introducer!')
 
-        mld[self.host]['status'] = Status.RUNNING
-        mld[self.host]['ts'] = datetime.datetime.now().strftime(TIME_FORMAT_STRING)
-        mld[self.host]['id'] = random.randint(0, 65535)
+        self.ml.set(self.host, status=Status.RUNNING, id=random.randint(0, 65535), inc=mld[self.host].inc + 1)
+        self.acked.clear()  # send the full list to every neighbour first
         if not self.is_introducer():
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                # print('[INFO] Send join msg to introducer.')
-                join_msg = {
-                    MessageField.TYPE: MessageType.JOIN,
-                    MessageField.HOST: self.host,
-                    MessageField.PORT: self.port,
-                    MessageField.INFO: mld[self.host],
-                }
-                s.sendto(json.dumps(join_msg).encode('utf-8'), (INTRODUCER_HOST, DEFAULT_PORT_FD))
+            # print('[INFO] Send join msg to introducer.')
+            join_msg = {
+                MessageField.TYPE: MessageType.JOIN,
+                MessageField.HOST: self.host,
+                MessageField.PORT: self.port,
+                MessageField.INFO: self.ml.item(self.host),
+            }
+            self.runtime.send(join_msg, (INTRODUCER_HOST, DEFAULT_PORT_FD))
 
     def leave(self):
         """
         Action leave, it tells its neighbours that the node will leave and leave the last word (LEAVE message).
+        It can be called from any thread, it runs on the event loop.
 
         :return:
         """
+        if not self.runtime.in_loop():
+            return self.runtime.call(self.leave)
         mld = self.ml.d
-        if mld[self.host]['status'] != Status.RUNNING:
-            # print('[INFO] Cant leave under the status %s.' % mld[self.host]['status'])
+        if mld[self.host].status != Status.RUNNING:
+            # print('[INFO] Cant leave under the status %s.' % mld[self.host].status)
             return
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            # print('[INFO] Send leave msg to neighbours.')
-            leave_msg = {
-                MessageField.TYPE: MessageType.LEAVE,
-                MessageField.HOST: self.host,
-                MessageField.PORT: self.port,
-            }
-            for host in self.nbs:
-                s.sendto(json.dumps(leave_msg).encode('utf-8'), (host, DEFAULT_PORT_FD))
-            mld[self.host]['status'] = Status.LEAVED
+        # print('[INFO] Send leave msg to neighbours.')
+        leave_msg = {
+            MessageField.TYPE: MessageType.LEAVE,
+            MessageField.HOST: self.host,
+            MessageField.PORT: self.port,
+        }
+        nbs = self.ml.nbs
+        if self.mode == Mode.SWIM:  # a few members are enough, they gossip the leave
+            members = self.ml.members()
+            nbs = random.sample(members, min(PING_REQ_COUNT, len(members)))
+        for host in nbs:
+            self.runtime.send(leave_msg, (host, DEFAULT_PORT_FD))
+        self.ml.set(self.host, status=Status.LEAVED)
         # print('[INFO] %s safely LEAVES the group.' % self.host)
 
     def monitor(self):
@@ -354,26 +667,16 @@ class FailureDetector:
     def run(self):
         """
         Run a server as a node in group but not joined yet.
-        There are totally four parallel processes for a single node:
-        - receiver: receive all UDP message
-        - sender: send PING message
-        - monitor: monitor the actions including join, leave, id and ml
-        - checker: check the failed events
+        Everything of a node runs on the single event loop of its runtime, shared with SDFS:
+        - receiver: handle every UDP message on the failure detector port
+        - sender: send PING messages once per period
+        - checker (and the SWIM time outs): run at the deadlines of the PINGs not acknowledged
+        The monitor (join, leave and ml) runs in its own thread and hands them over to the loop.
 
         :return: None
         """
-        t_receiver = threading.Thread(target=self.receiver)
-        t_sender = threading.Thread(target=self.sender)
-        t_checker = threading.Thread(target=self.checker)
-        # t_monitor = threading.Thread(target=self.monitor)
-        t_receiver.start()
-        t_sender.start()
-        t_checker.start()
-        # t_monitor.start()
-        # t_receiver.join()
-        # t_sender.join()
-        # t_checker.join()
-        # t_monitor.join()
+        self.runtime.listen(self.addr, self.receiver)
+        self.runtime.every(PROBE_PERIOD if self.mode == Mode.SWIM else 0.5, self.sender)
 
 
 def main():
@@ -1,7 +1,3 @@
-
-# time stamp format in this program
-TIME_FORMAT_STRING = '%H:%M:%S'
-
 # static introducer addr
 INTRODUCER_HOST = 'fa18-cs425-g33-01.cs.illinois.edu'
 
@@ -23,67 +19,37 @@ ALL_HOSTS = [
 DEFAULT_PORT_FD = 52333
 DEFAULT_PORT_SDFS = 53222
 
-# topology of 10 VMs
-# {source: [dest_1, dest_2, ...]}
-CONNECTIONS = {
-    'fa18-cs425-g33-01.cs.illinois.edu': [
-        'fa18-cs425-g33-09.cs.illinois.edu',
-        'fa18-cs425-g33-10.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-        'fa18-cs425-g33-03.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-02.cs.illinois.edu': [
-        'fa18-cs425-g33-03.cs.illinois.edu',
-        'fa18-cs425-g33-04.cs.illinois.edu',
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-10.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-03.cs.illinois.edu': [
-        'fa18-cs425-g33-04.cs.illinois.edu',
-        'fa18-cs425-g33-05.cs.illinois.edu',
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-04.cs.illinois.edu': [
-        'fa18-cs425-g33-05.cs.illinois.edu',
-        'fa18-cs425-g33-06.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-        'fa18-cs425-g33-03.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-05.cs.illinois.edu': [
-        'fa18-cs425-g33-06.cs.illinois.edu',
-        'fa18-cs425-g33-07.cs.illinois.edu',
-        'fa18-cs425-g33-03.cs.illinois.edu',
-        'fa18-cs425-g33-04.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-06.cs.illinois.edu': [
-        'fa18-cs425-g33-07.cs.illinois.edu',
-        'fa18-cs425-g33-08.cs.illinois.edu',
-        'fa18-cs425-g33-04.cs.illinois.edu',
-        'fa18-cs425-g33-05.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-07.cs.illinois.edu': [
-        'fa18-cs425-g33-08.cs.illinois.edu',
-        'fa18-cs425-g33-09.cs.illinois.edu',
-        'fa18-cs425-g33-05.cs.illinois.edu',
-        'fa18-cs425-g33-06.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-08.cs.illinois.edu': [
-        'fa18-cs425-g33-09.cs.illinois.edu',
-        'fa18-cs425-g33-10.cs.illinois.edu',
-        'fa18-cs425-g33-06.cs.illinois.edu',
-        'fa18-cs425-g33-07.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-09.cs.illinois.edu': [
-        'fa18-cs425-g33-10.cs.illinois.edu',
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-07.cs.illinois.edu',
-        'fa18-cs425-g33-08.cs.illinois.edu',
-    ],
-    'fa18-cs425-g33-10.cs.illinois.edu': [
-        'fa18-cs425-g33-01.cs.illinois.edu',
-        'fa18-cs425-g33-02.cs.illinois.edu',
-        'fa18-cs425-g33-08.cs.illinois.edu',
-        'fa18-cs425-g33-09.cs.illinois.edu',
-    ]
-}
+# number of successors and predecessors of a node in the sorted ring of live hosts which it pings
+NUM_SUCCESSORS = 2
+NUM_PREDECESSORS = 2
+
+# every this many rounds a node sends its full membership list instead of the changes only
+FULL_SYNC_ROUNDS = 10
+
+# a neighbour is failed if it does not acknowledge a PING within this many secs
+PING_TIMEOUT = 2.
+
+# a failure is relayed to SDFS once the node has stayed FAILED for this many secs
+FAILED_RELAY_DELAY = 3.
+
+# failure detector mode, 'ring' pings the ring neighbours, 'swim' probes one random member per period
+FD_MODE = 'ring'
+
+# SWIM mode: period between two probes, and the time outs of the direct and the indirect PINGs in secs
+PROBE_PERIOD = 0.5
+PROBE_TIMEOUT = 0.2
+PING_REQ_TIMEOUT = 0.3
+
+# SWIM mode: number of members asked to PING a target which did not acknowledge the direct PING
+PING_REQ_COUNT = 3
+
+# SWIM mode: a SUSPECT node which does not refute within this many secs is FAILED
+SUSPECT_TIMEOUT = 2.
+
+# SWIM mode: max number of membership items piggybacked on a message, and how many times each change
+# is sent, times log2 of the group size
+MAX_PIGGYBACK = 8
+RETRANSMIT_MULT = 3
+
+# format of the messages sent, 'binary' (see codec.py) or 'json', both formats are always received
+WIRE_FORMAT = 'binary'
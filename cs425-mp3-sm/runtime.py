@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import concurrent.futures
+import socket
+import threading
+import codec
+
+
+class Endpoint(asyncio.DatagramProtocol):
+    def __init__(self, handler):
+        """
+        A bound UDP endpoint, every datagram is decoded (binary or json, see codec.py) and passed to its
+        handler on the event loop.
+
+        :param handler: function(msg, addr), it should return quickly
+        """
+        self.handler = handler
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = codec.decode(data)
+        except ValueError:
+            print('[ERROR] Invalid message from %s:%d.' % addr[:2])
+            return
+        try:
+            self.handler(msg, addr)
+        except Exception as e:
+            print(e)
+
+    def error_received(self, exc):
+        pass  # e.g. port unreachable from a failed node, which its time out detects anyway
+
+
+class Runtime:
+    def __init__(self):
+        """
+        A single thread running an asyncio event loop, which every UDP endpoint, periodic task and
+        time out of a process runs on. Handlers never run concurrently, so the state they share needs
+        no lock, and all the outgoing messages are sent through one shared non-blocking socket.
+
+        Other threads (e.g. the command monitor reading stdin) hand work over with call(), send()
+        and spawn(). add(), cancel(), send_data() and send_wait() must only be used on the loop.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.timers = {}  # {key: TimerHandle}
+        self.endpoints = {}  # {addr: Endpoint}
+        self.thread = threading.Thread(target=self.loop.run_forever)  # keeps the process alive like the old receivers
+        self.thread.start()
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.out.setblocking(False)
+        self.backlog = collections.deque()  # (datagram, addr) of data messages waiting for a writable socket
+        self.drain_waiters = []  # futures of send_wait() calls, done once the backlog is flushed
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def wait(self, coro):
+        """
+        Run a coroutine on the loop and wait for its result, from another thread.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def spawn(self, coro):
+        """
+        Run a coroutine on the loop as a task, from any thread.
+
+        :return: concurrent.futures.Future of its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, callback, *args):
+        """
+        Run callback(*args) on the loop and wait for its result, from any thread.
+        """
+        if self.in_loop():
+            return callback(*args)
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(callback(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def listen(self, addr, handler):
+        """
+        Bind a UDP endpoint, from another thread.
+
+        :param addr: (host, port)
+        :param handler: function(msg, addr) run on the loop for every message
+        :return: Endpoint
+        """
+        _, endpoint = self.wait(self.loop.create_datagram_endpoint(lambda: Endpoint(handler), local_addr=addr))
+        self.endpoints[addr] = endpoint
+        return endpoint
+
+    def send(self, msg, addr):
+        """
+        Encode a control message in WIRE_FORMAT (see codec.py) and send it through the shared socket,
+        from any thread. A datagram transport is closed for good by an invalid address, so the socket
+        is used directly: a full send buffer drops the message like the network would (pings and acks
+        are periodic anyway), and so does a socket error for its host (e.g. an unresolvable host or an
+        unreachable network), which is logged, so a loop sending to many hosts still reaches the
+        others. Data messages, which must not be lost, go through send_data() instead.
+
+        :param msg: json serializable message
+        :param addr: (host, port)
+        :return: None
+        """
+        try:
+            self.out.sendto(codec.encode(msg), addr)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print('[ERROR] Send to %s: %s' % (addr, e))
+
+    def send_data(self, msg, addr):
+        """
+        Send a data message (e.g. a tuple of a stream) through the shared socket, on the loop. Unlike
+        send(), a full send buffer does not drop it: it waits in the backlog, in order, until the
+        socket is writable again. A socket error for its host drops it like send() does.
+
+        :param msg: json serializable message
+        :param addr: (host, port)
+        :return: None
+        """
+        data = codec.encode(msg)
+        if not self.backlog:
+            try:
+                self.out.sendto(data, addr)
+                return
+            except BlockingIOError:
+                self.loop.add_writer(self.out, self.flush)
+            except OSError as e:
+                print('[ERROR] Send to %s: %s' % (addr, e))
+                return
+        self.backlog.append((data, addr))
+
+    async def send_wait(self, msg, addr):
+        """
+        send_data(), then wait until the backlog is flushed, so a producer (e.g. the spout of a job)
+        is throttled by the socket like with a blocking sendto.
+        """
+        self.send_data(msg, addr)
+        if self.backlog:
+            waiter = self.loop.create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    def flush(self):
+        """
+        Send the backlog once the shared socket is writable, run by the loop.
+        """
+        while self.backlog:
+            data, addr = self.backlog[0]
+            try:
+                self.out.sendto(data, addr)
+            except BlockingIOError:
+                return  # wait for the next writable event
+            except Exception as e:
+                print(e)  # e.g. an invalid address, nothing would ever send it
+            self.backlog.popleft()
+        self.loop.remove_writer(self.out)
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters.clear()
+
+    def every(self, period, callback, *args):
+        """
+        Run callback(*args) on the loop every period secs, from any thread.
+        """
+        def tick():
+            self.loop.call_later(period, tick)
+            try:
+                callback(*args)
+            except Exception as e:
+                print(e)
+
+        self.loop.call_soon_threadsafe(self.loop.call_later, period, tick)
+
+    def add(self, key, delay, callback, *args):
+        """
+        Run callback(*args) after delay secs, unless the key is cancelled first.
+        A key which is already pending keeps its earlier deadline.
+
+        :param key: any hashable, e.g. a host name
+        :param delay: secs from now
+        :param callback: function to run, it should return quickly
+        :return: True if added, False if the key is already pending
+        """
+        if key in self.timers:
+            return False
+        self.timers[key] = self.loop.call_later(delay, self.fire, key, callback, args)
+        return True
+
+    def cancel(self, key):
+        """
+        :param key: key of a pending callback
+        :return: True if it was pending
+        """
+        handle = self.timers.pop(key, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        return True
+
+    def fire(self, key, callback, args):
+        del self.timers[key]
+        try:
+            callback(*args)
+        except Exception as e:
+            print(e)
@@ -1,12 +1,12 @@
 import socket
 import threading
-import json
 import hashlib
 import subprocess
 import os
 import shutil
 from glob import *
 from pprint import pprint
+from runtime import Runtime
 import fd
 import random
 
@@ -77,9 +77,11 @@ class Server:
         self.id = self.get_id_from_host(host)
         self.addr = (self.host, self.port)
         self.lives = {self.id}  # record all available sources, i.e. replicas
-        self.failure_detector = fd.FailureDetector(host_name=socket.gethostname(), port=DEFAULT_PORT_FD)
+        self.runtime = Runtime()  # one event loop for the failure detector and SDFS
+        self.failure_detector = fd.FailureDetector(host_name=socket.gethostname(), port=DEFAULT_PORT_FD,
+                                                   runtime=self.runtime)
 
-    def receiver(self):
+    def receiver(self, msg, addr):
         """
         Like failure detector, receiver is an UDP receiver to get all contact message including
         - UPDATE: update idm and fm, sync the status
@@ -87,114 +89,109 @@ class Server:
         - FAILED_RELAY: receive from failure detector, to know that a replica is down
         - FAILED: multicasted by replicas, to let all other node know a replica is down
         - JOIN: multicasted by sdfs server whose failure detector is introducer (default is node with id 1)
+        It runs on the event loop shared with the failure detector.
+        :param msg: decoded message
+        :param addr: source address
         :return: None
         """
         fm = self.ft.fm
         idm = self.ft.idm
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind(self.addr)
-            while True:
-                data, server = s.recvfrom(4096)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    msg_type = msg['type']
-                    pprint(msg)
-
-                    if msg_type == 'update':
-                        print('[INFO] Receive update message.')
-                        fn = msg['file_name']
-                        replicas = set(msg['replicas'])
-                        for replica in replicas:
-                            idm[replica].add(fn)
-                        if fn not in fm:
-                            fm[fn] = {
-                                'version': 0,
-                                'replicas': set(),
-                            }
-                        fm[fn]['version'] = msg['version']
-                        fm[fn]['replicas'] |= replicas
-
-                    elif msg_type == 'delete':
-                        print('[INFO] Receive delete message.')
-                        fn = msg['file_name']
-                        self.ft.delete_file(fn)
-                        # search and delete sdfs replica from local storage
+        msg_type = msg['type']
+        pprint(msg)
+
+        if msg_type == 'update':
+            print('[INFO] Receive update message.')
+            fn = msg['file_name']
+            replicas = set(msg['replicas'])
+            for replica in replicas:
+                idm[replica].add(fn)
+            if fn not in fm:
+                fm[fn] = {
+                    'version': 0,
+                    'replicas': set(),
+                }
+            fm[fn]['version'] = msg['version']
+            fm[fn]['replicas'] |= replicas
+
+        elif msg_type == 'delete':
+            print('[INFO] Receive delete message.')
+            fn = msg['file_name']
+            self.ft.delete_file(fn)
+            # search and delete sdfs replica from local storage
+            for file in os.listdir(SDFS_PATH):
+                file_path = os.path.join(SDFS_PATH, file)
+                if os.path.isfile(file_path) and file.startswith(fn):
+                    print('[INFO] Match and delete file %s.' % file)
+                    os.remove(file_path)
+
+        # elif msg_type == 'failed_relay':
+        #     fid = self.get_id_from_host(msg['host'])
+        #     if fid not in self.lives:
+        #         continue
+        #     print('[INFO] Receive failed_relay message.')
+        #     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
+        #         failed_msg = {
+        #             'type': 'failed',
+        #             'host': msg['host'],
+        #         }
+        #         # multicast FAILED message to all other nodes
+        #         for host in ALL_HOSTS:
+        #             ss.sendto(json.dumps(failed_msg).encode('utf-8'), (host, DEFAULT_PORT_SDFS))
+
+        elif msg_type == 'failed_relay':
+            fid = self.get_id_from_host(msg['host'])
+            if fid not in self.lives:
+                return
+            print('[INFO] Receive failed_relay message.')
+            self.lives.discard(fid)
+            for f in idm[fid]:
+                replicas = fm[f]['replicas']
+                replicas.discard(fid)
+                # check if itself needs to help re-replicate
+                try:
+                    if self.id == max(replicas):
+                        # choice an available source
+                        rid = random.choice(list(self.lives - replicas))
+                        # help to re-replicate
                         for file in os.listdir(SDFS_PATH):
                             file_path = os.path.join(SDFS_PATH, file)
-                            if os.path.isfile(file_path) and file.startswith(fn):
-                                print('[INFO] Match and delete file %s.' % file)
-                                os.remove(file_path)
-
-                    # elif msg_type == 'failed_relay':
-                    #     fid = self.get_id_from_host(msg['host'])
-                    #     if fid not in self.lives:
-                    #         continue
-                    #     print('[INFO] Receive failed_relay message.')
-                    #     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                    #         failed_msg = {
-                    #             'type': 'failed',
-                    #             'host': msg['host'],
-                    #         }
-                    #         # multicast FAILED message to all other nodes
-                    #         for host in ALL_HOSTS:
-                    #             ss.sendto(json.dumps(failed_msg).encode('utf-8'), (host, DEFAULT_PORT_SDFS))
-
-                    elif msg_type == 'failed_relay':
-                        fid = self.get_id_from_host(msg['host'])
-                        if fid not in self.lives:
-                            continue
-                        print('[INFO] Receive failed_relay message.')
-                        self.lives.discard(fid)
-                        for f in idm[fid]:
-                            replicas = fm[f]['replicas']
-                            replicas.discard(fid)
-                            # check if itself needs to help re-replicate
-                            try:
-                                if self.id == max(replicas):
-                                    # choice an available source
-                                    rid = random.choice(list(self.lives - replicas))
-                                    # help to re-replicate
-                                    for file in os.listdir(SDFS_PATH):
-                                        file_path = os.path.join(SDFS_PATH, file)
-                                        if os.path.isfile(file_path) and file.startswith(f):
-                                            print('[INFO] Re-replica file %s to %d' % (file, rid))
-                                            prefix = 'wenhans2' + '@' + self.get_host_from_id(rid)
-                                            p = subprocess.Popen(['scp',
-                                                                  file_path,
-                                                                  prefix + ':' + file_path])
-                                            # os.waitpid(p.pid, 0)
-                                    # update status and new replica message
-                                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                                        update_msg = {
-                                            'type': 'update',
-                                            'file_name': f,
-                                            'replicas': list({rid} | replicas),
-                                            'version': fm[f]['version'],
-                                        }
-                                        for host in ALL_HOSTS:
-                                            ss.sendto(json.dumps(update_msg).encode('utf-8'), (host, self.port))
-                            except Exception as e:
-                                pass
-                        # clean idm, in case other failed message comes
-                        idm[fid] = set()
-
-                    elif msg_type == 'join':
-                        print('[INFO] Receive join message.')
-                        if self.failure_detector.is_introducer():
-                            # multicast join message, sync structure of lives
-                            jid = self.get_id_from_host(msg['host'][0])
-                            self.lives.add(jid)
-                            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                                join_msg = {
-                                    'type': 'join',
-                                    'lives': list(self.lives),
-                                }
-                                for host in ALL_HOSTS:
-                                    if host != self.host:
-                                        ss.sendto(json.dumps(join_msg).encode('utf-8'), (host, self.port))
-                        else:
-                            # if receiver is not introducer, just update lives
-                            self.lives |= set(msg['lives'])
+                            if os.path.isfile(file_path) and file.startswith(f):
+                                print('[INFO] Re-replica file %s to %d' % (file, rid))
+                                prefix = 'wenhans2' + '@' + self.get_host_from_id(rid)
+                                p = subprocess.Popen(['scp',
+                                                      file_path,
+                                                      prefix + ':' + file_path])
+                                # os.waitpid(p.pid, 0)
+                        # update status and new replica message
+                        update_msg = {
+                            'type': 'update',
+                            'file_name': f,
+                            'replicas': list({rid} | replicas),
+                            'version': fm[f]['version'],
+                        }
+                        for host in ALL_HOSTS:
+                            self.runtime.send(update_msg, (host, self.port))
+                except Exception as e:
+                    pass
+            # clean idm, in case other failed message comes
+            idm[fid] = set()
+
+        elif msg_type == 'join':
+            print('[INFO] Receive join message.')
+            if self.failure_detector.is_introducer():
+                # multicast join message, sync structure of lives
+                jid = self.get_id_from_host(msg['host'][0])
+                self.lives.add(jid)
+                join_msg = {
+                    'type': 'join',
+                    'lives': list(self.lives),
+                }
+                for host in ALL_HOSTS:
+                    if host != self.host:
+                        self.runtime.send(join_msg, (host, self.port))
+            else:
+                # if receiver is not introducer, just update lives
+                self.lives |= set(msg['lives'])
 
     def get_id_from_host(self, host):
         """
@@ -240,15 +237,14 @@ class Server:
         self.ft.insert_file(sdfs_file_name, target_ids)
 
         # multicast udpate message
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            update_msg = {
-                'type': 'update',
-                'file_name': sdfs_file_name,
-                'replicas': list(target_ids),
-                'version': fm[sdfs_file_name]['version'],
-            }
-            for host in ALL_HOSTS:
-                s.sendto(json.dumps(update_msg).encode('utf-8'), (host, self.port))
+        update_msg = {
+            'type': 'update',
+            'file_name': sdfs_file_name,
+            'replicas': list(target_ids),
+            'version': fm[sdfs_file_name]['version'],
+        }
+        for host in ALL_HOSTS:
+            self.runtime.send(update_msg, (host, self.port))
 
     def get_file(self, sdfs_file_name, local_file_name, num_version=None):
         """
@@ -300,13 +296,12 @@ class Server:
             print('[ERROR] No such sdfs file: %s' % sdfs_file_name)
             return
         self.ft.delete_file(sdfs_file_name)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            delete_msg = {
-                'type': 'delete',
-                'file_name': sdfs_file_name,
-            }
-            for host in ALL_HOSTS:
-                s.sendto(json.dumps(delete_msg).encode('utf-8'), (host, self.port))
+        delete_msg = {
+            'type': 'delete',
+            'file_name': sdfs_file_name,
+        }
+        for host in ALL_HOSTS:
+            self.runtime.send(delete_msg, (host, self.port))
 
     def list_sdfs_file(self, sdfs_file_name):
         fm = self.ft.fm
@@ -319,6 +314,12 @@ class Server:
         pprint(self.ft.idm)
 
     def monitor(self):
+        """
+        It monitors the input command in its own thread. Commands run on the event loop, except for
+        get-versions which waits for its downloads.
+
+        :return: None
+        """
         helper = '''
         ======  Command List  ======
         - get [sdfs_file_name] [local_file_name]
@@ -348,28 +349,28 @@ class Server:
                 if len(args) != 3:
                     print('[ERROR FORMAT] get sdfs_file_name local_file_name')
                     continue
-                self.get_file(args[1], args[2])
+                self.runtime.call(self.get_file, args[1], args[2])
             elif arg.startswith('put'):
                 if len(args) != 3:
                     print('[ERROR FORMAT] put local_file_name sdfs_file_name')
                     continue
-                self.put_file(args[1], args[2])
+                self.runtime.call(self.put_file, args[1], args[2])
             elif arg.startswith('delete'):
                 if len(args) != 2:
                     print('[ERROR FORMAT] delete sdfs_file_name')
                     continue
-                self.delete_file(args[1])
+                self.runtime.call(self.delete_file, args[1])
             elif arg.startswith('ls'):
                 if len(args) != 2:
                     print('[ERROR FORMAT] ls sdfs_file_name')
                     continue
-                self.list_sdfs_file(args[1])
+                self.runtime.call(self.list_sdfs_file, args[1])
             elif arg.startswith('store'):
-                self.show_store()
+                self.runtime.call(self.show_store)
             elif arg == 'fm':
-                pprint(self.ft.fm)
+                self.runtime.call(pprint, self.ft.fm)
             elif arg == 'idm':
-                pprint(self.ft.idm)
+                self.runtime.call(pprint, self.ft.idm)
             elif arg == 'join':
                 self.failure_detector.join()
             elif arg == 'leave':
@@ -377,7 +378,7 @@ class Server:
             elif arg == 'ml':
                 self.failure_detector.print_ml()
             elif arg == 'lives':
-                print(self.lives)
+                self.runtime.call(print, self.lives)
             else:
                 print('[ERROR] Invalid input arg %s' % arg)
 
@@ -387,11 +388,9 @@ class Server:
         if os.path.exists(SDFS_PATH):
             shutil.rmtree(SDFS_PATH)
         os.mkdir(SDFS_PATH)
-        t_receiver = threading.Thread(target=self.receiver)
+        self.runtime.listen(self.addr, self.receiver)
         t_monitor = threading.Thread(target=self.monitor)
-        t_receiver.start()
         t_monitor.start()
-        t_receiver.join()
         t_monitor.join()
 
 
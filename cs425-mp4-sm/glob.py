@@ -25,3 +25,9 @@ NUM_REPLICAS = 2
 SDFS_PATH = os.path.join(os.path.expanduser('~'), 'files')
 
 INPUT_SLEEP_PERIOD = .0
+
+# a node is failed if it does not acknowledge a ping within this many secs
+PING_TIMEOUT = 3.
+
+# format of the messages sent, 'binary' (see codec.py) or 'json', both formats are always received
+WIRE_FORMAT = 'binary'
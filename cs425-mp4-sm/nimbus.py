@@ -1,10 +1,9 @@
 import socket
-import json
 from helper import *
 from glob import *
+from runtime import Runtime
+import asyncio
 import random
-import time
-import datetime
 import threading
 from pprint import pprint
 import yaml
@@ -27,175 +26,150 @@ class Nimbus:
         self.pid = 0  # package id, package is tuple in Storm system
         self.jid = -1  # job id, every new job has a unique id
         self.ml = {}  # membership list, like failure detector
-        self.timer = {}  # failure checker
-        self.ml_lock = threading.Lock()
+        self.runtime = Runtime()  # event loop of the receiver, the pings, their time outs and the jobs
         self.master_host = DEFAULT_MASTER_HOST
-        self.t_receiver = threading.Thread(target=self.receiver)
-        self.t_receiver.start()
-        self.t_ping_sender = threading.Thread(target=self.ping_sender)
-        self.t_ping_sender.start()
-        self.t_checker = threading.Thread(target=self.checker)
-        self.t_checker.start()
+        self.runtime.listen((self.host, DEFAULT_FD_PORT), self.receiver)
+        self.runtime.every(1, self.ping_sender)
         self.t_monitor = threading.Thread(target=self.monitor)
         self.t_monitor.start()
         self.join()
 
     def join(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            join_msg = {
-                'type': 'join',
-                'host': self.host,
-                'mode': 'master',
-            }
-            s.sendto(json.dumps(join_msg).encode('utf-8'), (self.master_host, DEFAULT_FD_PORT))
+        join_msg = {
+            'type': 'join',
+            'host': self.host,
+            'mode': 'master',
+        }
+        self.runtime.send(join_msg, (self.master_host, DEFAULT_FD_PORT))
 
-    def receiver(self):
+    def receiver(self, msg, addr):
         """
-        Receiver thread on Nimbus. It responsible for all incoming message:
+        Receiver on Nimbus, run on the event loop for every message. It responsible for all incoming message:
         - 'ack/join/leave' from follower
         - 'ping' from another hot-standby master
         - 'sync' from current master (as hot-standby itself)
 
+        :param msg: decoded message
+        :param addr: source address
         :return: None
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind((self.host, DEFAULT_FD_PORT))
-            while True:
-                data, server = s.recvfrom(4096)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    from_host = msg['host']
-                    if msg['type'] == 'join':
-                        self.ml_lock.acquire()
-                        self.ml[from_host] = {
-                            'mode': msg['mode'],
-                            'status': Status.RUNNING,
-                        }
-                        self.ml_lock.release()
-                        if from_host in self.timer:
-                            del self.timer[from_host]
-                        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                            join_msg = {
-                                'type': 'join',
-                                'lives': list(INIT_SUPERVISOR_IDS & {get_id_from_host(k) for k in self.ml}),
-                            }
-                            for host in ALL_HOSTS:
-                                ss.sendto(json.dumps(join_msg).encode('utf-8'), (host, DEFAULT_SDFS_PORT))
-                    elif msg['type'] == 'ack':
-                        if from_host in self.timer:
-                            del self.timer[from_host]
-                    elif msg['type'] == 'leave':
-                        if from_host not in self.ml:
-                            continue
-                        self.ml[from_host]['status'] = Status.LEAVED
-                        if from_host in self.timer:
-                            del self.timer[from_host]
-                    elif msg['type'] == 'sync' and self.master_host != self.host:
-                        self.topo_file = msg['topo_file']
-                        self.source = msg['source']
-                        self.node_map = msg['node_map']
-                        self.pid = msg['pid']
-                        self.jid = msg['jid']
-                        self.ml = msg['ml']
-                    elif msg['type'] == 'ping':
-                        ack_msg = {
-                            'type': 'ack',
-                            'host': self.host,
-                        }
-                        s.sendto(json.dumps(ack_msg).encode('utf-8'), (from_host, DEFAULT_FD_PORT))
+        from_host = msg['host']
+        if msg['type'] == 'join':
+            self.ml[from_host] = {
+                'mode': msg['mode'],
+                'status': Status.RUNNING,
+            }
+            self.runtime.cancel(from_host)
+            join_msg = {
+                'type': 'join',
+                'lives': list(INIT_SUPERVISOR_IDS & {get_id_from_host(k) for k in self.ml}),
+            }
+            for host in ALL_HOSTS:
+                self.runtime.send(join_msg, (host, DEFAULT_SDFS_PORT))
+        elif msg['type'] == 'ack':
+            self.runtime.cancel(from_host)
+        elif msg['type'] == 'leave':
+            if from_host not in self.ml:
+                return
+            self.ml[from_host]['status'] = Status.LEAVED
+            self.runtime.cancel(from_host)
+        elif msg['type'] == 'sync' and self.master_host != self.host:
+            self.topo_file = msg['topo_file']
+            self.source = msg['source']
+            self.node_map = msg['node_map']
+            self.pid = msg['pid']
+            self.jid = msg['jid']
+            self.ml = msg['ml']
+        elif msg['type'] == 'ping':
+            ack_msg = {
+                'type': 'ack',
+                'host': self.host,
+            }
+            self.runtime.send(ack_msg, (from_host, DEFAULT_FD_PORT))
 
     def ping_sender(self):
         """
-        A ping sender. Multicast ping message to all followers.
+        A ping sender, run on the event loop every second. Multicast ping message to all followers.
 
         :return: None
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            while True:
-                time.sleep(1)
-                ping_msg = {
-                    'type': 'ping',
+        ping_msg = {
+            'type': 'ping',
+            'host': self.host,
+        }
+        for host in list(self.ml.keys()):
+            if (host == self.host) or (self.ml[host]['status'] == Status.LEAVED):
+                continue
+            if self.ml[host]['mode'] == 'master':
+                # send sync message to hot-standby
+                sync_msg = {
+                    'type': 'sync',
+                    'topo_file': self.topo_file,
+                    'source': self.source,
+                    'node_map': self.node_map,
+                    'pid': self.pid,
+                    'jid': self.jid,
+                    'ml': self.ml,
                     'host': self.host,
                 }
-                for host in list(self.ml.keys()):
-                    if (host == self.host) or (self.ml[host]['status'] == Status.LEAVED):
-                        continue
-                    if self.ml[host]['mode'] == 'master':
-                        # send sync message to hot-standby
-                        sync_msg = {
-                            'type': 'sync',
-                            'topo_file': self.topo_file,
-                            'source': self.source,
-                            'node_map': self.node_map,
-                            'pid': self.pid,
-                            'jid': self.jid,
-                            'ml': self.ml,
-                            'host': self.host,
-                        }
-                        s.sendto(json.dumps(sync_msg).encode('utf-8'), (host, DEFAULT_FD_PORT))
-                        s.sendto(json.dumps(ping_msg).encode('utf-8'), (host, DEFAULT_FD_PORT))
-                        if host not in self.timer:
-                            self.timer[host] = datetime.datetime.now()
+                self.runtime.send(sync_msg, (host, DEFAULT_FD_PORT))
+                self.runtime.send(ping_msg, (host, DEFAULT_FD_PORT))
+                self.runtime.add(host, PING_TIMEOUT, self.checker, host)
 
-                    if self.ml[host]['mode'] == 'follower' and self.host == self.master_host:
-                        # send ping message to all followers
-                        s.sendto(json.dumps(ping_msg).encode('utf-8'), (host, DEFAULT_FD_PORT))
-                        if host not in self.timer:
-                            self.timer[host] = datetime.datetime.now()
+            if self.ml[host]['mode'] == 'follower' and self.host == self.master_host:
+                # send ping message to all followers
+                self.runtime.send(ping_msg, (host, DEFAULT_FD_PORT))
+                self.runtime.add(host, PING_TIMEOUT, self.checker, host)
 
-    def checker(self):
+    def checker(self, host):
         """
-        A failure-detector-liked checker with timeout feature.
+        A failure-detector-liked checker with timeout feature. The runtime runs it on the event loop
+        once a ping to the host has not been acknowledged for PING_TIMEOUT secs.
 
+        :param host: host which did not acknowledge in time
         :return: None
         """
-        while True:
-            for host in list(self.timer.keys()):
-                now = datetime.datetime.now()
-                time_delta = now - self.timer.get(host, datetime.datetime.now())
-                if time_delta.days >= 0 and time_delta.seconds > 3.:
-                    if self.ml[host]['status'] == Status.FAILED:
-                        continue
-                    self.ml[host]['status'] = Status.FAILED
-                    cur_ids = set(self.node_map.values())
-                    if self.ml[host]['mode'] == 'master':
-                        # master fault tolerance: switch to hot-standby and resubmit current job
-                        if host == self.master_host:
-                            print('[INFO] Master failure detected. Change master to [%s].' % self.host)
-                            self.master_host = self.host
-                            if self.topo_file is not None:
-                                print('[INFO] Resubmit the job.')
-                                self.submit(self.topo_file, self.source)
-                                self.run_job(self.jid)
-                    else:
-                        # follower fault tolerance: simply resubmit current the job or not (if not related)
-                        print('[INFO] Follower [%s] failure detected.' % host)
-                        if get_id_from_host(host) in cur_ids:
-                            print('[INFO] Resubmit the job.')
-                            self.submit(self.topo_file, self.source)
-                            self.run_job(self.jid)
-                        else:
-                            print('[INFO] No need to resubmit the job.')
-                        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                            failed_msg = {
-                                'type': 'failed',
-                                'host': host,
-                            }
-                            for live_host in self.ml:
-                                s.sendto(json.dumps(failed_msg).encode('utf-8'), (live_host, DEFAULT_SDFS_PORT))
+        if self.ml[host]['status'] == Status.FAILED:
+            return
+        self.ml[host]['status'] = Status.FAILED
+        cur_ids = set(self.node_map.values())
+        if self.ml[host]['mode'] == 'master':
+            # master fault tolerance: switch to hot-standby and resubmit current job
+            if host == self.master_host:
+                print('[INFO] Master failure detected. Change master to [%s].' % self.host)
+                self.master_host = self.host
+                if self.topo_file is not None:
+                    print('[INFO] Resubmit the job.')
+                    self.submit(self.topo_file, self.source)
+                    self.run_job(self.jid)
+        else:
+            # follower fault tolerance: simply resubmit current the job or not (if not related)
+            print('[INFO] Follower [%s] failure detected.' % host)
+            if get_id_from_host(host) in cur_ids:
+                print('[INFO] Resubmit the job.')
+                self.submit(self.topo_file, self.source)
+                self.run_job(self.jid)
+            else:
+                print('[INFO] No need to resubmit the job.')
+            failed_msg = {
+                'type': 'failed',
+                'host': host,
+            }
+            for live_host in self.ml:
+                self.runtime.send(failed_msg, (live_host, DEFAULT_SDFS_PORT))
 
     def run_job(self, jid):
         """
-        Create a new instance of run() process to submit multiple jobs without stopping the previous.
+        Create a new instance of run() task on the event loop to submit multiple jobs without stopping the previous.
+        It can be called from any thread.
 
         :return:
         """
-        t_run = threading.Thread(target=self.run, args=[jid])
-        t_run.start()
+        self.runtime.spawn(self.run(jid))
 
     def monitor(self):
         """
-        It monitors the input command.
+        It monitors the input command in its own thread, and hands the commands over to the event loop.
 
         :return: None
         """
@@ -214,19 +188,19 @@ class Nimbus:
             if arg == '?' or arg == 'help':
                 print(helper)
             elif arg == 'ml':
-                pprint(self.ml)
+                self.runtime.call(pprint, self.ml)
             elif arg == 'nm':
-                pprint(self.node_map)
+                self.runtime.call(pprint, self.node_map)
             elif arg == 'topo':
                 if not self.topo:
                     print('[ERROR] No topology.')
                     continue
-                pprint(self.topo.nodes)
+                self.runtime.call(pprint, self.topo.nodes)
             elif arg.startswith('submit'):
                 if len(args) != 3:
                     print('[ERROR FORMAT] submit topo_file source')
                     continue
-                self.submit(args[1], args[2])
+                self.runtime.call(self.submit, args[1], args[2])
             elif arg == 'run':
                 self.run_job(self.jid)
             else:
@@ -264,58 +238,55 @@ class Nimbus:
         self.source = source
         self.jid = random.randint(0, 65535)
         self.node_map = {}  # reschedule node map
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            cur_ids = self.get_live_follower_ids()
-            for nid, node_info in self.topo.nodes.items():
-                # for each node in topology, allocate a available follower to it
-                remain_ids = cur_ids - set(self.node_map.values())
-                if not remain_ids:
-                    print('[ERROR] No remain empty nodes.')
-                    return
-                schedule_id = random.choice(list(remain_ids))
-                node_msg = {
-                    'type': 'node',
-                    'nid': nid,
-                    'jid': self.jid,
-                    'info': node_info,
-                    'master_host': self.host,
-                }
-                s.sendto(json.dumps(node_msg).encode('utf-8'),
-                         (get_host_from_id(schedule_id), DEFAULT_SUPERVISOR_PORT))
-                self.node_map[nid] = schedule_id
-            # once all nodes are allocated, broadcast a complete node map info to all followers
-            node_map_msg = {
-                'type': 'node_map',
-                'info': self.node_map,
+        cur_ids = self.get_live_follower_ids()
+        for nid, node_info in self.topo.nodes.items():
+            # for each node in topology, allocate a available follower to it
+            remain_ids = cur_ids - set(self.node_map.values())
+            if not remain_ids:
+                print('[ERROR] No remain empty nodes.')
+                return
+            schedule_id = random.choice(list(remain_ids))
+            node_msg = {
+                'type': 'node',
+                'nid': nid,
+                'jid': self.jid,
+                'info': node_info,
+                'master_host': self.host,
             }
-            for nid in INIT_SUPERVISOR_IDS:
-                s.sendto(json.dumps(node_map_msg).encode('utf-8'),
-                         (get_host_from_id(nid), DEFAULT_SUPERVISOR_PORT))
+            self.runtime.send(node_msg, (get_host_from_id(schedule_id), DEFAULT_SUPERVISOR_PORT))
+            self.node_map[nid] = schedule_id
+        # once all nodes are allocated, broadcast a complete node map info to all followers
+        node_map_msg = {
+            'type': 'node_map',
+            'info': self.node_map,
+        }
+        for nid in INIT_SUPERVISOR_IDS:
+            self.runtime.send(node_map_msg, (get_host_from_id(nid), DEFAULT_SUPERVISOR_PORT))
 
-    def run(self, jid):
+    async def run(self, jid):
         """
         Run a job with current config (i.e. topology and data source).
+        It yields to the event loop after every tuple, so pings and acks are still handled in time.
 
         :return:
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            with open(self.source, 'r') as f:
-                for line in f:
-                    if jid != self.jid:
-                        break
-                    if INPUT_SLEEP_PERIOD != .0:
-                        time.sleep(INPUT_SLEEP_PERIOD)
-                    pkg = {
-                        'pid': self.pid,
-                        'jid': jid,
-                        'data': line.rstrip('\n'),
-                    }
-                    try:
-                        s.sendto(json.dumps(pkg).encode('utf-8'),
-                                 (get_host_from_id(self.node_map[self.topo.root_id]), DEFAULT_DATA_PORT))
-                    except Exception as e:
-                        pass
-                    self.pid += 1
+        with open(self.source, 'r') as f:
+            for line in f:
+                if jid != self.jid:
+                    break
+                await asyncio.sleep(INPUT_SLEEP_PERIOD)
+                pkg = {
+                    'pid': self.pid,
+                    'jid': jid,
+                    'data': line.rstrip('\n'),
+                }
+                try:
+                    # waits for room in the send buffer instead of dropping the tuple
+                    await self.runtime.send_wait(pkg, (get_host_from_id(self.node_map[self.topo.root_id]),
+                                                       DEFAULT_DATA_PORT))
+                except Exception as e:
+                    pass
+                self.pid += 1
 
 
 if __name__ == '__main__':
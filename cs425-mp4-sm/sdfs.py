@@ -1,6 +1,3 @@
-import socket
-import threading
-import json
 import subprocess
 import shutil
 from glob import *
@@ -44,7 +41,7 @@ class FileTable:
 
 
 class SDFSServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, runtime):
         self.ft = FileTable()  # file table, including an id mapper and file mapper
         self.host = host
         self.port = port
@@ -54,10 +51,10 @@ class SDFSServer:
         if os.path.exists(SDFS_PATH):
             shutil.rmtree(SDFS_PATH)
         os.mkdir(SDFS_PATH)
-        self.t_receiver = threading.Thread(target=self.receiver)
-        self.t_receiver.start()
+        self.runtime = runtime  # event loop shared with Supervisor
+        self.runtime.listen(self.addr, self.receiver)
 
-    def receiver(self):
+    def receiver(self, msg, addr):
         """
         Like failure detector, receiver is an UDP receiver to get all contact message including
         - UPDATE: update idm and fm, sync the status
@@ -65,81 +62,77 @@ class SDFSServer:
         - FAILED_RELAY: receive from failure detector, to know that a replica is down
         - FAILED: multicasted by replicas, to let all other node know a replica is down
         - JOIN: multicasted by sdfs server whose failure detector is introducer (default is node with id 1)
+        It runs on the event loop shared with Supervisor.
+        :param msg: decoded message
+        :param addr: source address
         :return: None
         """
         fm = self.ft.fm
         idm = self.ft.idm
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind(self.addr)
-            while True:
-                data, server = s.recvfrom(4096)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    msg_type = msg['type']
+        msg_type = msg['type']
 
-                    if msg_type == 'update':
-                        fn = msg['file_name']
-                        replicas = set(msg['replicas'])
-                        for replica in replicas:
-                            idm[replica].add(fn)
-                        if fn not in fm:
-                            fm[fn] = {
-                                'version': 0,
-                                'replicas': set(),
-                            }
-                        fm[fn]['version'] = msg['version']
-                        fm[fn]['replicas'] |= replicas
+        if msg_type == 'update':
+            fn = msg['file_name']
+            replicas = set(msg['replicas'])
+            for replica in replicas:
+                idm[replica].add(fn)
+            if fn not in fm:
+                fm[fn] = {
+                    'version': 0,
+                    'replicas': set(),
+                }
+            fm[fn]['version'] = msg['version']
+            fm[fn]['replicas'] |= replicas
 
-                    elif msg_type == 'delete':
-                        fn = msg['file_name']
-                        self.ft.delete_file(fn)
-                        # search and delete sdfs replica from local storage
+        elif msg_type == 'delete':
+            fn = msg['file_name']
+            self.ft.delete_file(fn)
+            # search and delete sdfs replica from local storage
+            for file in os.listdir(SDFS_PATH):
+                file_path = os.path.join(SDFS_PATH, file)
+                if os.path.isfile(file_path) and file.startswith(fn):
+                    print('[INFO] Match and delete file %s.' % file)
+                    os.remove(file_path)
+
+        elif msg_type == 'failed':
+            fid = self.get_id_from_host(msg['host'])
+            if fid not in self.lives:
+                return
+            self.lives.discard(fid)
+            for f in idm[fid]:
+                replicas = fm[f]['replicas']
+                replicas.discard(fid)
+                # check if itself needs to help re-replicate
+                try:
+                    if self.id == max(replicas):
+                        # choice an available source
+                        rid = random.choice(list(self.lives - replicas))
+                        # help to re-replicate
                         for file in os.listdir(SDFS_PATH):
                             file_path = os.path.join(SDFS_PATH, file)
-                            if os.path.isfile(file_path) and file.startswith(fn):
-                                print('[INFO] Match and delete file %s.' % file)
-                                os.remove(file_path)
-
-                    elif msg_type == 'failed':
-                        fid = self.get_id_from_host(msg['host'])
-                        if fid not in self.lives:
-                            continue
-                        self.lives.discard(fid)
-                        for f in idm[fid]:
-                            replicas = fm[f]['replicas']
-                            replicas.discard(fid)
-                            # check if itself needs to help re-replicate
-                            try:
-                                if self.id == max(replicas):
-                                    # choice an available source
-                                    rid = random.choice(list(self.lives - replicas))
-                                    # help to re-replicate
-                                    for file in os.listdir(SDFS_PATH):
-                                        file_path = os.path.join(SDFS_PATH, file)
-                                        if os.path.isfile(file_path) and file.startswith(f):
-                                            print('[INFO] Re-replica file %s to %d' % (file, rid))
-                                            prefix = 'wenhans2' + '@' + self.get_host_from_id(rid)
-                                            p = subprocess.Popen(['scp',
-                                                                  file_path,
-                                                                  prefix + ':' + file_path])
-                                            # os.waitpid(p.pid, 0)
-                                    # update status and new replica message
-                                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                                        update_msg = {
-                                            'type': 'update',
-                                            'file_name': f,
-                                            'replicas': list({rid} | replicas),
-                                            'version': fm[f]['version'],
-                                        }
-                                        for host in ALL_HOSTS:
-                                            ss.sendto(json.dumps(update_msg).encode('utf-8'), (host, self.port))
-                            except Exception as e:
-                                pass
-                        # clean idm, in case other failed message comes
-                        idm[fid] = set()
+                            if os.path.isfile(file_path) and file.startswith(f):
+                                print('[INFO] Re-replica file %s to %d' % (file, rid))
+                                prefix = 'wenhans2' + '@' + self.get_host_from_id(rid)
+                                p = subprocess.Popen(['scp',
+                                                      file_path,
+                                                      prefix + ':' + file_path])
+                                # os.waitpid(p.pid, 0)
+                        # update status and new replica message
+                        update_msg = {
+                            'type': 'update',
+                            'file_name': f,
+                            'replicas': list({rid} | replicas),
+                            'version': fm[f]['version'],
+                        }
+                        for host in ALL_HOSTS:
+                            self.runtime.send(update_msg, (host, self.port))
+                except Exception as e:
+                    pass
+            # clean idm, in case other failed message comes
+            idm[fid] = set()
 
-                    elif msg_type == 'join':
-                        self.lives |= set(msg['lives'])
+        elif msg_type == 'join':
+            self.lives |= set(msg['lives'])
 
     def get_id_from_host(self, host):
         """
@@ -185,15 +178,14 @@ class SDFSServer:
         self.ft.insert_file(sdfs_file_name, target_ids)
 
         # multicast udpate message
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            update_msg = {
-                'type': 'update',
-                'file_name': sdfs_file_name,
-                'replicas': list(target_ids),
-                'version': fm[sdfs_file_name]['version'],
-            }
-            for host in ALL_HOSTS:
-                s.sendto(json.dumps(update_msg).encode('utf-8'), (host, self.port))
+        update_msg = {
+            'type': 'update',
+            'file_name': sdfs_file_name,
+            'replicas': list(target_ids),
+            'version': fm[sdfs_file_name]['version'],
+        }
+        for host in ALL_HOSTS:
+            self.runtime.send(update_msg, (host, self.port))
 
     def get_file(self, sdfs_file_name, local_file_name, num_version=None):
         """
@@ -245,13 +237,12 @@ class SDFSServer:
             print('[ERROR] No such sdfs file: %s' % sdfs_file_name)
             return
         self.ft.delete_file(sdfs_file_name)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            delete_msg = {
-                'type': 'delete',
-                'file_name': sdfs_file_name,
-            }
-            for host in ALL_HOSTS:
-                s.sendto(json.dumps(delete_msg).encode('utf-8'), (host, self.port))
+        delete_msg = {
+            'type': 'delete',
+            'file_name': sdfs_file_name,
+        }
+        for host in ALL_HOSTS:
+            self.runtime.send(delete_msg, (host, self.port))
 
     def list_sdfs_file(self, sdfs_file_name):
         fm = self.ft.fm
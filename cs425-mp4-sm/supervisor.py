@@ -1,7 +1,7 @@
 import socket
-import json
 from helper import *
 from glob import *
+from runtime import Runtime
 import threading
 from pprint import pprint
 import sdfs
@@ -17,104 +17,87 @@ class Supervisor:
         self.node_info = None
         self.next_host = None  # its child node id in current topology
         self.master_host = DEFAULT_MASTER_HOST  # current master host, to handle master failure
-        self.t_data_receiver = threading.Thread(target=self.config_receiver)
-        self.t_config_receiver = threading.Thread(target=self.data_receiver)
-        self.t_ping_receiver = threading.Thread(target=self.ping_receiver)
-        self.t_data_receiver.start()
-        self.t_config_receiver.start()
-        self.t_ping_receiver.start()
+        self.runtime = Runtime()  # one event loop for all the receivers of Supervisor and SDFS
+        self.runtime.listen((self.host, DEFAULT_SUPERVISOR_PORT), self.config_receiver)
+        self.runtime.listen((self.host, DEFAULT_DATA_PORT), self.data_receiver)
+        self.runtime.listen((self.host, DEFAULT_FD_PORT), self.ping_receiver)
         self.t_monitor = threading.Thread(target=self.monitor)
         self.t_monitor.start()
-        self.sdfs = sdfs.SDFSServer(self.host, DEFAULT_SDFS_PORT)
+        self.sdfs = sdfs.SDFSServer(self.host, DEFAULT_SDFS_PORT, self.runtime)
         self.join()
 
     def join(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            join_msg = {
-                'type': 'join',
-                'host': self.host,
-                'mode': 'follower',
-            }
-            s.sendto(json.dumps(join_msg).encode('utf-8'), (self.master_host, DEFAULT_FD_PORT))
+        join_msg = {
+            'type': 'join',
+            'host': self.host,
+            'mode': 'follower',
+        }
+        self.runtime.send(join_msg, (self.master_host, DEFAULT_FD_PORT))
 
-    def ping_receiver(self):
+    def ping_receiver(self, msg, addr):
         """
         Receive ping message from current master.
 
+        :param msg: decoded message
+        :param addr: source address
         :return: None
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind((self.host, DEFAULT_FD_PORT))
-            while True:
-                data, server = s.recvfrom(4096)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    msg_type = msg['type']
-                    if msg_type == 'ping':
-                        # return ack message to master
-                        ack_msg = {
-                            'type': 'ack',
-                            'host': self.host,
-                        }
-                        self.master_host = msg['host']
-                        s.sendto(json.dumps(ack_msg).encode('utf-8'), (self.master_host, DEFAULT_FD_PORT))
-
-    def config_receiver(self):
+        msg_type = msg['type']
+        if msg_type == 'ping':
+            # return ack message to master
+            ack_msg = {
+                'type': 'ack',
+                'host': self.host,
+            }
+            self.master_host = msg['host']
+            self.runtime.send(ack_msg, (self.master_host, DEFAULT_FD_PORT))
+
+    def config_receiver(self, msg, addr):
         """
         Receiver config message from master including:
         - node: node-follower allocation
         - node_map: all topology graph
 
+        :param msg: decoded message
+        :param addr: source address
         :return: None
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind((self.host, DEFAULT_SUPERVISOR_PORT))
-            while True:
-                data, server = s.recvfrom(4096)
-                if data:
-                    msg = json.loads(data.decode('utf-8'))
-                    msg_type = msg['type']
-                    if msg_type == 'node':
-                        self.nid = msg['nid']
-                        self.node_info = msg['info']
-                        self.jid = msg['jid']
-                        self.master_host = msg['master_host']
-                    elif msg_type == 'node_map':
-                        self.node_map = {int(k): v for k, v in msg['info'].items()}
-                        if self.nid in self.node_map and self.node_info['child'] != -1:
-                            # once we get node_map, we can know real child host from node id
-                            self.next_host = get_host_from_id(self.node_map[self.node_info['child']])
-
-    def data_receiver(self):
+        msg_type = msg['type']
+        if msg_type == 'node':
+            self.nid = msg['nid']
+            self.node_info = msg['info']
+            self.jid = msg['jid']
+            self.master_host = msg['master_host']
+        elif msg_type == 'node_map':
+            self.node_map = {int(k): v for k, v in msg['info'].items()}
+            if self.nid in self.node_map and self.node_info['child'] != -1:
+                # once we get node_map, we can know real child host from node id
+                self.next_host = get_host_from_id(self.node_map[self.node_info['child']])
+
+    def data_receiver(self, pkg, addr):
         """
         Receive data (i.e. package in our Crane or tuple in Storm) from father node,
         apply the operation,
         and send the data to the child node.
 
+        :param pkg: decoded package
+        :param addr: source address
         :return: None
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as rs:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ss:
-                rs.bind((self.host, DEFAULT_DATA_PORT))
-                while True:
-                    data, server = rs.recvfrom(4096)
-                    if data:
-                        pkg = json.loads(data.decode('utf-8'))
-                        if pkg['jid'] != self.jid:
-                            continue
-                        if self.node_info['type'] == 'filter':
-                            self.filter(ss, pkg)
-                        elif self.node_info['type'] == 'transform':
-                            self.transform(ss, pkg)
-                        elif self.node_info['type'] == 'join':
-                            # relay all valid data to child node
-                            ss.sendto(json.dumps(pkg).encode('utf-8'), (self.next_host, DEFAULT_DATA_PORT))
-
-    def filter(self, ss, pkg):
+        if pkg['jid'] != self.jid:
+            return
+        if self.node_info['type'] == 'filter':
+            self.filter(pkg)
+        elif self.node_info['type'] == 'transform':
+            self.transform(pkg)
+        elif self.node_info['type'] == 'join':
+            # relay all valid data to child node
+            self.runtime.send_data(pkg, (self.next_host, DEFAULT_DATA_PORT))
+
+    def filter(self, pkg):
         """
         Apply filter operation: if the data pass the filter, then it will be sent to child node.
 
-        :param ss: socket connection
         :param pkg: data in Crane
         :return: None
         """
@@ -126,13 +109,12 @@ class Supervisor:
             with open('result_%05d.txt' % self.jid, 'a') as f:
                 f.write(pkg['data'] + '\n')
         else:
-            ss.sendto(json.dumps(pkg).encode('utf-8'), (self.next_host, DEFAULT_DATA_PORT))
+            self.runtime.send_data(pkg, (self.next_host, DEFAULT_DATA_PORT))
 
-    def transform(self, ss, pkg):
+    def transform(self, pkg):
         """
         Apply transform operation and send to child node.
 
-        :param ss: socket connection
         :param pkg: data in Crane
         :return: None
         """
@@ -145,7 +127,7 @@ class Supervisor:
             with open('result_%05d.txt' % self.jid, 'a') as f:
                 f.write(new_pkg['data'] + '\n')
         else:
-            ss.sendto(json.dumps(new_pkg).encode('utf-8'), (self.next_host, DEFAULT_DATA_PORT))
+            self.runtime.send_data(new_pkg, (self.next_host, DEFAULT_DATA_PORT))
 
     def save_result(self):
         """
@@ -163,7 +145,7 @@ class Supervisor:
 
     def monitor(self):
         """
-        It monitors the input command.
+        It monitors the input command in its own thread, and hands the commands over to the event loop.
 
         :return: None
         """
@@ -186,23 +168,23 @@ class Supervisor:
             elif arg == 'jid':
                 print('Current job id: %d' % self.jid)
             elif arg == 'nm':
-                pprint(self.node_map)
+                self.runtime.call(pprint, self.node_map)
             elif arg == 'save':
-                self.save_result()
+                self.runtime.call(self.save_result)
             elif arg == 'lives':
-                print(self.sdfs.lives)
+                self.runtime.call(print, self.sdfs.lives)
             elif arg.startswith('get'):
                 if len(args) != 3:
                     print('[ERROR FORMAT] get sdfs_file_name local_file_name')
                     continue
-                self.sdfs.get_file(args[1], args[2])
+                self.runtime.call(self.sdfs.get_file, args[1], args[2])
             elif arg.startswith('put'):
                 if len(args) != 3:
                     print('[ERROR FORMAT] put local_file_name sdfs_file_name')
                     continue
-                self.sdfs.put_file(args[1], args[2])
+                self.runtime.call(self.sdfs.put_file, args[1], args[2])
             elif arg.startswith('store'):
-                self.sdfs.show_store()
+                self.runtime.call(self.sdfs.show_store)
             else:
                 print('[ERROR] Invalid input arg %s' % arg)
 